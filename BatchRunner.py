@@ -0,0 +1,211 @@
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import yaml
+
+DEFAULT_MAX_WORKERS = 4
+LOF_FIELDS = ("unique_id", "install_date", "material")
+COF_FIELDS = LOF_FIELDS + ("diameter",)
+BREAK_SETTINGS = ("break_tolerance", "break_date", "break_window", "break_half_life")
+ROADWAY_VALUES = ("roadway_type", "major_road", "minor_road", "major_intersection", "minor_intersection")
+
+# The batch config lists every city to run, each city is run in its own worker process with its own results folder:
+#
+# cities:
+#   Allegan:
+#     login: Abonmarche          # city in CityLogins.yaml to sign in with, the city name when not given
+#     results_folder: C:\Results\Allegan
+#     service_life_table: C:\Results\AlleganServiceLife.csv   # or material: years pairs
+#     coordinate_system: 102690
+#     fields: {unique_id: FACILITYID, install_date: PLACEDINSE, material: MATERIAL, diameter: DIAMETER}
+#     roadway: {roadway_type: Road, major_road: Major Road, ...}   # optional, same defaults as WaterMainCOF
+#     streaming_risk: true       # optional, merge the risk results in batches for very large systems
+#     sensitivity_scenarios: 1000   # optional, score the COF under this many sampled weight scenarios after Risk
+#     tile_size: 50000           # optional, run the COF geometry stages in tiles of this side, for regional systems
+#     max_workers: 4             # optional, COF tiles running at once
+#     break_tolerance: 10        # optional, largest distance from a break to its main in coordinate_system units
+#     break_date: BREAKDATE      # optional, break date field, needed for break_window and break_half_life
+#     break_window: 10           # optional, only score the breaks of the last this many years
+#     break_half_life: 10        # optional, add the recency weighted break rate to Breaks
+#     services:
+#       WaterMain: https://.../FeatureServer/6
+#       Breaks: https://.../FeatureServer/5                    # optional
+#       WaterLaterals: https://.../FeatureServer/4
+#       ... one url for every layer in WaterMainCOF.COF_LAYERS
+
+
+def load_city_configs(config_file: str, cities=None) -> dict:
+    """
+    Reads the per city settings from the batch config
+
+    :param config_file: str: Path of the batch config
+    :param cities: list: Cities to run, every city in the config when not given
+    :return: dict: City name to its settings
+    """
+    with open(config_file, "r") as file:
+        config = yaml.safe_load(file)
+    city_configs = config["cities"]
+    if cities:
+        missing = [city for city in cities if city not in city_configs]
+        if missing:
+            raise KeyError(f"Cities not in {config_file}: {', '.join(missing)}")
+        city_configs = {city: city_configs[city] for city in cities}
+    return city_configs
+
+
+def _pipelines(city_config: dict) -> list:
+    # (name, callable) of every pipeline of a city in the order they have to run, Risk reads the LOF and COF results
+    from WaterMainCOF import COF_LAYERS, run_cof
+    from WaterMainLOF import run_lof
+    from WaterMainRisk import run_risk, run_risk_streaming
+    from WeightSensitivity import run_sensitivity
+
+    results_folder = city_config["results_folder"]
+    fields = city_config.get("fields", {})
+    services = city_config["services"]
+    unique_id = fields.get("unique_id", "FACILITYID")
+    lof_fields = {key: value for key, value in fields.items() if key in LOF_FIELDS}
+    cof_fields = {key: value for key, value in fields.items() if key in COF_FIELDS}
+    roadway = {key: value for key, value in city_config.get("roadway", {}).items() if key in ROADWAY_VALUES}
+    feature_services = [(name, services[name]) for name in COF_LAYERS]
+    export_csv = city_config.get("export_csv", False)
+    break_settings = {key: city_config[key] for key in BREAK_SETTINGS if key in city_config}
+    # merge the risk results in batches for very large systems
+    risk = run_risk_streaming if city_config.get("streaming_risk", False) else run_risk
+
+    pipelines = [
+        ("LOF", lambda gis: run_lof(
+            gis, results_folder, services["WaterMain"], city_config["service_life_table"], services.get("Breaks"),
+            coordinate_system=city_config.get("coordinate_system", 102690), export_csv=export_csv, **lof_fields,
+            **break_settings,
+        )),
+        ("COF", lambda gis: run_cof(
+            gis, results_folder, feature_services, coordinate_system=city_config.get("coordinate_system", 102690),
+            export_csv=export_csv, tile_size=city_config.get("tile_size"), max_workers=city_config.get("max_workers"),
+            **cof_fields, **roadway,
+        )),
+        ("Risk", lambda gis: risk(
+            results_folder, unique_id, cof_columns=[unique_id, "COF", "LENGTH"], lof_columns=[unique_id, "LOF"],
+            export_csv=export_csv,
+        )),
+    ]
+    if city_config.get("sensitivity_scenarios"):
+        pipelines.append(("Sensitivity", lambda gis: run_sensitivity(
+            results_folder, unique_id, city_config["sensitivity_scenarios"], export_csv=export_csv,
+        )))
+    return pipelines
+
+
+def run_city(city_name: str, city_config: dict, login_file: str) -> dict:
+    """
+    Runs the LOF, COF and Risk pipelines of one city, stopping at the first pipeline that fails
+
+    Everything the pipelines print goes to run.log in the city's results folder.
+
+    :param city_name: str: Name of the city
+    :param city_config: dict: Settings of the city from the batch config
+    :param login_file: str: Path of CityLogins.yaml
+    :return: dict: Status, time of every pipeline and the error of the failed pipeline
+    """
+    report = {"city": city_name, "status": "succeeded", "stages": {}, "failed_stage": None, "error": None}
+    start = time.perf_counter()
+    stage = "setup"
+    try:
+        results_folder = city_config["results_folder"]
+        os.makedirs(results_folder, exist_ok=True)
+        with open(os.path.join(results_folder, "run.log"), "a") as log, \
+                contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} starting {city_name}")
+            from WaterMainCOF import get_gis
+
+            gis = get_gis(city_config.get("login", city_name), login_file)
+            for stage, pipeline in _pipelines(city_config):
+                stage_start = time.perf_counter()
+                pipeline(gis)
+                report["stages"][stage] = round(time.perf_counter() - stage_start, 3)
+                print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {stage} finished")
+    except Exception as e:
+        report.update(status="failed", failed_stage=stage, error=repr(e), traceback=traceback.format_exc())
+    report["seconds"] = round(time.perf_counter() - start, 3)
+    return report
+
+
+def _pool(max_workers: int) -> ProcessPoolExecutor:
+    # Spawned workers do not inherit the parent's arcpy state, and on Python 3.11+ every city gets a fresh process
+    kwargs = {"max_workers": max_workers, "mp_context": multiprocessing.get_context("spawn")}
+    if sys.version_info >= (3, 11):
+        kwargs["max_tasks_per_child"] = 1
+    return ProcessPoolExecutor(**kwargs)
+
+
+def run_batch(city_configs: dict, login_file: str, max_workers: int = DEFAULT_MAX_WORKERS, report_path: str = None) -> list:
+    """
+    Runs every city in parallel worker processes and reports the progress as each city finishes
+
+    A city that fails does not stop the others. Cities lost to a worker process that died are run once more in a new
+    pool before they are reported as failed.
+
+    :param city_configs: dict: City name to its settings from load_city_configs
+    :param login_file: str: Path of CityLogins.yaml
+    :param max_workers: int: Largest number of cities running at once
+    :param report_path: str: Path to write the JSON report of every city to
+    :return: list: Report of every city from run_city
+    """
+    reports = {}
+    pending = list(city_configs)
+    total = len(pending)
+    for attempt in range(2):
+        lost = []
+        with _pool(max_workers) as pool:
+            futures = {pool.submit(run_city, city, city_configs[city], login_file): city for city in pending}
+            for future in as_completed(futures):
+                city = futures[future]
+                try:
+                    reports[city] = future.result()
+                except BrokenProcessPool as e:
+                    if attempt == 0:
+                        lost.append(city)
+                        continue
+                    reports[city] = {"city": city, "status": "failed", "stages": {}, "failed_stage": None,
+                                     "error": f"worker process died: {e!r}"}
+                report = reports[city]
+                detail = f"in {report['failed_stage']}: {report['error']}" if report["status"] == "failed" else ""
+                print(f"[{len(reports)}/{total}] {city} {report['status']} {detail}".rstrip(), flush=True)
+        if not lost:
+            break
+        print(f"Running {len(lost)} cities again after a worker process died", flush=True)
+        pending = lost
+
+    reports = [reports[city] for city in city_configs]
+    failed = [report["city"] for report in reports if report["status"] == "failed"]
+    print(f"{total - len(failed)} of {total} cities succeeded" + (f", failed: {', '.join(failed)}" if failed else ""))
+    if report_path:
+        with open(report_path, "w") as file:
+            json.dump(reports, file, indent=2)
+    return reports
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the LOF, COF and Risk pipelines for many cities in parallel")
+    parser.add_argument("config", help="Batch config with the settings of every city")
+    parser.add_argument("--logins", default="../CityLogins.yaml", help="CityLogins.yaml with the credentials")
+    parser.add_argument("--cities", nargs="*", help="Cities to run, every city in the config when not given")
+    parser.add_argument("--max-workers", type=int, default=DEFAULT_MAX_WORKERS, help="Cities running at once")
+    parser.add_argument("--report", default="batch_report.json", help="Path of the JSON report")
+    args = parser.parse_args(argv)
+
+    city_configs = load_city_configs(args.config, args.cities)
+    reports = run_batch(city_configs, args.logins, args.max_workers, args.report)
+    return 0 if all(report["status"] == "succeeded" for report in reports) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
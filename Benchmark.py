@@ -0,0 +1,276 @@
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import psutil
+import shapely
+
+from BreakHistory import break_table, build_break_history
+from BreakMatching import snap_breaks
+from Instrumentation import Trace
+from GeometryIO import GEOJSON_EXTENSIONS, GEOPARQUET_EXTENSIONS, layer_frame, read_layer
+from COFScoring import calculate_final_scores, score_mains, update_zones_with_connection
+from IsolationZoneEngine import find_isolation_zones, read_lines_shapely
+from LOFScoring import calculate_lof, score_service_life
+from NearDistance import class_distances, near_distances
+from ResultStore import write_result
+from Schemas import connection_dtypes, cof_dtypes, enforce_dtypes, lof_dtypes, near_results_dtypes, zone_dtypes
+from ServiceConnections import build_connection_index, critical_connections, lateral_mains, laterals_per_zone
+from SyntheticNetwork import SERVICE_LIFE, generate_network
+from Tiling import DEFAULT_MAX_WORKERS, tiled_connection_index, tiled_lateral_mains, tiled_near_distances
+from WaterMainRisk import heatmap_stage, risk_matrix_stage, risk_merge_stage
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+STAGES = [
+    "isolation_zones", "near_distances", "zone_join", "critical_connections", "lof", "cof_scoring", "risk_merge",
+    "risk_matrix", "heatmap",
+]
+# Near layer column names the COF scoring looks for
+ROAD_COLUMNS = {
+    "Major Road": "Major_Road", "Major Intersection": "Major_Intersection",
+    "Minor Intersection": "Minor_Intersection", "Minor Road": "Minor_Road",
+}
+UNIQUE_ID = "FACILITYID"
+CONNECTION_COLUMNS = ["CriticalCustomers", "SchoolChildcare", "Healthcare"]
+NEAR_COLUMNS = [*ROAD_COLUMNS.values(), "Buildings", "ROW", "WaterAreas", "WaterLines", "Railroad"]
+
+
+def _measures(record: dict) -> dict:
+    # Wall time, CPU time and peak RSS of one stage from its span
+    return {key: record[key] for key in ("wall_seconds", "cpu_seconds", "peak_rss_mb")}
+
+
+def _geometries(layers: dict, name: str) -> np.ndarray:
+    return layers[name]["geometry"].to_numpy()
+
+
+def run_stages(
+    layers: dict, work_folder: str, stages=STAGES, trace: Trace = None, tile_size: float = None,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+) -> dict:
+    """
+    Runs the pipeline stages on a synthetic system with the in memory engines and measures each one
+
+    Stages are run in order, a stage that is left out is still computed when a later stage needs its output but is
+    not reported.
+
+    :param layers: dict: Layers from SyntheticNetwork.generate_network
+    :param work_folder: str: Folder for the result store files the stages write
+    :param stages: list: Stages to report
+    :param trace: Trace: Active trace to record the stages to, a trace is made for the call when not given
+    :param tile_size: float: Run the near distances, zone join and critical connections in tiles of this side
+    :param max_workers: int: Tiles running at once
+    :return: dict: Stage name to its wall time, CPU time, peak RSS and row counts
+    """
+    mains = layers["mains"]
+    main_geometries = _geometries(layers, "mains")
+    report = {}
+    outputs = {}
+
+    def stage(name, rows_in, func, *args):
+        with trace.span(name, int(rows_in)) as record:
+            result = func(*args)
+            record["rows_out"] = int(len(result))
+        outputs[name] = result
+        if name in stages:
+            report[name] = {**_measures(record), "rows_in": record["rows_in"], "rows_out": record["rows_out"]}
+        return result
+
+    def isolation_zones():
+        lines = read_lines_shapely(mains[UNIQUE_ID].to_numpy(), main_geometries)
+        valve_xy = shapely.get_coordinates(_geometries(layers, "valves"))
+        return find_isolation_zones(lines, valve_xy)["main_zones"].rename(columns={"id": UNIQUE_ID})
+
+    def near():
+        roadway = layers["roadway"]
+        near_layers = {
+            "Buildings": _geometries(layers, "buildings"), "ROW": _geometries(layers, "row"),
+            "WaterAreas": _geometries(layers, "water_areas"), "WaterLines": _geometries(layers, "water_lines"),
+            "Railroad": _geometries(layers, "railroad"),
+        }
+        if tile_size:
+            classed = (roadway["geometry"].to_numpy(), roadway["Road"].to_numpy(), ROAD_COLUMNS)
+            near_df = tiled_near_distances(
+                np.arange(len(mains)), main_geometries, near_layers, classed_layer=classed, tile_size=tile_size,
+                max_workers=max_workers,
+            ).drop(columns="IN_FID")
+        else:
+            road_df = class_distances(main_geometries, roadway["geometry"].to_numpy(), roadway["Road"].to_numpy(), ROAD_COLUMNS)
+            near_df = near_distances(np.arange(len(mains)), main_geometries, near_layers).drop(columns="IN_FID")
+            near_df = pd.concat([road_df, near_df], axis=1)
+        near_df = pd.concat([mains.drop(columns="geometry").reset_index(drop=True), near_df], axis=1)
+        near_df["LENGTH"] = shapely.length(main_geometries).round(0)
+        # the distances stay float64 until they are scored, as in the near distances stage
+        return enforce_dtypes(near_df, near_results_dtypes(UNIQUE_ID, "MATERIAL", []))
+
+    def zone_join():
+        zones_df = outputs["isolation_zones"][[UNIQUE_ID, "zone"]].copy()
+        if tile_size:
+            lateral_main = tiled_lateral_mains(
+                _geometries(layers, "laterals"), main_geometries, tile_size=tile_size, max_workers=max_workers
+            )
+        else:
+            lateral_main = lateral_mains(_geometries(layers, "laterals"), main_geometries)
+        summary_df = laterals_per_zone(lateral_main, zones_df["zone"].to_numpy())
+        zones_df["affected_lats"] = zones_df["zone"].map(summary_df.set_index("zone")["FREQUENCY"])
+        return enforce_dtypes(zones_df, zone_dtypes(UNIQUE_ID))
+
+    def connections():
+        geometries = (_geometries(layers, "parcels"), _geometries(layers, "laterals"), main_geometries)
+        if tile_size:
+            index = tiled_connection_index(*geometries, tile_size=tile_size, max_workers=max_workers)
+        else:
+            index = build_connection_index(*geometries)
+        customers = {
+            "SchoolChildcare": _geometries(layers, "schools"), "Healthcare": _geometries(layers, "healthcare"),
+            "CriticalCustomers": _geometries(layers, "critical_customers"),
+        }
+        connections_df = critical_connections(mains[UNIQUE_ID].to_numpy(), index, customers)
+        return enforce_dtypes(connections_df.rename(columns={"main_id": UNIQUE_ID}), connection_dtypes(UNIQUE_ID, customers))
+
+    def lof():
+        service_life_df = pd.DataFrame({"Material": list(SERVICE_LIFE), "Service Life": list(SERVICE_LIFE.values())})
+        # install dates read from GeoJSON are text, the LOF stage parses them the same way
+        mains_df = mains.drop(columns="geometry").assign(PLACEDINSE=pd.to_datetime(mains["PLACEDINSE"], errors="coerce"))
+        lof_df = score_service_life(mains_df, service_life_df, "PLACEDINSE", "MATERIAL")
+        break_main = snap_breaks(shapely.get_coordinates(_geometries(layers, "breaks")), main_geometries)
+        history = build_break_history(mains[UNIQUE_ID].to_numpy(), break_main, layers["breaks"]["BREAKDATE"])
+        breaks_df = break_table(history, UNIQUE_ID)
+        lof_df = calculate_lof(pd.merge(lof_df, breaks_df, on=UNIQUE_ID, how="left"))
+        lof_df = enforce_dtypes(lof_df, lof_dtypes(UNIQUE_ID, "MATERIAL"))
+        write_result(lof_df, work_folder, "Final_LOF", sort_by=UNIQUE_ID)
+        return lof_df
+
+    def cof():
+        df = pd.merge(outputs["near_distances"], outputs["zone_join"], on=UNIQUE_ID, how="left")
+        df = pd.merge(df, outputs["critical_connections"], on=UNIQUE_ID, how="left")
+        df = update_zones_with_connection(df, CONNECTION_COLUMNS)
+        df = score_mains(df, "DIAMETER", "SchoolChildcare", "Healthcare", "CriticalCustomers")
+        df = calculate_final_scores(df, work_folder)
+        df = enforce_dtypes(df, cof_dtypes(UNIQUE_ID, "MATERIAL", NEAR_COLUMNS, CONNECTION_COLUMNS))
+        write_result(df, work_folder, "Final_COF", sort_by=UNIQUE_ID)
+        return df
+
+    def run():
+        stage("isolation_zones", len(mains), isolation_zones)
+        stage("near_distances", len(mains), near)
+        stage("zone_join", len(layers["laterals"]), zone_join)
+        stage("critical_connections", len(layers["parcels"]), connections)
+        stage("lof", len(mains) + len(layers["breaks"]), lof)
+        stage("cof_scoring", len(mains), cof)
+        stage("risk_merge", len(mains) * 2, risk_merge_stage, work_folder, UNIQUE_ID, [UNIQUE_ID, "COF", "LENGTH"],
+              [UNIQUE_ID, "LOF"])
+        stage("risk_matrix", len(outputs["risk_merge"]), risk_matrix_stage, outputs["risk_merge"], work_folder, "LENGTH")
+        if "heatmap" in stages:
+            with trace.span("heatmap", len(outputs["risk_matrix"])) as record:
+                heatmap_stage(outputs["risk_matrix"], "LENGTH")
+                record["rows_out"] = 1
+            report["heatmap"] = {**_measures(record), "rows_in": record["rows_in"], "rows_out": 1}
+
+    if trace is None:
+        with Trace("Benchmark", print_summary=False) as trace:
+            run()
+    else:
+        run()
+    return report
+
+
+def read_layers(folder: str) -> dict:
+    """
+    Reads every GeoJSON and GeoParquet layer file of a folder through GeometryIO, e.g. the files SyntheticNetwork
+    writes, so the stages run on local files without arcpy
+
+    :param folder: str: Folder with one file per layer, named like the layers of SyntheticNetwork.generate_network
+    :return: dict: Layer name to a DataFrame with the attributes and a geometry column of shapely geometries
+    """
+    layers = {}
+    for file_name in sorted(os.listdir(folder)):
+        name, extension = os.path.splitext(file_name)
+        if extension.lower() in GEOJSON_EXTENSIONS + GEOPARQUET_EXTENSIONS:
+            layers[name] = layer_frame(read_layer(os.path.join(folder, file_name)))
+    return layers
+
+
+def run_benchmark(
+    sizes=DEFAULT_SIZES, seed: int = 0, stages=STAGES, report_path: str = None, tile_size: float = None,
+    max_workers: int = DEFAULT_MAX_WORKERS, layers_folder: str = None,
+) -> dict:
+    """
+    Generates a synthetic system of every size and times and memory profiles each pipeline stage on it
+
+    :param sizes: list: Number of mains of every system
+    :param seed: int: Random seed of the synthetic systems
+    :param stages: list: Stages to report
+    :param report_path: str: Path to write the JSON report to
+    :param tile_size: float: Run the geometry stages in tiles of this side, in one pass when not given
+    :param max_workers: int: Tiles running at once
+    :param layers_folder: str: Folder of layer files to read with read_layers and profile instead of the sizes
+    :return: dict: Report with the machine, and the layer counts and stage measures of every size
+    """
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {
+            "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+            "memory_gb": round(psutil.virtual_memory().total / 2 ** 30, 1),
+            "numpy": np.__version__, "pandas": pd.__version__, "shapely": shapely.__version__,
+        },
+        "seed": seed,
+        "tile_size": tile_size,
+        "max_workers": max_workers if tile_size else None,
+        "runs": [],
+    }
+    for size in [None] if layers_folder else sizes:
+        # the trace keeps the spans inside the stages as well, e.g. the result store reads and writes
+        with Trace(f"Benchmark-{size or 'layers'}", print_summary=False) as trace:
+            with trace.span("read" if layers_folder else "generate", size) as generate:
+                layers = read_layers(layers_folder) if layers_folder else generate_network(size, seed)
+            with tempfile.TemporaryDirectory() as work_folder:
+                stage_report = run_stages(layers, work_folder, stages, trace, tile_size, max_workers)
+        report["runs"].append({
+            "mains": len(layers["mains"]),
+            "features": {name: len(df) for name, df in layers.items()},
+            "generate": _measures(generate),
+            "stages": stage_report,
+            "trace": trace.to_dict()["spans"],
+        })
+        print_summary(report["runs"][-1])
+        del layers
+    if report_path:
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+def print_summary(run: dict):
+    """
+    Prints the stage measures of one size as a table
+
+    :param run: dict: One entry of the runs in the report from run_benchmark
+    """
+    print(f"\n{run['mains']:,} mains")
+    print(f"{'stage':<22}{'wall s':>10}{'cpu s':>10}{'peak MB':>10}{'rows in':>12}{'rows out':>12}")
+    for name, measures in run["stages"].items():
+        print(f"{name:<22}{measures['wall_seconds']:>10.3f}{measures['cpu_seconds']:>10.3f}"
+              f"{measures['peak_rss_mb']:>10.1f}{measures['rows_in']:>12,}{measures['rows_out']:>12,}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic water systems")
+    parser.add_argument("sizes", type=int, nargs="*", default=DEFAULT_SIZES, help="Number of mains of every system")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the synthetic systems")
+    parser.add_argument("--stages", nargs="*", default=STAGES, choices=STAGES, help="Stages to report")
+    parser.add_argument("--report", default="benchmark.json", help="Path of the JSON report")
+    parser.add_argument("--tile-size", type=float, help="Run the geometry stages in tiles of this side in feet")
+    parser.add_argument("--workers", type=int, default=DEFAULT_MAX_WORKERS, help="Tiles running at once")
+    parser.add_argument("--layers", help="Profile the GeoJSON or GeoParquet layer files of this folder instead")
+    args = parser.parse_args(argv)
+    run_benchmark(args.sizes, args.seed, args.stages, args.report, args.tile_size, args.workers, args.layers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+import numpy as np
+import pandas as pd
+
+from BreakMatching import DEFAULT_BREAK_TOLERANCE, read_breaks_featureclass, score_breaks, snap_breaks
+from GeometryIO import geometries, read_layer
+
+# The break history is built once from the breaks layer: the breaks of every main sorted by date in one array, with the
+# offset of each main's first break. Every break is keyed by (main, date) so windowed counts for all mains are two
+# binary searches per main, and the LOF breaks score can be changed without reading or snapping the breaks again.
+
+# Windows in years the break history is summarized over
+DEFAULT_WINDOWS = (5, 10, 20)
+# Breaks this many years old weigh half as much in the recency weighted break rate
+DEFAULT_HALF_LIFE = 10
+DAYS_PER_YEAR = 365.25
+# Day numbers are stored shifted by this so every date is positive and undated breaks, stored as 0, sort first
+_DAY_SHIFT = 2 ** 31
+
+
+def _days(dates) -> np.ndarray:
+    # Shifted day number of every date, 0 for a missing date
+    days = np.asarray(pd.to_datetime(pd.Series(dates), errors="coerce").to_numpy().astype("datetime64[D]"))
+    shifted = days.astype(np.int64) + _DAY_SHIFT
+    shifted[np.isnat(days)] = 0
+    return shifted
+
+
+def _as_of_day(as_of=None) -> int:
+    return int(_days([as_of or pd.Timestamp.now().normalize()])[0])
+
+
+def build_break_history(main_ids, break_main: np.ndarray, break_dates=None) -> dict:
+    """
+    Builds the per main break history index
+
+    :param main_ids: array-like: Unique id of every main, in the order of the main geometries the breaks were snapped to
+    :param break_main: np.ndarray: Index of the main of every break from snap_breaks, -1 for none
+    :param break_dates: array-like: Date of every break, every break is undated when not given
+    :return: dict: ids (unique main ids), offsets (first break of every id, with the total at the end), days (shifted
+        day number of every break sorted by id then date) and keys (id code and day of every break in one sorted int64)
+    """
+    id_codes, ids = pd.factorize(pd.Series(main_ids, dtype=object))
+    break_main = np.asarray(break_main, dtype=np.int64)
+    days = _days(break_dates) if break_dates is not None else np.zeros(len(break_main), dtype=np.int64)
+    matched = break_main >= 0
+    codes = id_codes[break_main[matched]]
+    days = days[matched]
+    kept = codes >= 0
+    codes, days = codes[kept].astype(np.int64), days[kept]
+    keys = (codes << 32) | days
+    order = np.argsort(keys, kind="stable")
+    return {
+        "ids": np.asarray(ids, dtype=object),
+        "offsets": np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(ids)))]).astype(np.int64),
+        "days": days[order],
+        "keys": keys[order],
+    }
+
+
+def break_history_featureclasses(
+    water_main_fc: str, unique_id: str, breaks_fc: str, date_field: str = None,
+    tolerance: float = DEFAULT_BREAK_TOLERANCE,
+) -> dict:
+    """
+    Reads the mains and breaks once, snaps every break to its nearest main and builds the break history index
+
+    :param water_main_fc: str: Water main feature class or layer file
+    :param unique_id: str: Water main unique id field
+    :param breaks_fc: str: Breaks feature class or layer file
+    :param date_field: str: Break date field, every break is undated when not given
+    :param tolerance: float: Largest distance from a break to its main, in map units
+    :return: dict: Break history index, see build_break_history
+    """
+    mains = read_layer(water_main_fc, unique_id)
+    main_geometries = geometries(mains)
+    breaks_df = read_breaks_featureclass(breaks_fc, [date_field] if date_field else [])
+    break_main = snap_breaks(breaks_df[["x", "y"]].to_numpy(), main_geometries, tolerance)
+    unmatched = int((break_main < 0).sum())
+    if unmatched:
+        print(f"{unmatched} of {len(break_main)} breaks are farther than {tolerance} from every main")
+    dates = breaks_df[date_field] if date_field else None
+    return build_break_history(mains["ids"], break_main, dates)
+
+
+def window_counts(history: dict, years=None, as_of=None) -> np.ndarray:
+    """
+    Counts the breaks of every main in the last years before a date, a window takes in the breaks after its first day
+    up to and including the end date, undated breaks are only counted without a window
+
+    :param history: dict: Break history index from build_break_history
+    :param years: float or list: Length of the window in years, or of several windows, every break ever when not given
+    :param as_of: str or datetime: End of the windows, today when not given
+    :return: np.ndarray: Number of breaks of every main, one column per window when several are given
+    """
+    if years is None:
+        return np.diff(history["offsets"])
+    windows = np.atleast_1d(np.asarray(years, dtype=float))
+    end = _as_of_day(as_of)
+    codes = np.arange(len(history["ids"]), dtype=np.int64)[:, None] << 32
+    starts = end - np.round(windows * DAYS_PER_YEAR).astype(np.int64)
+    counts = (np.searchsorted(history["keys"], codes | end, side="right")
+              - np.searchsorted(history["keys"], codes | starts, side="right"))
+    return counts if np.ndim(years) else counts[:, 0]
+
+
+def breaks_outside_window(history: dict, years: float, as_of=None) -> tuple:
+    """
+    Counts the dated breaks left out of a window, before its start or after its end
+
+    :param history: dict: Break history index from build_break_history
+    :param years: float: Length of the window in years
+    :param as_of: str or datetime: End of the window, today when not given
+    :return: tuple: Number of dated breaks outside the window and of dated breaks
+    """
+    dated = int((history["days"] > 0).sum())
+    return dated - int(window_counts(history, years, as_of).sum()), dated
+
+
+def decay_rates(history: dict, half_life: float = DEFAULT_HALF_LIFE, as_of=None) -> np.ndarray:
+    """
+    Recency weighted break rate of every main, every dated break weighs half as much for every half life of age
+
+    The weights are divided by the total weight of a year round window, the half life over ln 2, so a main breaking at
+    a steady rate gets that rate in breaks per year. Undated breaks and breaks after the end date are left out.
+
+    :param history: dict: Break history index from build_break_history
+    :param half_life: float: Age in years at which a break weighs half
+    :param as_of: str or datetime: Date to take the age of the breaks at, today when not given
+    :return: np.ndarray: Weighted breaks per year of every main
+    """
+    end = _as_of_day(as_of)
+    days = history["days"]
+    codes = np.repeat(np.arange(len(history["ids"])), np.diff(history["offsets"]))
+    dated = (days > 0) & (days <= end)
+    ages = (end - days[dated]) / DAYS_PER_YEAR
+    weights = 0.5 ** (ages / half_life)
+    return np.bincount(codes[dated], weights=weights, minlength=len(history["ids"])) * np.log(2) / half_life
+
+
+def break_table(history: dict, unique_id: str, window: float = None, half_life: float = None, as_of=None) -> pd.DataFrame:
+    """
+    Counts and scores the breaks of every main that has breaks in the window
+
+    :param history: dict: Break history index from build_break_history
+    :param unique_id: str: Name of the unique id column
+    :param window: float: Only count the breaks of the last years, every break ever when not given
+    :param half_life: float: Add the recency weighted break rate with this half life as Break_Rate when given
+    :param as_of: str or datetime: End of the window, today when not given
+    :return: pd.DataFrame: unique_id, Breaks, Breaks_score and optionally Break_Rate columns
+    """
+    counts = window_counts(history, window, as_of)
+    has_breaks = counts > 0
+    breaks_df = pd.DataFrame({
+        unique_id: history["ids"][has_breaks],
+        "Breaks": counts[has_breaks],
+        "Breaks_score": score_breaks(counts[has_breaks]),
+    })
+    if half_life:
+        breaks_df["Break_Rate"] = decay_rates(history, half_life, as_of)[has_breaks]
+    return breaks_df
+
+
+def window_table(
+    history: dict, unique_id: str, windows=DEFAULT_WINDOWS, half_life: float = DEFAULT_HALF_LIFE, as_of=None
+) -> pd.DataFrame:
+    """
+    Summarizes the break history of every main with breaks over several windows at once, to compare them
+
+    :param history: dict: Break history index from build_break_history
+    :param unique_id: str: Name of the unique id column
+    :param windows: list: Window lengths in years
+    :param half_life: float: Half life of the recency weighted break rate
+    :param as_of: str or datetime: End of the windows, today when not given
+    :return: pd.DataFrame: unique_id, Breaks (every break ever), Breaks_{n}y for every window and Break_Rate columns
+    """
+    total = window_counts(history)
+    has_breaks = total > 0
+    counts = window_counts(history, list(windows), as_of)[has_breaks]
+    window_df = pd.DataFrame({unique_id: history["ids"][has_breaks], "Breaks": total[has_breaks]})
+    for column, window in enumerate(windows):
+        window_df[f"Breaks_{window:g}y"] = counts[:, column]
+    window_df["Break_Rate"] = decay_rates(history, half_life, as_of)[has_breaks]
+    return window_df
@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import shapely
+
+from GeometryIO import point_coordinates, read_layer
+
+# Breaks are often digitized a few feet off the main they were on, a break is snapped to the nearest main within this
+# distance, in the units of the coordinate system the layers are extracted in (feet in the default State Plane)
+DEFAULT_BREAK_TOLERANCE = 10
+# Breaks are queried against the main STR-tree in blocks of this many so decades of breaks stay in bounded memory
+BREAK_CHUNK_SIZE = 250000
+# Breaks score of a main by its number of breaks, mains with more breaks than listed get the last score
+BREAK_SCORES = [0, 8, 10]
+
+
+def snap_breaks(
+    break_xy: np.ndarray, main_geometries, tolerance: float = DEFAULT_BREAK_TOLERANCE, chunk_size: int = BREAK_CHUNK_SIZE
+) -> np.ndarray:
+    """
+    Snaps every break to the nearest main within the tolerance with bulk STR-tree queries
+
+    :param break_xy: np.ndarray: (x, y) of every break
+    :param main_geometries: array-like: Shapely geometry of every main
+    :param tolerance: float: Largest distance from a break to its main, in map units
+    :param chunk_size: int: Number of breaks per STR-tree query
+    :return: np.ndarray: Index of the main of every break, -1 when no main is within the tolerance
+    """
+    break_xy = np.asarray(break_xy, dtype=float).reshape(-1, 2)
+    break_main = np.full(len(break_xy), -1, dtype=np.int64)
+    if len(break_xy) == 0 or len(main_geometries) == 0:
+        return break_main
+    tree = shapely.STRtree(np.asarray(main_geometries, dtype=object))
+    for start in range(0, len(break_xy), chunk_size):
+        points = shapely.points(break_xy[start:start + chunk_size])
+        breaks, mains = tree.query_nearest(points, max_distance=tolerance, all_matches=False)
+        break_main[start + breaks] = mains
+    return break_main
+
+
+
+
+def score_breaks(counts: np.ndarray) -> np.ndarray:
+    """
+    Scores the number of breaks of every main, 8 for one break and 10 for two or more
+
+    :param counts: np.ndarray: Number of breaks of every main
+    :return: np.ndarray: Breaks score of every main, 0 for mains without breaks
+    """
+    scores = np.asarray(BREAK_SCORES)
+    return scores[np.minimum(np.asarray(counts, dtype=np.int64), len(scores) - 1)]
+
+
+
+
+def read_breaks_featureclass(breaks_fc: str, fields=()) -> pd.DataFrame:
+    """
+    Reads the location and attributes of every break once through GeometryIO
+
+    :param breaks_fc: str: Breaks feature class or layer file
+    :param fields: list: Attribute fields to read with the location
+    :return: pd.DataFrame: x, y and the attribute columns, breaks without a location are dropped
+    """
+    breaks = read_layer(breaks_fc)
+    breaks_df = breaks["attributes"][list(fields)].copy()
+    xy = point_coordinates(breaks)
+    breaks_df.insert(0, "x", xy[:, 0])
+    breaks_df.insert(1, "y", xy[:, 1])
+    return breaks_df
@@ -0,0 +1,263 @@
+import os
+import numpy as np
+import pandas as pd
+
+# Breakpoint tables for the COF factors
+# Each table is a list of (edge, closed) pairs in ascending order and a list of scores with one more entry than
+# there are edges. "left" means a value equal to the edge already belongs to the next interval, "right" means it
+# still belongs to the interval ending at the edge. Intervals the original scorers left undefined score NaN.
+DIAMETER_BREAKPOINTS = (
+    [(4, "left"), (8, "right"), (16, "right")],
+    [1, 4, 7, 10],
+)
+
+# Shared by the railroad and water body proximity factors
+PROXIMITY_BREAKPOINTS = (
+    [(0, "left"), (0, "right"), (10, "right"), (50, "right"), (100, "right")],
+    [np.nan, 10, 9, 7, 5, 0],
+)
+
+BUILDINGS_BREAKPOINTS = (
+    [(0, "left"), (5, "right"), (20, "right")],
+    [np.nan, 10, 5, 0],
+)
+
+AFFECTED_LATS_BREAKPOINTS = (
+    [(0, "left"), (0, "right"), (1, "left"), (10, "right"), (11, "left"), (30, "right"), (31, "left"), (50, "right")],
+    [np.nan, 0, np.nan, 1, np.nan, 5, np.nan, 8, 10],
+)
+
+# Scores for the critical customer connection status columns, anything else scores 0
+CONNECTION_SCORES = {"Connected": 10, "Zone": 8}
+
+# Default weights for each score
+COF_WEIGHTS = {
+    'DIAMETER_score': 0.1,
+    'Railroad_score': 0.1,
+    'Roadway_score': 0.15,
+    'Buildings_score': 0.1,
+    'affected_lats_score': 0.2,
+    'WaterBodies_score': 0.2,
+    'medical_score': 0.05,
+    'school_childcare_score': 0.05,
+    'critical_cust_score': 0.05
+}
+
+
+def update_zones_with_connection(df: pd.DataFrame, feature_classes) -> pd.DataFrame:
+    """
+    Marks every main that shares an isolation zone with a "Connected" main as "zone" for each critical customer column
+
+    :param df: pd.DataFrame: Water mains with a zone column and one connection column per critical customer layer
+    :param feature_classes: list: Critical customer feature classes, used to find the column names
+    :return: pd.DataFrame: The dataframe with the connection columns updated
+    """
+    # Get the base name of each feature class for use as the column names
+    columns = [os.path.basename(fc).split('.')[0] for fc in feature_classes]
+
+    # Code the zones once, mains without a zone get -1 and never pick up a zone label
+    zone_codes, zones = pd.factorize(df['zone'])
+    has_zone = zone_codes >= 0
+
+    # Count the connected mains in every zone for all columns in one pass
+    connected = (df[columns] == "Connected").to_numpy()
+    zone_connected = np.zeros((len(zones), len(columns)), dtype=np.int64)
+    np.add.at(zone_connected, zone_codes[has_zone], connected[has_zone])
+
+    # Update the empty column values for mains in a zone with a connected main
+    in_connected_zone = np.zeros(connected.shape, dtype=bool)
+    in_connected_zone[has_zone] = zone_connected[zone_codes[has_zone]] > 0
+    for j, column in enumerate(columns):
+        fill = df[column].isna().to_numpy() & in_connected_zone[:, j]
+        df[column] = df[column].astype(object).where(~fill, "zone")
+
+    return df
+
+
+def score_breakpoints(values, table) -> np.ndarray:
+    """
+    Scores a whole column against a breakpoint table
+
+    :param values: array-like: Numeric values to score
+    :param table: tuple: (edges, scores) breakpoint table
+    :return: np.ndarray: Score for every value, NaN where the value is missing or falls in an undefined interval
+    """
+    edges, scores = table
+    values = np.asarray(values, dtype=float)
+    left_edges = np.array([edge for edge, closed in edges if closed == "left"], dtype=float)
+    right_edges = np.array([edge for edge, closed in edges if closed == "right"], dtype=float)
+
+    # The interval index is the number of edges the value has passed
+    index = np.searchsorted(right_edges, values, side="left") + np.searchsorted(left_edges, values, side="right")
+    result = np.asarray(scores, dtype=float)[np.minimum(index, len(scores) - 1)]
+    result[np.isnan(values)] = np.nan
+    return result
+
+
+def _as_scores(result: np.ndarray) -> np.ndarray:
+    # Keep integer scores as integers so the output matches the per-row scorers
+    if np.isnan(result).any():
+        return result
+    return result.astype(np.int64)
+
+
+# Function to score the diameter of the water main
+def score_diameter(diameter) -> np.ndarray:
+    diameter = pd.Series(diameter)
+    numeric = pd.to_numeric(diameter, errors="coerce")
+    result = score_breakpoints(numeric, DIAMETER_BREAKPOINTS)
+    # Values that could not be converted to a number get the default score
+    result[(numeric.isna() & diameter.notna()).to_numpy()] = 0
+    return _as_scores(result)
+
+
+# Function to score the proximity to a railroad
+def score_railroad(railroad) -> np.ndarray:
+    return _as_scores(score_breakpoints(railroad, PROXIMITY_BREAKPOINTS))
+
+
+# Function to score the proximity to a water body using the closer of the water areas and water lines
+def score_waterbodies(water_areas, water_lines) -> np.ndarray:
+    water_areas = np.asarray(water_areas, dtype=float)
+    water_lines = np.asarray(water_lines, dtype=float)
+    # Take the water lines distance only when it is strictly closer, like min() did
+    waterbodies = np.where(water_lines < water_areas, water_lines, water_areas)
+    return _as_scores(score_breakpoints(waterbodies, PROXIMITY_BREAKPOINTS))
+
+
+# Function to score the proximity to a building
+def score_buildings(buildings) -> np.ndarray:
+    return _as_scores(score_breakpoints(buildings, BUILDINGS_BREAKPOINTS))
+
+
+# Function to score the number of affected laterals, zones without a lateral count score 0
+def score_affected_lats(affected_lats) -> np.ndarray:
+    affected_lats = np.nan_to_num(np.asarray(affected_lats, dtype=float), nan=0)
+    return _as_scores(score_breakpoints(affected_lats, AFFECTED_LATS_BREAKPOINTS))
+
+
+# Function to score a critical customer connection status column (schools, healthcare and critical customers)
+def score_connection(connection) -> np.ndarray:
+    # categorical status columns are mapped as plain values so the unmapped statuses can be filled
+    return pd.Series(connection).astype(object).map(CONNECTION_SCORES).fillna(0).to_numpy(dtype=np.int64)
+
+
+# function to score the type of road covering the water main
+def score_roadway(major_intersection, major_road, minor_intersection, minor_road, row) -> np.ndarray:
+    major_intersection = np.asarray(major_intersection, dtype=float)
+    major_road = np.asarray(major_road, dtype=float)
+    minor_intersection = np.asarray(minor_intersection, dtype=float)
+    minor_road = np.asarray(minor_road, dtype=float)
+    row = np.asarray(row, dtype=float)
+    # Conditions are checked in order, the first one that matches sets the score
+    conditions = [
+        major_intersection == 0,
+        major_road == 0,
+        minor_intersection == 0,
+        minor_road == 0,
+        (row == 0) & (major_road < minor_road),
+        (row == 0) & (major_road >= minor_road),
+    ]
+    return np.select(conditions, [10, 9, 7, 6, 3, 2], default=0)
+
+
+def score_mains(
+    df: pd.DataFrame, diameter_field: str, school_column: str, healthcare_column: str, critical_customer_column: str
+) -> pd.DataFrame:
+    """
+    Adds a score column for every COF factor that has its input columns in the dataframe
+
+    :param df: pd.DataFrame: Water mains with near distances, affected laterals and connection status columns
+    :param diameter_field: str: Name of the diameter field
+    :param school_column: str: Name of the school/childcare connection column
+    :param healthcare_column: str: Name of the healthcare connection column
+    :param critical_customer_column: str: Name of the critical customer connection column
+    :return: pd.DataFrame: The dataframe with the score columns added
+    """
+    if diameter_field in df.columns:
+        df['DIAMETER_score'] = score_diameter(df[diameter_field])
+
+    if 'Railroad' in df.columns:
+        df['Railroad_score'] = score_railroad(df['Railroad'])
+
+    if 'Buildings' in df.columns:
+        df['Buildings_score'] = score_buildings(df['Buildings'])
+
+    if 'WaterAreas' in df.columns and 'WaterLines' in df.columns:
+        df['WaterBodies_score'] = score_waterbodies(df['WaterAreas'], df['WaterLines'])
+
+    if 'affected_lats' in df.columns:
+        df['affected_lats_score'] = score_affected_lats(df['affected_lats'])
+
+    if school_column in df.columns:
+        df['school_childcare_score'] = score_connection(df[school_column])
+
+    if healthcare_column in df.columns:
+        df['medical_score'] = score_connection(df[healthcare_column])
+
+    if critical_customer_column in df.columns:
+        df['critical_cust_score'] = score_connection(df[critical_customer_column])
+
+    required_roadway_columns = {'Major_Intersection', 'Major_Road', 'Minor_Intersection', 'Minor_Road', 'ROW'}
+    if required_roadway_columns.issubset(df.columns):
+        df['Roadway_score'] = score_roadway(
+            df['Major_Intersection'], df['Major_Road'], df['Minor_Intersection'], df['Minor_Road'], df['ROW']
+        )
+
+    return df
+
+
+def normalize_weights(weights: dict, columns) -> dict:
+    """
+    Normalizes the weights of the score columns that are available so they sum to 1
+
+    :param weights: dict: Weight for each score column
+    :param columns: Columns available in the dataframe
+    :return: dict: Normalized weight for each available score column, in the order of weights
+    """
+    available_columns = [col for col in weights if col in columns]
+    total_weight = sum(weights[col] for col in available_columns)
+    return {col: weights[col] / total_weight for col in available_columns}
+
+
+def weighted_sum(score_matrix: np.ndarray, weight_vector: np.ndarray) -> np.ndarray:
+    """
+    Matrix-vector product of the per-main score matrix and the weight vector, or matrix product with a weight matrix
+
+    The product is accumulated one score column at a time, in weight order, so every main gets the same floating
+    point total the per-row sum produced and the ceiling lands on the same integer. A weight matrix has one column
+    per weight scenario, and every scenario gets the total its weight vector would get on its own.
+
+    :param score_matrix: np.ndarray: (mains x scores) matrix
+    :param weight_vector: np.ndarray: Weight for each score column, or (scores x scenarios) weight matrix
+    :return: np.ndarray: Weighted total for every main, (mains x scenarios) for a weight matrix
+    """
+    weight_vector = np.asarray(weight_vector, dtype=float)
+    total = np.zeros(score_matrix.shape[:1] + weight_vector.shape[1:])
+    for j in range(score_matrix.shape[1]):
+        scores = score_matrix[:, j].reshape((-1,) + (1,) * (weight_vector.ndim - 1))
+        total = total + scores * weight_vector[j]
+    return total
+
+
+def calculate_final_scores(df: pd.DataFrame, results_folder: str, weights: dict = COF_WEIGHTS) -> pd.DataFrame:
+    """
+    Calculates the weighted COF score for every main
+
+    :param df: pd.DataFrame: Water mains with score columns
+    :param results_folder: str: Folder to save the normalized weights to
+    :param weights: dict: Weight for each score column
+    :return: pd.DataFrame: The dataframe with the COF column added
+    """
+    normalized_weights = normalize_weights(weights, df.columns)
+
+    # Save normalized weights to a CSV file
+    normalized_weights_df = pd.DataFrame(list(normalized_weights.items()), columns=['Column', 'Normalized_Weight'])
+    normalized_weights_df.to_csv(os.path.join(results_folder, 'normalized_weights.csv'), index=False)
+
+    # Build the score matrix and scale the weighted total to a whole number out of 10
+    score_matrix = df[list(normalized_weights)].to_numpy(dtype=float)
+    weight_vector = np.array(list(normalized_weights.values()))
+    df['COF'] = _as_scores(np.ceil(weighted_sum(score_matrix, weight_vector)))
+
+    return df
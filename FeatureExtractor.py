@@ -0,0 +1,291 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+
+import numpy as np
+import requests
+
+# Pages are never larger than this even if the service allows it
+DEFAULT_PAGE_SIZE = 2000
+DEFAULT_MAX_WORKERS = 8
+RETRIES = 3
+
+
+def get_session(gis=None) -> requests.Session:
+    """
+    Gets one session to reuse for every request, authenticated by the GIS object from get_gis
+
+    :param gis: GIS: Signed in GIS object, an anonymous session is returned when not given
+    :return: requests.Session: Session to send the queries with
+    """
+    if gis is not None and getattr(gis, "session", None) is not None:
+        return gis.session
+    session = requests.Session()
+    if gis is not None and gis._con.token:
+        session.params = {"token": gis._con.token}
+    return session
+
+
+class BoundedSession:
+    """
+    Wraps a session so no more than a set number of its requests are in flight at once, across every thread and pool
+    that sends requests with it
+
+    :param session: requests.Session: Session to send the requests with
+    :param max_requests: int: Largest number of requests in flight at once
+    """
+
+    def __init__(self, session, max_requests: int = DEFAULT_MAX_WORKERS):
+        self.session = session
+        self.slots = threading.BoundedSemaphore(max_requests)
+
+    def post(self, *args, **kwargs):
+        with self.slots:
+            return self.session.post(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+def _request(session, url: str, params: dict) -> dict:
+    # Send a request to the REST endpoint, retrying failed requests with a short backoff
+    for attempt in range(RETRIES):
+        try:
+            response = session.post(url, data=params, timeout=120)
+            response.raise_for_status()
+            result = response.json()
+            if "error" in result:
+                raise RuntimeError(f"{url}: {result['error'].get('message', result['error'])}")
+            return result
+        except (requests.RequestException, ValueError):
+            if attempt == RETRIES - 1:
+                raise
+            time.sleep(2 ** attempt)
+
+
+def plan_layer(session, url: str, page_size: int = DEFAULT_PAGE_SIZE) -> dict:
+    """
+    Reads the layer description and object ids and splits the layer into OBJECTID range pages
+
+    :param session: requests.Session: Session to send the requests with
+    :param url: str: Feature service layer url
+    :param page_size: int: Largest number of features per page
+    :return: dict: Layer info, OBJECTID field name and (first, last) OBJECTID of every page
+    """
+    info = _request(session, url, {"f": "json"})
+    ids = _request(session, url + "/query", {"where": "1=1", "returnIdsOnly": "true", "f": "json"})
+    page_size = min(page_size, info.get("maxRecordCount") or page_size)
+    object_ids = np.sort(np.asarray(ids.get("objectIds") or [], dtype=np.int64))
+    starts = np.arange(0, len(object_ids), page_size)
+    ends = np.minimum(starts + page_size, len(object_ids)) - 1
+    return {
+        "info": info,
+        "oid_field": ids.get("objectIdFieldName") or info.get("objectIdField") or "OBJECTID",
+        "pages": list(zip(object_ids[starts].tolist(), object_ids[ends].tolist())),
+    }
+
+
+def fetch_page(session, url: str, oid_field: str, first: int, last: int, out_sr: int = None) -> list:
+    """
+    Queries one OBJECTID range page of a layer
+
+    :param session: requests.Session: Session to send the request with
+    :param url: str: Feature service layer url
+    :param oid_field: str: OBJECTID field name
+    :param first: int: First OBJECTID of the page
+    :param last: int: Last OBJECTID of the page
+    :param out_sr: int: WKID to project the geometry to, the layer's own spatial reference when not given
+    :return: list: Esri JSON features of the page
+    """
+    params = {
+        "where": f"{oid_field} >= {first} AND {oid_field} <= {last}",
+        "outFields": "*",
+        "returnGeometry": "true",
+        "f": "json",
+    }
+    if out_sr:
+        params["outSR"] = out_sr
+    return _request(session, url + "/query", params).get("features", [])
+
+
+def fetch_ids(session, url: str, object_ids, out_sr: int = None) -> list:
+    """
+    Queries the features with the given OBJECTIDs
+
+    :param session: requests.Session: Session to send the request with
+    :param url: str: Feature service layer url
+    :param object_ids: list: OBJECTIDs to fetch, no more than the layer's maxRecordCount
+    :param out_sr: int: WKID to project the geometry to, the layer's own spatial reference when not given
+    :return: list: Esri JSON features
+    """
+    params = {
+        "objectIds": ",".join(str(object_id) for object_id in object_ids),
+        "outFields": "*",
+        "returnGeometry": "true",
+        "f": "json",
+    }
+    if out_sr:
+        params["outSR"] = out_sr
+    return _request(session, url + "/query", params).get("features", [])
+
+
+def _signed_area(ring) -> float:
+    ring = np.asarray(ring, dtype=float)
+    x, y = ring[:, 0], ring[:, 1]
+    return float(np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y)) / 2
+
+
+def esri_to_geojson(geometry: dict):
+    """
+    Converts an Esri JSON geometry to a GeoJSON geometry
+
+    :param geometry: dict: Esri JSON point, multipoint, polyline or polygon
+    :return: dict: GeoJSON geometry, None for an empty geometry
+    """
+    if not geometry:
+        return None
+    if "x" in geometry:
+        return None if geometry["x"] is None else {"type": "Point", "coordinates": [geometry["x"], geometry["y"]]}
+    if "points" in geometry:
+        return {"type": "MultiPoint", "coordinates": geometry["points"]}
+    if "paths" in geometry:
+        return {"type": "MultiLineString", "coordinates": geometry["paths"]}
+    # Esri exterior rings run clockwise and holes counterclockwise, holes follow the exterior ring they are in
+    polygons = []
+    for ring in geometry.get("rings", []):
+        if _signed_area(ring) < 0 or not polygons:
+            polygons.append([ring])
+        else:
+            polygons[-1].append(ring)
+    return {"type": "MultiPolygon", "coordinates": polygons}
+
+
+class _LayerWriter:
+    # Streams the pages of one layer into a temporary file in page order as they arrive, the layer file is only
+    # replaced once every page is written
+
+    def __init__(self, path: str, plan: dict, out_sr: int, output_format: str):
+        self.path = path
+        self.temp_path = path + ".tmp"
+        self.output_format = output_format
+        self.pending = {}
+        self.next_page = 0
+        self.count = 0
+        self.file = open(self.temp_path, "w")
+        info = plan["info"]
+        if output_format == "geojson":
+            header = {"type": "FeatureCollection"}
+        else:
+            spatial_reference = {"wkid": out_sr} if out_sr else info.get("extent", {}).get("spatialReference")
+            header = {
+                "objectIdFieldName": plan["oid_field"],
+                "geometryType": info.get("geometryType"),
+                "spatialReference": spatial_reference,
+                "fields": info.get("fields", []),
+            }
+        self.file.write(json.dumps(header)[:-1] + ', "features": [')
+
+    def add(self, page: int, features: list):
+        # Hold pages that arrive early until every page before them is written
+        self.pending[page] = features
+        while self.next_page in self.pending:
+            for feature in self.pending.pop(self.next_page):
+                if self.output_format == "geojson":
+                    feature = {
+                        "type": "Feature",
+                        "properties": feature.get("attributes", {}),
+                        "geometry": esri_to_geojson(feature.get("geometry")),
+                    }
+                self.file.write((", " if self.count else "") + json.dumps(feature))
+                self.count += 1
+            self.next_page += 1
+
+    def finish(self):
+        self.file.write("]}")
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+
+    def discard(self):
+        # A layer missing pages is never written, the layer file from before is left as it was
+        self.file.close()
+        os.remove(self.temp_path)
+
+
+def extract_layers(
+    feature_services,
+    output_folder: str,
+    session,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    out_sr: int = None,
+    output_format: str = "esrijson",
+    pool: ThreadPoolExecutor = None,
+) -> dict:
+    """
+    Downloads feature service layers to local files, paging each layer by OBJECTID ranges and fetching the pages of
+    every layer concurrently with a bounded thread pool. The files are only written once every page of every layer is,
+    a failed download leaves the files from before as they were
+
+    :param feature_services: list: (name, url) of every layer
+    :param output_folder: str: Folder to write the layer files to
+    :param session: requests.Session: Session from get_session to send every request with
+    :param max_workers: int: Largest number of requests in flight at once
+    :param page_size: int: Largest number of features per page
+    :param out_sr: int: WKID to project the geometry to, each layer's own spatial reference when not given
+    :param output_format: str: "esrijson" for Esri JSON feature sets (JSONToFeatures) or "geojson"
+    :param pool: ThreadPoolExecutor: Pool to send the requests on, shared with other downloads, a pool of max_workers
+        is made when not given
+    :return: dict: Layer name to the path of its file
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    extension = ".geojson" if output_format == "geojson" else ".json"
+    paths = {}
+    with (ThreadPoolExecutor(max_workers=max_workers) if pool is None else nullcontext(pool)) as pool:
+        # Plan every layer at once, then queue all pages of all layers on the same pool
+        plan_futures = {name: pool.submit(plan_layer, session, url, page_size) for name, url in feature_services}
+        urls = dict(feature_services)
+        writers = {}
+        page_futures = {}
+        try:
+            for name, future in plan_futures.items():
+                plan = future.result()
+                paths[name] = os.path.join(output_folder, name + extension)
+                writers[name] = _LayerWriter(paths[name], plan, out_sr, output_format)
+                for page, (first, last) in enumerate(plan["pages"]):
+                    page_future = pool.submit(fetch_page, session, urls[name], plan["oid_field"], first, last, out_sr)
+                    page_futures[page_future] = (name, page)
+
+            for future in as_completed(page_futures):
+                name, page = page_futures[future]
+                writers[name].add(page, future.result())
+        except BaseException:
+            # the pages not sent yet are dropped and no layer file is written
+            for future in [*plan_futures.values(), *page_futures]:
+                future.cancel()
+            for writer in writers.values():
+                writer.discard()
+            raise
+        for writer in writers.values():
+            writer.finish()
+    return paths
+
+
+def extract_to_workspace(feature_services, output_folder: str, session, out_sr: int = None, **kwargs):
+    """
+    Downloads feature service layers with extract_layers and loads each one into the arcpy workspace
+
+    :param feature_services: list: (name, url) of every layer, the name is used for the feature class
+    :param output_folder: str: Folder to write the layer files to
+    :param session: requests.Session: Session from get_session to send every request with
+    :param out_sr: int: WKID to project the geometry to
+    :return: dict: Layer name to the path of its file
+    """
+    import arcpy
+
+    paths = extract_layers(feature_services, output_folder, session, out_sr=out_sr, **kwargs)
+    for name, path in paths.items():
+        arcpy.conversion.JSONToFeatures(path, name)
+    return paths
@@ -1,17 +1,43 @@
+import os
 import arcpy
+import pandas as pd
+from Instrumentation import Trace, call, span, tool
+from GeometryIO import point_coordinates, read_layer
+from IsolationZoneEngine import (
+    find_isolation_zones, update_isolation_zones, read_lines_featureclass, write_zones_featureclass,
+    update_zones_featureclass, line_geometries, valve_criticality, zone_lateral_counts
+)
+from ResultStore import read_result
+from ServiceConnections import lateral_mains
+from ShutdownIndex import save_shutdown_index, shutdown_index_from_zones
 
 # Set the workspace - change this to your actual workspace
 arcpy.env.workspace = r"Place Feature Database Path Here"
 trace_network = r"Place Trace Network Path Here"
 water_mains_fc = "Place Water Main Layer Name Here"
 water_valves_fc = "Place Water Valve Layer Name Here"
+water_laterals_fc = "Place Water Lateral Layer Name Here"
+UniqueID = "FACILITYID"
+#Valve id field, the valves a crew has to close are listed by it
+ValveID = "FACILITYID"
+#Table of the zones each main is in, used to update the zones after edits without rerunning the whole network
+main_zones_csv = r"Place Main Zones CSV Path Here"
+#Table of the zones every valve would merge if it failed to close, written by criticality()
+valve_criticality_csv = r"Place Valve Criticality CSV Path Here"
+#Folder the shutdown plan index of every main is written to by shutdown_index(), look plans up with ShutdownIndex.py
+shutdown_index_folder = r"Place Shutdown Index Folder Here"
+#Results folder of the COF pipeline and its critical customer columns, used to flag the zones with critical customers
+cof_results_folder = r"Place COF Results Folder Here"
+critical_columns = ["CriticalCustomers", "SchoolChildcare", "Healthcare"]
+#Folder the JSON trace of the time, memory and row counts of every step of a run is written to
+trace_folder = os.path.join(os.path.dirname(main_zones_csv), "Traces")
 
 #This function will create individual in memory points in the center of each of the features
 #Inputs: The feature line (An individual feature), The point name or objectid for the point
 #Returns: The given point feature for the line
 def create_in_memory_point(input_line_layer, point_name):
     #Generate a point at the center of the input line layer
-    in_memory_point = arcpy.management.FeatureToPoint(input_line_layer, f"in_memory/{point_name}", "INSIDE")
+    in_memory_point = tool(arcpy.management.FeatureToPoint, input_line_layer, f"in_memory/{point_name}", "INSIDE", count=False)
     return in_memory_point
 
 #This function will run the trace function for the program for the given input parameters
@@ -19,7 +45,9 @@ def create_in_memory_point(input_line_layer, point_name):
 #Returns a trace feature layer that stores the geometry for the traced item
 def perform_trace(start_point_feature, barrier_layer):
     #Will generate a trace line that is multi-point.
-    arcpy.tn.Trace(
+    tool(
+        arcpy.tn.Trace,
+        count=False,
         in_trace_network=trace_network,
         trace_type="CONNECTED",
         starting_points=start_point_feature,
@@ -47,24 +75,31 @@ def perform_trace(start_point_feature, barrier_layer):
         out_json_file=None
     )
 
-def main():
+#This function finds the isolation zones by running one trace on the trace network per untraced main centroid
+def trace_isolation_zones():
     #Creates the spatial reference of a layer because the created layer require that information
     spatial_ref = arcpy.Describe(water_mains_fc).spatialReference
     #This will create an Isolation Zone Layer and will store all of the data into this layer once the program ends
     iso_zone_fc = "IsoZone"
-    arcpy.CreateFeatureclass_management(arcpy.env.workspace, iso_zone_fc, "POLYLINE", spatial_reference=spatial_ref)
+    tool(
+        arcpy.CreateFeatureclass_management, arcpy.env.workspace, iso_zone_fc, "POLYLINE", spatial_reference=spatial_ref,
+        count=False
+    )
     arcpy.env.overwriteOutput = True
 
     # add a text field called zone to the iso zone feature class
-    arcpy.AddField_management(iso_zone_fc, "zone", "TEXT")
+    tool(arcpy.AddField_management, iso_zone_fc, "zone", "TEXT", count=False)
     #Will create a centroid layer that will have the center of each of the lines such that we can start traces
-    centroids = arcpy.FeatureVerticesToPoints_management(water_mains_fc, "Water_Centroids","MID")
+    centroids = tool(
+        arcpy.FeatureVerticesToPoints_management, in_features=water_mains_fc, out_feature_class="Water_Centroids",
+        point_location="MID"
+    )
 
     #Creates a storage layer so that we can only test points that are un-used
     UsedPoints = []
     count = 0
     #Will run through every point in the centroid layer that was created
-    with arcpy.da.SearchCursor(centroids, ["OID@", "SHAPE@"]) as centroid:
+    with span("trace centroids") as record, arcpy.da.SearchCursor(centroids, ["OID@", "SHAPE@"]) as centroid:
         for row in centroid:
             #Will check to see if the point had been checked already
             if row[0] not in UsedPoints:
@@ -72,15 +107,111 @@ def main():
                 #Will preform a trace on the point
                 perform_trace(row[1], water_valves_fc)
                 #Will place the feature in the feature storage
-                arcpy.Append_management("Trace_Lines", iso_zone_fc, "NO_TEST")\
+                tool(arcpy.Append_management, "Trace_Lines", iso_zone_fc, "NO_TEST", count=False)
                 #Will identify all points that are on the trace
-                Storage_Values = arcpy.management.SelectLayerByLocation("Water_Centroids", "INTERSECT", "Trace_Lines", 0, "NEW_SELECTION")
+                Storage_Values = tool(arcpy.management.SelectLayerByLocation, "Water_Centroids", "INTERSECT", "Trace_Lines", 0, "NEW_SELECTION", count=False)
                 #Will place all points in the used points list to ensure that none of them are checked again
                 with arcpy.da.SearchCursor(Storage_Values, ["OID@", "SHAPE@"]) as removePoint:
                     for row in removePoint:
                         UsedPoints.append(row[0])
-    arcpy.Delete_management("memory")
+        record["rows_out"] = count
+    tool(arcpy.Delete_management, "memory", count=False)
     print(count)
 
+#This function reads the water mains and the valve locations and ids
+#Returns: The water main lines, the (x, y) of every valve and the id of every valve
+def read_network():
+    with span("read_lines_featureclass") as record:
+        lines = read_lines_featureclass(water_mains_fc, UniqueID)
+        record["rows_out"] = len(lines["ids"])
+    with span("read_valves") as record:
+        valves = read_layer(water_valves_fc, ValveID)
+        record["rows_out"] = len(valves["ids"])
+    return lines, point_coordinates(valves), valves["ids"].astype(str)
+
+#This function finds the isolation zones in process from the main and valve geometry, without a trace network
+#Input: Whether to fall back to the per-centroid trace on the trace network
+def main(use_trace_network=False):
+    with Trace("IsolationZones", trace_folder):
+        if use_trace_network:
+            trace_isolation_zones()
+            return
+        #Creates the spatial reference of a layer because the created layer require that information
+        spatial_ref = arcpy.Describe(water_mains_fc).spatialReference
+        arcpy.env.overwriteOutput = True
+        #Reads the mains and valves once and labels every zone in one pass with the valves as barriers
+        lines, valve_xy, _ = read_network()
+        with span("find_isolation_zones", len(lines["ids"])) as record:
+            result = find_isolation_zones(lines, valve_xy)
+            record["rows_out"] = len(result["zones"])
+        #Writes the Isolation Zone Layer with the zone field filled in and the zones of each main
+        with span("write_zones_featureclass", len(result["zones"])):
+            write_zones_featureclass(arcpy.env.workspace, "IsoZone", result["zones"], spatial_ref)
+        call("to_csv", result["main_zones"].to_csv, main_zones_csv, index=False)
+        print(len(result["zones"]))
+
+#This function updates only the isolation zones touched by edits to the network since the last run
+#Input: The unique ids of the edited mains (added and deleted mains are found automatically), The old and new
+#locations of every added, moved or removed valve as (x, y) pairs
+def update(changed_mains, changed_valve_xy):
+    with Trace("IsolationZonesUpdate", trace_folder):
+        spatial_ref = arcpy.Describe(water_mains_fc).spatialReference
+        previous_zones = call("read_csv", pd.read_csv, main_zones_csv, dtype={"id": str})
+        lines, valve_xy, _ = read_network()
+        lines["ids"] = lines["ids"].astype(str)
+        with span("update_isolation_zones", len(lines["ids"])) as record:
+            result = update_isolation_zones(
+                lines, valve_xy, previous_zones, [str(main) for main in changed_mains], changed_valve_xy
+            )
+            record["rows_out"] = len(result["zones"])
+        #Replaces the touched zones in the Isolation Zone Layer and saves the zones of each main for the next update
+        with span("update_zones_featureclass", len(result["zones"])):
+            update_zones_featureclass("IsoZone", result["removed"], result["zones"], spatial_ref)
+        call("to_csv", result["main_zones"].to_csv, main_zones_csv, index=False)
+        print(len(result["zones"]))
+
+#This function counts the laterals in every zone through their nearest main
+#Input: The water main lines, The isolation zones found from them
+#Returns: The number of laterals in every zone number
+def read_zone_laterals(lines, result):
+    with span("zone_lateral_counts") as record:
+        laterals = read_lines_featureclass(water_laterals_fc)
+        lateral_main = lateral_mains(line_geometries(laterals), line_geometries(lines))
+        record["rows_in"] = len(lateral_main)
+        return zone_lateral_counts(result["network"], result["seg_zone"], lateral_main)
+
+#This function finds what every valve would add to a shutdown if it failed to close, without rerunning the zones per valve
+#The zones are labeled once and every valve merges the zones on its sides in the zone adjacency graph
+def criticality():
+    with Trace("ValveCriticality", trace_folder):
+        lines, valve_xy, _ = read_network()
+        with span("find_isolation_zones", len(lines["ids"])) as record:
+            result = find_isolation_zones(lines, valve_xy)
+            record["rows_out"] = len(result["zones"])
+        zone_laterals = read_zone_laterals(lines, result)
+        criticality_df = call(
+            "valve_criticality", valve_criticality, result["network"], result["seg_zone"], valve_xy, zone_laterals
+        )
+        call("to_csv", criticality_df.to_csv, valve_criticality_csv, index=False)
+        print(criticality_df.sort_values("extra_length", ascending=False).head(10).to_string(index=False))
+
+#This function precomputes the shutdown plan of every main: its zone, the ids of the valves to close, the laterals in
+#the zone and the critical customer categories in it, saved as memory-mappable arrays for ShutdownIndex.py lookups
+def shutdown_index():
+    with Trace("ShutdownIndex", trace_folder):
+        lines, valve_xy, valve_ids = read_network()
+        lines["ids"] = lines["ids"].astype(str)
+        with span("find_isolation_zones", len(lines["ids"])) as record:
+            result = find_isolation_zones(lines, valve_xy)
+            record["rows_out"] = len(result["zones"])
+        zone_laterals = read_zone_laterals(lines, result)
+        connections_df = read_result(cof_results_folder, "Final_COF", [UniqueID] + critical_columns)
+        index = call(
+            "shutdown_index_from_zones", shutdown_index_from_zones,
+            result, valve_xy, zone_laterals, connections_df, UniqueID, critical_columns, valve_ids
+        )
+        save_shutdown_index(index, shutdown_index_folder)
+        print(len(index["ids"]))
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,437 @@
+import json
+import os
+from itertools import chain
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from Instrumentation import span
+
+# A geometry layer is read once into the GeoArrow layout: every vertex of the layer in one contiguous (n x 2) float64
+# coordinate array, with int64 offset arrays from each level of nesting into the next (features to parts, parts to
+# rings, rings to vertices), the attributes of every feature in one DataFrame, and no per feature geometry objects.
+# The engines get views of these arrays: the vertices of the points, the line layer of the isolation zone engine, or the
+# shapely geometries of the layer, built from the arrays once and kept with the layer. Layers are read from feature
+# classes with arcpy, or from local Esri JSON (the layer cache files), GeoJSON or GeoParquet files without it. A
+# GeometryCache keeps every layer read during a run so each layer is only read once however many stages use it.
+# A layer mixing geometry families, e.g. road lines and intersection points, has no GeoArrow layout of its own. It is
+# kept as a GEOMETRYCOLLECTION layer of its shapely geometries with the vertices of every feature as its arrays.
+# Features without a geometry have no place in the arrays, their attributes are only kept in all_attributes, the
+# attributes of every feature of the source, for the tables that list every feature like the water main attributes.
+
+# File extensions read without arcpy, anything else is read as a feature class
+ESRI_JSON_EXTENSIONS = (".json",)
+GEOJSON_EXTENSIONS = (".geojson",)
+GEOPARQUET_EXTENSIONS = (".parquet", ".geoparquet")
+
+# Nesting levels below the feature of each geometry family, with every feature stored as the multi part type
+_DEPTHS = {"point": 1, "linestring": 2, "polygon": 3}
+_MULTI = {
+    "point": shapely.GeometryType.MULTIPOINT,
+    "linestring": shapely.GeometryType.MULTILINESTRING,
+    "polygon": shapely.GeometryType.MULTIPOLYGON,
+}
+_SINGLE = {
+    shapely.GeometryType.MULTIPOINT: shapely.GeometryType.POINT,
+    shapely.GeometryType.MULTILINESTRING: shapely.GeometryType.LINESTRING,
+    shapely.GeometryType.MULTIPOLYGON: shapely.GeometryType.POLYGON,
+}
+# Esri JSON and GeoJSON geometry type to geometry family
+_ESRI_FAMILIES = {
+    "esriGeometryPoint": "point", "esriGeometryMultipoint": "point", "esriGeometryPolyline": "linestring",
+    "esriGeometryPolygon": "polygon",
+}
+_GEOJSON_FAMILIES = {
+    "Point": "point", "MultiPoint": "point", "LineString": "linestring", "MultiLineString": "linestring",
+    "Polygon": "polygon", "MultiPolygon": "polygon",
+}
+
+_active = []
+
+
+def _layer(
+    geometry_type, coords: np.ndarray, offsets, attributes: pd.DataFrame, id_field: str = None,
+    all_attributes: pd.DataFrame = None,
+) -> dict:
+    # Layer of the arrays, a multi part layer of single part features is stored as the single part type
+    offsets = tuple(np.asarray(offset, dtype=np.int64) for offset in offsets)
+    if geometry_type in _SINGLE and len(offsets[-1]) and (np.diff(offsets[-1]) == 1).all():
+        geometry_type, offsets = _SINGLE[geometry_type], offsets[:-1]
+    attributes = attributes.reset_index(drop=True)
+    return {
+        "geometry_type": shapely.GeometryType(geometry_type),
+        "coords": np.ascontiguousarray(coords, dtype=float).reshape(-1, 2),
+        "offsets": offsets,
+        "attributes": attributes,
+        "all_attributes": attributes if all_attributes is None else all_attributes.reset_index(drop=True),
+        "id_field": id_field,
+        # views of the arrays, built once when first asked for and shared by every copy of the layer
+        "views": {},
+    }
+
+
+def _flatten(nested: list, depth: int):
+    # Coordinates and offsets of nested coordinate lists, offsets from the innermost level out like shapely
+    offsets = []
+    level = nested
+    for _ in range(depth):
+        offsets.append(np.concatenate([[0], np.cumsum([len(item) for item in level], dtype=np.int64)]))
+        level = list(chain.from_iterable(level))
+    try:
+        coords = np.asarray(level, dtype=float)
+    except ValueError:
+        # vertices with and without z or m
+        coords = np.asarray([vertex[:2] for vertex in level], dtype=float)
+    coords = coords[:, :2] if coords.ndim == 2 else coords.reshape(-1, 2)
+    return coords, tuple(reversed(offsets))
+
+
+def _polygon_offsets(ring_offsets: np.ndarray, feature_rings: np.ndarray, coords: np.ndarray) -> tuple:
+    # Groups the rings of every feature into polygons, each clockwise ring (an Esri exterior ring) and the first ring of
+    # every feature starts a polygon and the rings after it are its holes
+    x, y = coords[:, 0], coords[:, 1]
+    cross = np.concatenate([[0], np.cumsum(x[:-1] * y[1:] - x[1:] * y[:-1])]) if len(coords) else np.zeros(1)
+    ends = np.maximum(ring_offsets[1:] - 1, ring_offsets[:-1])
+    area = cross[ends] - cross[ring_offsets[:-1]]
+    starts = area < 0
+    starts[feature_rings[:-1][np.diff(feature_rings) > 0]] = True
+    polygon_rings = np.concatenate([np.flatnonzero(starts), [len(starts)]])
+    feature_polygons = np.concatenate([[0], np.cumsum(starts)])[feature_rings]
+    return ring_offsets, polygon_rings, feature_polygons
+
+
+def from_geometries(geometries, attributes: pd.DataFrame = None, id_field: str = None) -> dict:
+    """
+    Packs shapely geometries into a layer, features without a geometry are only kept in all_attributes
+
+    :param geometries: array-like: Shapely geometries
+    :param attributes: pd.DataFrame: Attributes of every geometry
+    :param id_field: str: Attribute with the feature id, the feature position is used when not given
+    :return: dict: Layer with geometry_type, coords, offsets and attributes
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    attributes = pd.DataFrame(index=range(len(geometries))) if attributes is None else attributes.reset_index(drop=True)
+    kept = ~(shapely.is_missing(geometries) | shapely.is_empty(geometries))
+    try:
+        geometry_type, coords, offsets = shapely.to_ragged_array(geometries[kept], include_z=False)
+    except ValueError:
+        # several geometry families
+        coords, index = shapely.get_coordinates(geometries[kept], return_index=True)
+        geometry_type = shapely.GeometryType.GEOMETRYCOLLECTION
+        offsets = (np.concatenate([[0], np.cumsum(np.bincount(index, minlength=kept.sum()))]),)
+    layer = _layer(geometry_type, coords, offsets, attributes[kept], id_field, attributes)
+    layer["views"]["geometries"] = geometries[kept]
+    return layer
+
+
+def _from_nested(
+    family: str, nested: list, attributes: pd.DataFrame, kept: np.ndarray, id_field: str = None, rings: bool = False
+) -> dict:
+    # Layer of the multi part coordinate lists of every feature with a geometry, Esri rings are grouped into polygons
+    # by orientation
+    if family == "polygon" and rings:
+        coords, (ring_offsets, feature_rings) = _flatten(nested, 2)
+        offsets = _polygon_offsets(ring_offsets, feature_rings, coords)
+    else:
+        coords, offsets = _flatten(nested, _DEPTHS[family])
+    return _layer(_MULTI[family], coords, offsets, attributes[kept], id_field, attributes)
+
+
+def read_esrijson(path: str) -> dict:
+    """
+    Reads an Esri JSON feature set, e.g. a layer cache file, into a layer
+
+    :param path: str: Path to the Esri JSON file
+    :return: dict: Layer, the OBJECTID is the feature id
+    """
+    with open(path, "r") as file:
+        collection = json.load(file)
+
+    family = _ESRI_FAMILIES[collection["geometryType"]]
+    records, nested, kept = [], [], []
+    for feature in collection["features"]:
+        records.append(feature["attributes"])
+        geometry = feature.get("geometry") or {}
+        if family == "point":
+            parts = geometry.get("points") or ([[geometry["x"], geometry["y"]]] if geometry.get("x") is not None else [])
+        else:
+            parts = geometry.get("paths" if family == "linestring" else "rings") or []
+        has_geometry = bool(parts) and not (family == "point" and parts[0][0] in (None, "NaN"))
+        kept.append(has_geometry)
+        if has_geometry:
+            nested.append(parts)
+    fields = collection.get("fields", [])
+    attributes = pd.DataFrame(records, index=range(len(records)), columns=[field["name"] for field in fields] or None)
+    for field in fields:
+        # dates are milliseconds since the epoch
+        if field["type"] == "esriFieldTypeDate":
+            attributes[field["name"]] = pd.to_datetime(attributes[field["name"]], unit="ms", errors="coerce")
+    oid_field = collection.get("objectIdFieldName") or next(
+        (field["name"] for field in fields if field["type"] == "esriFieldTypeOID"), None
+    )
+    return _from_nested(family, nested, attributes, np.asarray(kept, dtype=bool), oid_field, rings=True)
+
+
+def read_geojson(path: str) -> dict:
+    """
+    Reads a GeoJSON feature collection into a layer
+
+    :param path: str: Path to the GeoJSON file
+    :return: dict: Layer, the feature position is the feature id
+    """
+    with open(path, "r") as file:
+        collection = json.load(file)
+
+    features = collection["features"]
+    records = [feature.get("properties") or {} for feature in features]
+    attributes = pd.DataFrame(records, index=range(len(records)))
+    kept = np.array([bool((feature.get("geometry") or {}).get("coordinates")) for feature in features], dtype=bool)
+    families, nested = set(), []
+    for feature in (feature for feature, has_geometry in zip(features, kept) if has_geometry):
+        geometry = feature["geometry"]
+        families.add(_GEOJSON_FAMILIES[geometry["type"]])
+        coordinates = geometry["coordinates"]
+        nested.append(coordinates if geometry["type"].startswith("Multi") else [coordinates])
+    if len(families) > 1:
+        geometries = np.full(len(features), None, dtype=object)
+        geometries[kept] = shapely.from_geojson(
+            [json.dumps(feature["geometry"]) for feature, has_geometry in zip(features, kept) if has_geometry]
+        )
+        return from_geometries(geometries, attributes)
+    return _from_nested(families.pop() if families else "point", nested, attributes, kept)
+
+
+def _arrow_geometry(column, encoding: str) -> tuple:
+    # Coordinates and offsets of a GeoArrow native geometry column, the interleaved coordinates are not copied
+    import pyarrow as pa
+
+    array = column.combine_chunks() if isinstance(column, pa.ChunkedArray) else column
+    offsets = []
+    while pa.types.is_list(array.type) or pa.types.is_large_list(array.type):
+        offset = array.offsets.to_numpy().astype(np.int64)
+        array = array.values.slice(offset[0], offset[-1] - offset[0])
+        offsets.append(offset - offset[0])
+    if pa.types.is_struct(array.type):
+        coords = np.column_stack([array.field("x").to_numpy(), array.field("y").to_numpy()])
+    else:
+        coords = array.values.to_numpy().reshape(len(array), -1)[:, :2]
+    return shapely.GeometryType[encoding.upper()], coords, tuple(reversed(offsets))
+
+
+def read_geoparquet(path: str) -> dict:
+    """
+    Reads a GeoParquet file with WKB or GeoArrow native geometry into a layer
+
+    :param path: str: Path to the GeoParquet file
+    :return: dict: Layer, the feature position is the feature id
+    """
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(path)
+    metadata = json.loads((table.schema.metadata or {}).get(b"geo", b"{}"))
+    column = metadata.get("primary_column", "geometry")
+    encoding = metadata.get("columns", {}).get(column, {}).get("encoding", "WKB")
+    attributes = table.drop_columns([column]).to_pandas()
+    if encoding.upper() == "WKB":
+        return from_geometries(shapely.from_wkb(table[column].to_numpy(zero_copy_only=False)), attributes)
+    kept = table[column].is_valid().to_numpy(zero_copy_only=False)
+    geometry = table.filter(table[column].is_valid())[column]
+    return _layer(*_arrow_geometry(geometry, encoding), attributes[kept], all_attributes=attributes)
+
+
+def write_geoparquet(layer: dict, path: str) -> str:
+    """
+    Writes a layer to a GeoParquet file with GeoArrow native geometry, the arrays of the layer are written as they are,
+    a layer of several geometry families is written as WKB
+
+    :param layer: dict: Layer to write
+    :param path: str: Path of the GeoParquet file
+    :return: str: The path
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if layer["geometry_type"] == shapely.GeometryType.GEOMETRYCOLLECTION:
+        geometry = pa.array(shapely.to_wkb(geometries(layer)), pa.binary())
+        encoding, geometry_types = "WKB", []
+    else:
+        coords = layer["coords"]
+        geometry = pa.StructArray.from_arrays([pa.array(coords[:, 0]), pa.array(coords[:, 1])], names=["x", "y"])
+        for offset in layer["offsets"]:
+            geometry = pa.ListArray.from_arrays(pa.array(offset, pa.int32()), geometry)
+        encoding = layer["geometry_type"].name.lower()
+        geometry_types = [_geometry_type_name(encoding)]
+    attributes = pa.Table.from_pandas(layer["attributes"], preserve_index=False)
+    # built from the columns, a table of a frame without columns has no rows
+    table = pa.Table.from_arrays([*attributes.columns, geometry], names=[*attributes.column_names, "geometry"])
+    geo = {
+        "version": "1.1.0",
+        "primary_column": "geometry",
+        "columns": {"geometry": {"encoding": encoding, "geometry_types": geometry_types}},
+    }
+    pq.write_table(table.replace_schema_metadata({**(attributes.schema.metadata or {}), b"geo": json.dumps(geo).encode()}), path)
+    return path
+
+
+def _geometry_type_name(encoding: str) -> str:
+    # GeoJSON name of a GeoArrow encoding, e.g. multilinestring to MultiLineString
+    return next(name for name in _GEOJSON_FAMILIES if name.lower() == encoding)
+
+
+def read_featureclass(feature_class: str) -> dict:
+    """
+    Reads a feature class into a layer with one search cursor pass
+
+    :param feature_class: str: Path or name of the feature class
+    :return: dict: Layer, the OBJECTID is the feature id
+    """
+    import arcpy
+
+    fields = [field for field in arcpy.ListFields(feature_class) if field.type not in ("Geometry", "Blob", "Raster")]
+    names = [field.name for field in fields]
+    rows = list(arcpy.da.SearchCursor(feature_class, ["SHAPE@WKB", *names]))
+    attributes = pd.DataFrame([row[1:] for row in rows], columns=names)
+    geometries = shapely.from_wkb([bytes(row[0]) if row[0] else None for row in rows])
+    oid_field = next((field.name for field in fields if field.type == "OID"), None)
+    return from_geometries(geometries, attributes, oid_field)
+
+
+def _read(source: str) -> dict:
+    extension = os.path.splitext(source)[1].lower()
+    with span("read_layer", source=os.path.basename(source)) as record:
+        if extension in ESRI_JSON_EXTENSIONS:
+            layer = read_esrijson(source)
+        elif extension in GEOJSON_EXTENSIONS:
+            layer = read_geojson(source)
+        elif extension in GEOPARQUET_EXTENSIONS:
+            layer = read_geoparquet(source)
+        else:
+            layer = read_featureclass(source)
+        record["rows_out"] = len(layer["attributes"])
+    dropped = len(layer["all_attributes"]) - len(layer["attributes"])
+    if dropped:
+        print(f"{dropped} of {len(layer['all_attributes'])} features of {source} have no geometry, only their "
+              f"attributes are kept")
+    return layer
+
+
+class GeometryCache:
+    """
+    Keeps every layer read with read_layer while it is active, e.g. for one pipeline run
+
+    Layers are kept by their source so every stage reading a layer gets the arrays read the first time.
+
+    Usage:
+        with GeometryCache():
+            mains = read_layer("WaterMainFC", "FACILITYID")
+    """
+
+    def __init__(self):
+        self.layers = {}
+
+    def get(self, source: str) -> dict:
+        """
+        Reads a layer the first time it is asked for and returns the same layer every time after
+
+        :param source: str: Feature class, or path of an Esri JSON, GeoJSON or GeoParquet file
+        :return: dict: Layer
+        """
+        key = os.path.abspath(source) if os.path.exists(source) else source
+        if key not in self.layers:
+            self.layers[key] = _read(source)
+        return self.layers[key]
+
+    def clear(self):
+        self.layers.clear()
+
+    def __enter__(self):
+        _active.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        _active.remove(self)
+        self.clear()
+        return False
+
+
+def current() -> GeometryCache:
+    """
+    :return: GeometryCache: The innermost active geometry cache, None when none is active
+    """
+    return _active[-1] if _active else None
+
+
+def read_layer(source: str, id_field: str = None) -> dict:
+    """
+    Reads a layer, from the active geometry cache when there is one
+
+    :param source: str: Feature class, or path of an Esri JSON, GeoJSON or GeoParquet file
+    :param id_field: str: Attribute with the feature id, the OBJECTID or the feature position when not given
+    :return: dict: Layer with ids, geometry_type, coords, offsets, attributes and all_attributes, sharing the arrays of the cached layer
+    """
+    cache = current()
+    layer = cache.get(source) if cache is not None else _read(source)
+    id_field = id_field or layer["id_field"]
+    ids = layer["attributes"][id_field].to_numpy() if id_field else np.arange(len(layer["attributes"]))
+    return {**layer, "ids": ids}
+
+
+def geometries(layer: dict) -> np.ndarray:
+    """
+    Shapely geometry of every feature, built from the arrays the first time
+
+    :param layer: dict: Layer
+    :return: np.ndarray: Shapely geometries
+    """
+    views = layer["views"]
+    if "geometries" not in views:
+        views["geometries"] = np.asarray(
+            shapely.from_ragged_array(layer["geometry_type"], layer["coords"], layer["offsets"] or None), dtype=object
+        )
+    return views["geometries"]
+
+
+def layer_frame(layer: dict) -> pd.DataFrame:
+    """
+    Attributes of every feature with a geometry column of its shapely geometry, the layout of the synthetic layers
+
+    :param layer: dict: Layer
+    :return: pd.DataFrame: The attribute columns and a geometry column
+    """
+    return layer["attributes"].assign(geometry=geometries(layer))
+
+
+def point_coordinates(layer: dict) -> np.ndarray:
+    """
+    (n x 2) coordinates of every point feature, the coordinate array itself for a point layer and the centroids of the
+    features otherwise
+
+    :param layer: dict: Layer
+    :return: np.ndarray: Point coordinates
+    """
+    if layer["geometry_type"] == shapely.GeometryType.POINT:
+        return layer["coords"]
+    return shapely.get_coordinates(shapely.centroid(geometries(layer)))
+
+
+def line_layer(layer: dict) -> dict:
+    """
+    Line layer of the isolation zone engine from a line layer, sharing its coordinate and offset arrays
+
+    :param layer: dict: Layer of LineString or MultiLineString features from read_layer
+    :return: dict: Line layer with ids, coords, part_offsets and part_features arrays
+    """
+    offsets = layer["offsets"]
+    if layer["geometry_type"] == shapely.GeometryType.LINESTRING:
+        part_features = np.arange(len(offsets[0]) - 1, dtype=np.int64)
+    elif layer["geometry_type"] == shapely.GeometryType.MULTILINESTRING:
+        part_features = np.repeat(np.arange(len(offsets[1]) - 1, dtype=np.int64), np.diff(offsets[1]))
+    else:
+        raise ValueError(f"{layer['geometry_type'].name} is not a line geometry type")
+    return {
+        "ids": layer.get("ids", np.arange(len(layer["attributes"]))),
+        "coords": layer["coords"],
+        "part_offsets": offsets[0],
+        "part_features": part_features,
+    }
@@ -0,0 +1,313 @@
+import json
+import os
+import platform
+import threading
+import time
+from contextlib import contextmanager
+
+import psutil
+
+# Every geoprocessing call and DataFrame stage of a run is recorded as a span with its wall time, CPU time, peak RSS and
+# row counts. Spans nest, a span opened inside another records the outer span as its parent. The spans of a run are
+# written to a JSON trace and summed up per name in a table when the run ends.
+#
+# The cost of a span is two clock reads and two RSS reads, the peak in between is caught by one sampler thread per run
+# so spans can be left on in production. Spans opened while no trace is active cost next to nothing and are not kept.
+
+# Seconds between the RSS samples of the sampler thread
+SAMPLE_INTERVAL = 0.01
+
+# Stack of the traces that are active in this process, spans are recorded to the innermost one
+_active = []
+
+
+class _Sampler:
+    # Samples the resident set size of the process in a background thread and raises the peak of every open span,
+    # allocations made by GEOS, arcpy and other native libraries are seen as well as Python's
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.open = []
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def rss(self) -> int:
+        return self.process.memory_info().rss
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            rss = self.rss()
+            self.peak = max(self.peak, rss)
+            for record in list(self.open):
+                if rss > record["_peak"]:
+                    record["_peak"] = rss
+
+    def start(self):
+        self.peak = self.rss()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.rss())
+
+
+def _length(value):
+    # Row count of a DataFrame, Series or array, None for anything else
+    shape = getattr(value, "shape", None)
+    if isinstance(shape, tuple) and shape:
+        return int(shape[0])
+    return None
+
+
+class Trace:
+    """
+    Records the spans of one run and writes them to a JSON trace and a summary table when the run ends
+
+    Used as a context manager around the run, spans opened with span, call and tool while it is active are recorded
+    to it::
+
+        with Trace("COF", os.path.join(results_folder, "Traces")):
+            run the stages
+
+    :param name: str: Name of the run, used for the trace file name
+    :param trace_folder: str: Folder to write the JSON trace to, the trace is not written when not given
+    :param print_summary: bool: Print the summary table when the run ends
+    :param interval: float: Seconds between the RSS samples
+    """
+
+    def __init__(self, name: str, trace_folder: str = None, print_summary: bool = True, interval: float = SAMPLE_INTERVAL):
+        self.name = name
+        self.trace_folder = trace_folder
+        self.print_summary = print_summary
+        self.spans = []
+        self.path = None
+        self.started = None
+        self.wall_seconds = None
+        self._sampler = _Sampler(interval)
+        self._stack = []
+        self._wall = None
+
+    @contextmanager
+    def span(self, name: str, rows_in: int = None, **attributes):
+        """
+        Records the block run inside it as a span
+
+        The record is yielded so the block can set rows_out or any other attribute on it.
+
+        :param name: str: Name of the span, spans with the same name are summed up in the summary
+        :param rows_in: int: Number of input rows
+        :param attributes: Other JSON serializable attributes to record
+        :return: dict: Record of the span
+        """
+        record = {
+            "name": name,
+            "parent": self._stack[-1]["id"] if self._stack else None,
+            "id": len(self.spans),
+            "start_seconds": round(time.perf_counter() - self._wall, 4),
+            "rows_in": rows_in,
+            "rows_out": None,
+            **attributes,
+            "_peak": self._sampler.rss(),
+        }
+        self.spans.append(record)
+        self._stack.append(record)
+        self._sampler.open.append(record)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        except BaseException as error:
+            record["error"] = f"{type(error).__name__}: {error}"
+            raise
+        finally:
+            record["wall_seconds"] = round(time.perf_counter() - wall, 4)
+            record["cpu_seconds"] = round(time.process_time() - cpu, 4)
+            self._sampler.open.remove(record)
+            record["peak_rss_mb"] = round(max(record.pop("_peak"), self._sampler.rss()) / 2 ** 20, 1)
+            self._stack.pop()
+
+    def __enter__(self):
+        self.started = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self._wall = time.perf_counter()
+        self._sampler.start()
+        _active.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        _active.remove(self)
+        self._sampler.stop()
+        self.wall_seconds = round(time.perf_counter() - self._wall, 4)
+        if self.trace_folder:
+            self.write()
+        if self.print_summary:
+            print(self.summary())
+        return False
+
+    def to_dict(self) -> dict:
+        """
+        :return: dict: The run, the machine it ran on and every span
+        """
+        return {
+            "name": self.name,
+            "started": self.started,
+            "wall_seconds": self.wall_seconds,
+            "peak_rss_mb": round(self._sampler.peak / 2 ** 20, 1),
+            "machine": {
+                "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+                "pid": os.getpid(),
+            },
+            "spans": self.spans,
+        }
+
+    def write(self, path: str = None) -> str:
+        """
+        Writes the JSON trace of the run
+
+        :param path: str: Path of the trace, {name}-{start time}.json in the trace folder when not given
+        :return: str: Path of the trace
+        """
+        if path is None:
+            os.makedirs(self.trace_folder, exist_ok=True)
+            path = os.path.join(self.trace_folder, f"{self.name}-{self.started.replace(':', '')}.json")
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2, default=str)
+        self.path = path
+        return path
+
+    def summary(self) -> str:
+        """
+        Sums up the spans per name, in the order they first ran
+
+        Wall and CPU time are summed over the calls of a name, the peak RSS is the largest of them. Time spent in a
+        nested span is counted in its parent as well.
+
+        :return: str: Table with the calls, wall time, CPU time, peak RSS and rows in and out of every span name
+        """
+        totals = {}
+        for record in self.spans:
+            total = totals.setdefault(record["name"], {
+                "depth": 0, "calls": 0, "wall": 0.0, "cpu": 0.0, "peak": 0.0, "rows_in": None, "rows_out": None,
+            })
+            if total["calls"] == 0:
+                parent, depth = record["parent"], 0
+                while parent is not None:
+                    depth += 1
+                    parent = self.spans[parent]["parent"]
+                total["depth"] = depth
+            total["calls"] += 1
+            total["wall"] += record.get("wall_seconds", 0.0)
+            total["cpu"] += record.get("cpu_seconds", 0.0)
+            total["peak"] = max(total["peak"], record.get("peak_rss_mb", 0.0))
+            for key in ("rows_in", "rows_out"):
+                if record[key] is not None:
+                    total[key] = (total[key] or 0) + record[key]
+
+        def rows(value):
+            return "" if value is None else f"{value:,}"
+
+        lines = [
+            f"{self.name} trace" + (f", {self.wall_seconds:.2f} s" if self.wall_seconds is not None else ""),
+            f"{'span':<44}{'calls':>7}{'wall s':>10}{'cpu s':>10}{'peak MB':>10}{'rows in':>12}{'rows out':>12}",
+        ]
+        for name, total in totals.items():
+            label = ("  " * total["depth"] + name)[:43]
+            lines.append(
+                f"{label:<44}{total['calls']:>7}{total['wall']:>10.3f}{total['cpu']:>10.3f}{total['peak']:>10.1f}"
+                f"{rows(total['rows_in']):>12}{rows(total['rows_out']):>12}"
+            )
+        return "\n".join(lines)
+
+
+def current() -> Trace:
+    """
+    :return: Trace: The innermost active trace, None when no trace is active
+    """
+    return _active[-1] if _active else None
+
+
+@contextmanager
+def span(name: str, rows_in: int = None, **attributes):
+    """
+    Records the block run inside it as a span of the active trace, see Trace.span
+
+    Nothing is recorded when no trace is active, the yielded record is then thrown away.
+
+    :param name: str: Name of the span
+    :param rows_in: int: Number of input rows
+    :param attributes: Other JSON serializable attributes to record
+    :return: dict: Record of the span
+    """
+    trace = current()
+    if trace is None:
+        yield {}
+        return
+    with trace.span(name, rows_in, **attributes) as record:
+        yield record
+
+
+def call(name: str, func, *args, **kwargs):
+    """
+    Calls a function as a span, the rows in are the rows of its DataFrame and array arguments and the rows out the
+    rows of its result
+
+    :param name: str: Name of the span
+    :param func: callable: Function to call
+    :return: Result of the function
+    """
+    sizes = [_length(value) for value in list(args) + list(kwargs.values())]
+    sizes = [size for size in sizes if size is not None]
+    with span(name, sum(sizes) if sizes else None) as record:
+        result = func(*args, **kwargs)
+        record["rows_out"] = _length(result)
+    return result
+
+
+# Keyword arguments of geoprocessing tools that name their input and output datasets
+_TOOL_INPUTS = ("in_features", "target_features", "in_table", "in_rows", "in_dataset")
+_TOOL_OUTPUTS = ("out_feature_class", "out_features", "out_table", "out_dataset")
+
+
+def count_rows(dataset):
+    """
+    Counts the rows of a feature class or table with GetCount
+
+    :param dataset: str: Feature class, table or layer
+    :return: int: Number of rows, None when it can not be counted
+    """
+    import arcpy
+
+    try:
+        return int(arcpy.management.GetCount(dataset).getOutput(0))
+    except Exception:
+        return None
+
+
+def tool(func, *args, count: bool = True, **kwargs):
+    """
+    Runs a geoprocessing tool as a span named after it
+
+    The rows of the input and output datasets are counted when they are passed as keyword arguments, or as the first
+    argument for the input. Counting is one GetCount per dataset, pass count=False for tools run many times over.
+
+    :param func: callable: arcpy tool, e.g. arcpy.analysis.SpatialJoin
+    :param count: bool: Count the rows of the input and output datasets
+    :return: arcpy.Result: Result of the tool
+    """
+    name = f"{func.__module__.split('.')[-1]}.{func.__name__}" if getattr(func, "__module__", None) else func.__name__
+    trace = current()
+    if trace is None:
+        return func(*args, **kwargs)
+    inputs = [kwargs[key] for key in _TOOL_INPUTS if isinstance(kwargs.get(key), str)]
+    if not inputs and args and isinstance(args[0], str):
+        inputs = [args[0]]
+    rows_in = count_rows(inputs[0]) if count and inputs else None
+    with trace.span(name, rows_in) as record:
+        result = func(*args, **kwargs)
+    outputs = [kwargs[key] for key in _TOOL_OUTPUTS if isinstance(kwargs.get(key), str)]
+    if count and outputs:
+        # counted after the span so the GetCount is not timed with the tool
+        record["rows_out"] = count_rows(outputs[0])
+    return result
@@ -0,0 +1,758 @@
+import argparse
+import json
+import re
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+# Vertices closer than this (in map units) are treated as the same network node
+DEFAULT_TOLERANCE = 0.01
+
+
+def read_lines_geojson(path: str, id_field: str = None) -> dict:
+    """
+    Reads a GeoJSON file of LineString/MultiLineString features into a line layer
+
+    :param path: str: Path to the GeoJSON file
+    :param id_field: str: Property to use as the feature id, the feature position is used when not given
+    :return: dict: Line layer with ids, coords, part_offsets and part_features arrays
+    """
+    from GeometryIO import line_layer, read_layer
+
+    return line_layer(read_layer(path, id_field))
+
+
+def read_points_geojson(path: str) -> np.ndarray:
+    """
+    Reads a GeoJSON file of Point/MultiPoint features into an (n x 2) coordinate array
+
+    :param path: str: Path to the GeoJSON file
+    :return: np.ndarray: Point coordinates
+    """
+    from GeometryIO import read_layer
+
+    return read_layer(path)["coords"]
+
+
+def read_lines_shapely(ids, geometries) -> dict:
+    """
+    Reads shapely LineString/MultiLineString geometries into a line layer
+
+    :param ids: array-like: Feature id of every geometry
+    :param geometries: array-like: Shapely line geometries
+    :return: dict: Line layer with ids, coords, part_offsets and part_features arrays
+    """
+    import shapely
+
+    geometries = np.asarray(geometries, dtype=object)
+    parts, part_features = shapely.get_parts(geometries, return_index=True)
+    coords, part_index = shapely.get_coordinates(parts, return_index=True)
+    counts = np.bincount(part_index, minlength=len(parts))
+    return {
+        "ids": np.asarray(ids),
+        "coords": coords,
+        "part_offsets": np.concatenate([[0], np.cumsum(counts)]),
+        "part_features": part_features.astype(np.int64),
+    }
+
+
+def read_lines_featureclass(feature_class: str, id_field: str = None) -> dict:
+    """
+    Reads a polyline feature class, or a local layer file, into a line layer once through GeometryIO
+
+    :param feature_class: str: Path or name of the polyline feature class, or path of an Esri JSON, GeoJSON or
+        GeoParquet file
+    :param id_field: str: Field to use as the feature id, the OBJECTID is used when not given
+    :return: dict: Line layer with ids, coords, part_offsets and part_features arrays
+    """
+    from GeometryIO import line_layer, read_layer
+
+    return line_layer(read_layer(feature_class, id_field))
+
+
+
+
+def _insert_valve_vertices(lines: dict, valve_xy: np.ndarray, tolerance: float) -> dict:
+    # Valves that sit part way along a segment split it, so add a vertex there on every segment the valve is on
+    coords = lines["coords"]
+    part_offsets = lines["part_offsets"]
+    seg_start = np.setdiff1d(np.arange(max(len(coords) - 1, 0)), part_offsets[1:] - 1)
+    # A repeated vertex makes a zero-length segment, no valve can sit part way along it
+    seg_start = seg_start[np.any(coords[seg_start + 1] != coords[seg_start], axis=1)]
+    if len(valve_xy) == 0 or len(seg_start) == 0:
+        return lines
+    a = coords[seg_start]
+    ab = coords[seg_start + 1] - a
+    length = np.hypot(*ab.T)
+
+    # Sample points along every segment so a KD-tree can find the segments near each valve
+    spacing = max(length.mean() / 4, tolerance)
+    steps = np.ceil(length / spacing).astype(np.int64) + 1
+    sample_seg = np.repeat(np.arange(len(seg_start)), steps)
+    sample_t = (np.arange(steps.sum()) - np.repeat(np.cumsum(steps) - steps, steps)) / np.repeat(steps - 1, steps)
+    samples = a[sample_seg] + sample_t[:, None] * ab[sample_seg]
+    hits = cKDTree(samples).query_ball_point(valve_xy, spacing / 2 + tolerance)
+    hit_count = np.array([len(hit) for hit in hits])
+    if hit_count.sum() == 0:
+        return lines
+    pairs = np.unique(np.stack([
+        np.repeat(np.arange(len(valve_xy)), hit_count), sample_seg[np.concatenate(hits).astype(np.int64)]
+    ], axis=1), axis=0)
+    valve, seg = pairs[:, 0], pairs[:, 1]
+
+    # Project each valve onto its candidate segments and keep the ones it is on, away from the segment ends
+    length2 = length[seg] ** 2
+    t = np.clip(np.einsum("ij,ij->i", valve_xy[valve] - a[seg], ab[seg]) / np.where(length2 > 0, length2, 1), 0, 1)
+    projected = a[seg] + t[:, None] * ab[seg]
+    on_segment = (np.hypot(*(projected - valve_xy[valve]).T) <= tolerance) & \
+        (t * length[seg] > tolerance) & ((1 - t) * length[seg] > tolerance)
+    if not on_segment.any():
+        return lines
+    seg, t, projected = seg[on_segment], t[on_segment], projected[on_segment]
+
+    # Insert the new vertices in order along each segment, skipping duplicates of the same valve location
+    order = np.lexsort((t, seg))
+    seg, t, projected = seg[order], t[order], projected[order]
+    duplicate = np.zeros(len(seg), dtype=bool)
+    duplicate[1:] = (seg[1:] == seg[:-1]) & (np.hypot(*(projected[1:] - projected[:-1]).T) <= tolerance)
+    insert_at = seg_start[seg[~duplicate]] + 1
+    new_coords = np.insert(coords, insert_at, projected[~duplicate], axis=0)
+    new_offsets = part_offsets + np.searchsorted(insert_at, part_offsets, side="left")
+    return dict(lines, coords=new_coords, part_offsets=new_offsets)
+
+
+def build_network(lines: dict, valve_xy: np.ndarray, tolerance: float = DEFAULT_TOLERANCE) -> dict:
+    """
+    Builds the in-memory network topology for a line layer with valves as barrier nodes
+
+    :param lines: dict: Line layer of water mains
+    :param valve_xy: np.ndarray: (n x 2) valve coordinates
+    :param tolerance: float: Snapping tolerance in map units
+    :return: dict: Network with the segment, node and barrier arrays
+    """
+    valve_xy = np.asarray(valve_xy, dtype=float).reshape(-1, 2)
+    lines = _insert_valve_vertices(lines, valve_xy, tolerance)
+    coords = lines["coords"]
+    part_offsets = lines["part_offsets"]
+    vertex_count = len(coords)
+
+    # Cluster vertices within the tolerance into network nodes
+    pairs = cKDTree(coords).query_pairs(tolerance, output_type="ndarray")
+    vertex_graph = coo_matrix(
+        (np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])), shape=(vertex_count, vertex_count)
+    )
+    _, vertex_node = connected_components(vertex_graph, directed=False)
+    node_count = vertex_node.max() + 1 if vertex_count else 0
+
+    # Segments run from every vertex to the next one in the same part
+    part_counts = np.diff(part_offsets)
+    seg_vertex = np.setdiff1d(np.arange(max(vertex_count - 1, 0)), part_offsets[1:] - 1)
+    seg_part = np.repeat(np.arange(len(part_counts)), np.maximum(part_counts - 1, 0))
+    seg_length = np.hypot(*(coords[seg_vertex + 1] - coords[seg_vertex]).T)
+
+    # Valves snapped to a node make that node a barrier
+    barrier = np.zeros(node_count, dtype=bool)
+    if len(valve_xy) and vertex_count:
+        distance, vertex = cKDTree(coords).query(valve_xy, distance_upper_bound=tolerance)
+        barrier[vertex_node[vertex[np.isfinite(distance)]]] = True
+
+    return {
+        "ids": lines["ids"],
+        "coords": coords,
+        "part_offsets": part_offsets,
+        "part_features": lines["part_features"],
+        "vertex_node": vertex_node,
+        "seg_vertex": seg_vertex,
+        "seg_part": seg_part,
+        "seg_feature": lines["part_features"][seg_part],
+        "seg_a": vertex_node[seg_vertex],
+        "seg_b": vertex_node[seg_vertex + 1],
+        "seg_length": seg_length,
+        "barrier": barrier,
+    }
+
+
+def label_zones(network: dict) -> np.ndarray:
+    """
+    Labels every segment with its isolation zone in one connected components pass
+
+    Segments and nodes form one graph and a segment is linked to each of its end nodes unless the node is a valve,
+    so the components are the areas a crew can isolate by closing valves. Zones are numbered from 0 in the order
+    their first segment appears, which is the order the trace loop would have found them.
+
+    :param network: dict: Network from build_network
+    :return: np.ndarray: Zone number for every segment
+    """
+    seg_count = len(network["seg_vertex"])
+    if seg_count == 0:
+        return np.empty(0, dtype=np.int64)
+    seg_index = np.arange(seg_count)
+    rows = np.concatenate([seg_index, seg_index])
+    nodes = np.concatenate([network["seg_a"], network["seg_b"]])
+    keep = ~network["barrier"][nodes]
+    node_total = len(network["barrier"])
+    rows, cols = rows[keep], nodes[keep] + seg_count
+
+    # A segment that starts and ends at the same node, e.g. at a repeated vertex, joins the zone of the nearest
+    # segment of its part before it, or after it at the start of the part, so it is not a zone of its own at a valve
+    seg_part = network["seg_part"]
+    collapsed = network["seg_a"] == network["seg_b"]
+    before = np.maximum.accumulate(np.where(collapsed, -1, seg_index))
+    after = np.minimum.accumulate(np.where(collapsed, seg_count, seg_index)[::-1])[::-1]
+    has_before = (before >= 0) & (seg_part[np.maximum(before, 0)] == seg_part)
+    has_after = (after < seg_count) & (seg_part[np.minimum(after, seg_count - 1)] == seg_part)
+    joined = collapsed & (has_before | has_after)
+    rows = np.concatenate([rows, seg_index[joined]])
+    cols = np.concatenate([cols, np.where(has_before, before, after)[joined]])
+
+    graph = coo_matrix(
+        (np.ones(len(rows), dtype=np.int8), (rows, cols)),
+        shape=(seg_count + node_total, seg_count + node_total),
+    )
+    _, labels = connected_components(graph, directed=False)
+
+    # Renumber the components in order of first appearance
+    seg_labels = labels[:seg_count]
+    _, first = np.unique(seg_labels, return_index=True)
+    rank = np.empty(len(first), dtype=np.int64)
+    order = np.argsort(first)
+    rank[order] = np.arange(len(first))
+    remap = np.full(seg_labels.max() + 1, -1, dtype=np.int64)
+    remap[seg_labels[first]] = rank
+    return remap[seg_labels]
+
+
+def zone_name(zone: int) -> str:
+    # Zone names follow the "Zone- n" format of the hosted IsoZone layer, numbered from 1
+    return f"Zone- {zone + 1}"
+
+
+def _zone_lengths(network: dict, seg_zone: np.ndarray) -> pd.DataFrame:
+    # Length of every feature in each zone it spans, longest first within each feature
+    lengths = pd.DataFrame({"feature": network["seg_feature"], "zone": seg_zone, "length": network["seg_length"]})
+    lengths = lengths.groupby(["feature", "zone"], sort=False)["length"].sum().reset_index()
+    return lengths.sort_values(["feature", "length"], ascending=[True, False], kind="stable")
+
+
+def main_zones(network: dict, seg_zone: np.ndarray, names=None) -> pd.DataFrame:
+    """
+    Assigns each main to the zone that holds the largest length of it
+
+    A main with a valve part way along it spans more than one zone, so every zone it spans is listed as well.
+
+    :param network: dict: Network from build_network
+    :param seg_zone: np.ndarray: Zone number for every segment
+    :param names: list: Name of every zone number, "Zone- n" names are used when not given
+    :return: pd.DataFrame: One row per main with its id, zone name and the ";" separated names of all its zones
+    """
+    lengths = _zone_lengths(network, seg_zone)
+    lengths["name"] = [names[zone] if names is not None else zone_name(zone) for zone in lengths["zone"]]
+    grouped = lengths.groupby("feature", sort=True)["name"]
+    return pd.DataFrame({
+        "id": network["ids"][grouped.first().index.to_numpy()],
+        "zone": grouped.first().to_numpy(),
+        "zones": grouped.agg(";".join).to_numpy(),
+    })
+
+
+def zone_geometries(network: dict, seg_zone: np.ndarray, names=None) -> list:
+    """
+    Builds the aggregated line geometry of every zone
+
+    :param network: dict: Network from build_network
+    :param seg_zone: np.ndarray: Zone number for every segment
+    :param names: list: Name of every zone number, "Zone- n" names are used when not given
+    :return: list: (zone name, list of part coordinate arrays) for every zone in zone order
+    """
+    if len(seg_zone) == 0:
+        return []
+    # Consecutive segments of the same part and zone are chained into one part
+    seg_part = network["seg_part"]
+    breaks = np.flatnonzero((np.diff(seg_part) != 0) | (np.diff(seg_zone) != 0)) + 1
+    run_start = np.concatenate([[0], breaks])
+    run_end = np.concatenate([breaks, [len(seg_zone)]]) - 1
+
+    coords = network["coords"]
+    seg_vertex = network["seg_vertex"]
+    zones = [[] for _ in range(seg_zone.max() + 1)]
+    for start, end in zip(run_start, run_end):
+        zones[seg_zone[start]].append(coords[seg_vertex[start]:seg_vertex[end] + 2])
+    return [(names[zone] if names is not None else zone_name(zone), parts) for zone, parts in enumerate(zones)]
+
+
+def find_isolation_zones(lines: dict, valve_xy: np.ndarray, tolerance: float = DEFAULT_TOLERANCE) -> dict:
+    """
+    Finds the isolation zones of a water main network with valves acting as barriers
+
+    :param lines: dict: Line layer of water mains
+    :param valve_xy: np.ndarray: (n x 2) valve coordinates
+    :param tolerance: float: Snapping tolerance in map units
+    :return: dict: The network, segment zones, main zones and zone geometries
+    """
+    network = build_network(lines, valve_xy, tolerance)
+    seg_zone = label_zones(network)
+    return {
+        "network": network,
+        "seg_zone": seg_zone,
+        "main_zones": main_zones(network, seg_zone),
+        "zones": zone_geometries(network, seg_zone),
+    }
+
+
+def feature_zones(network: dict, seg_zone: np.ndarray) -> np.ndarray:
+    """
+    Zone number of every main, the zone that holds the largest length of it as in main_zones
+
+    :param network: dict: Network from build_network
+    :param seg_zone: np.ndarray: Zone number for every segment
+    :return: np.ndarray: Zone number of every feature, -1 for features without segments
+    """
+    lengths = _zone_lengths(network, seg_zone).drop_duplicates("feature")
+    zones = np.full(len(network["ids"]), -1, dtype=np.int64)
+    zones[lengths["feature"].to_numpy()] = lengths["zone"].to_numpy()
+    return zones
+
+
+def line_geometries(lines: dict) -> np.ndarray:
+    """
+    Builds a shapely MultiLineString for every feature of a line layer
+
+    :param lines: dict: Line layer
+    :return: np.ndarray: Shapely geometry of every feature, None for features without parts
+    """
+    import shapely
+
+    counts = np.diff(lines["part_offsets"])
+    kept = counts >= 2
+    parts = shapely.linestrings(
+        lines["coords"][np.repeat(kept, counts)], indices=np.repeat(np.arange(kept.sum()), counts[kept])
+    )
+    geometries = np.full(len(lines["ids"]), None, dtype=object)
+    features = lines["part_features"][kept]
+    if len(parts):
+        present = np.unique(features)
+        geometries[present] = shapely.multilinestrings(parts, indices=features)[present]
+    return geometries
+
+
+def zone_adjacency(network: dict, seg_zone: np.ndarray) -> dict:
+    """
+    Builds the zone adjacency graph with the valve nodes as its edges
+
+    A valve node separates the zones of the segments that end at it, the zones of every valve node are listed once
+    in one array with the offset of each node's first zone.
+
+    :param network: dict: Network from build_network
+    :param seg_zone: np.ndarray: Zone number for every segment
+    :return: dict: nodes (every valve node with a segment, sorted), offsets (first zone of every node with the total
+        at the end) and zones (zone numbers of every node, sorted)
+    """
+    nodes = np.concatenate([network["seg_a"], network["seg_b"]])
+    zones = np.concatenate([seg_zone, seg_zone])
+    at_valve = network["barrier"][nodes]
+    pairs = np.unique(np.stack([nodes[at_valve], zones[at_valve]], axis=1), axis=0).reshape(-1, 2)
+    valve_nodes, counts = np.unique(pairs[:, 0], return_counts=True)
+    return {
+        "nodes": valve_nodes,
+        "offsets": np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+        "zones": pairs[:, 1],
+    }
+
+
+def _valve_rows(network: dict, adjacency: dict, valve_xy: np.ndarray, tolerance: float) -> np.ndarray:
+    # Row of the node of every valve in the zone adjacency, -1 for valves on no main
+    row = np.full(len(valve_xy), -1, dtype=np.int64)
+    if len(valve_xy) == 0 or len(adjacency["nodes"]) == 0:
+        return row
+    distance, vertex = cKDTree(network["coords"]).query(valve_xy, distance_upper_bound=tolerance)
+    snapped = np.flatnonzero(np.isfinite(distance))
+    node = network["vertex_node"][vertex[snapped]]
+    found = np.minimum(np.searchsorted(adjacency["nodes"], node), len(adjacency["nodes"]) - 1)
+    on_main = adjacency["nodes"][found] == node
+    row[snapped[on_main]] = found[on_main]
+    return row
+
+
+def zone_boundary_valves(
+    network: dict, seg_zone: np.ndarray, valve_xy: np.ndarray, tolerance: float = DEFAULT_TOLERANCE
+) -> dict:
+    """
+    Lists the valves on the boundary of every zone, the valves a crew closes to isolate it
+
+    :param network: dict: Network from build_network, built with the same valves
+    :param seg_zone: np.ndarray: Zone number for every segment
+    :param valve_xy: np.ndarray: (n x 2) valve coordinates
+    :param tolerance: float: Snapping tolerance in map units
+    :return: dict: offsets (first valve of every zone number with the total at the end) and valves (valve indexes
+        of every zone, sorted)
+    """
+    valve_xy = np.asarray(valve_xy, dtype=float).reshape(-1, 2)
+    adjacency = zone_adjacency(network, seg_zone)
+    row = _valve_rows(network, adjacency, valve_xy, tolerance)
+    valves = np.flatnonzero(row >= 0)
+    # one (zone, valve) pair for every zone at the node of every valve
+    counts = np.diff(adjacency["offsets"])[row[valves]]
+    zone_index = np.repeat(adjacency["offsets"][row[valves]], counts) + \
+        (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts))
+    zones = adjacency["zones"][zone_index]
+    valves = np.repeat(valves, counts)
+    order = np.lexsort((valves, zones))
+    zone_count = seg_zone.max() + 1 if len(seg_zone) else 0
+    return {
+        "offsets": np.concatenate([[0], np.cumsum(np.bincount(zones, minlength=zone_count))]).astype(np.int64),
+        "valves": valves[order],
+    }
+
+
+def valve_criticality(
+    network: dict,
+    seg_zone: np.ndarray,
+    valve_xy: np.ndarray,
+    zone_laterals: np.ndarray = None,
+    tolerance: float = DEFAULT_TOLERANCE,
+    names=None,
+) -> pd.DataFrame:
+    """
+    Finds the zone every valve would merge if it failed to close, for all valves in one pass over the zone adjacency
+
+    A valve that can not be closed leaves its node open, so the zones it separates become one zone and the nearest
+    working valves around them are closed instead. Valves snapped to the same node fail together. The extra length
+    and laterals are what a shutdown of the smallest of those zones gains, the worst case for a break next to the valve.
+
+    :param network: dict: Network from build_network, built with the same valves
+    :param seg_zone: np.ndarray: Zone number for every segment
+    :param valve_xy: np.ndarray: (n x 2) valve coordinates
+    :param zone_laterals: np.ndarray: Number of laterals in every zone number, from zone_lateral_counts
+    :param tolerance: float: Snapping tolerance in map units
+    :param names: list: Name of every zone number, "Zone- n" names are used when not given
+    :return: pd.DataFrame: One row per valve with its x, y, the number of zones it separates, the ";" separated
+        names of the merged zones, the merged and extra length and, with zone_laterals, the merged and extra laterals
+    """
+    valve_xy = np.asarray(valve_xy, dtype=float).reshape(-1, 2)
+    adjacency = zone_adjacency(network, seg_zone)
+    row = _valve_rows(network, adjacency, valve_xy, tolerance)
+    on_main = row >= 0
+    zone_count = seg_zone.max() + 1 if len(seg_zone) else 0
+    zone_length = np.bincount(seg_zone, weights=network["seg_length"], minlength=zone_count)
+    starts = adjacency["offsets"][:-1]
+    node_zones = np.diff(adjacency["offsets"])
+    zones = adjacency["zones"]
+
+    # the smallest zone of every valve node by length, the first of its zones once they are sorted by length
+    node_of_zone = np.repeat(np.arange(len(starts)), node_zones)
+    smallest = zones[np.lexsort((zone_length[zones], node_of_zone))][starts] if len(starts) else zones[:0]
+
+    def per_valve(values):
+        # value of every valve's node, 0 for valves on no main
+        result = np.zeros(len(valve_xy), dtype=np.asarray(values).dtype)
+        result[on_main] = values[row[on_main]]
+        return result
+
+    def merged(values):
+        # sum of the values of the zones every valve merges and how much that is over its smallest zone
+        total = np.add.reduceat(values[zones], starts) if len(starts) else values[:0]
+        return per_valve(total), per_valve(total - values[smallest])
+
+    zone_names = [names[zone] if names is not None else zone_name(zone) for zone in range(zone_count)]
+    merged_zones = [";".join(zone_names[zone] for zone in zones[start:end]) for start, end in zip(starts, starts + node_zones)]
+    merged_length, extra_length = merged(zone_length)
+    criticality = pd.DataFrame({
+        "valve": np.arange(len(valve_xy)),
+        "x": valve_xy[:, 0],
+        "y": valve_xy[:, 1],
+        "zones": per_valve(node_zones),
+        "merged_zones": [merged_zones[index] if index >= 0 else None for index in row],
+        "merged_length": merged_length,
+        "extra_length": extra_length,
+    })
+    if zone_laterals is not None:
+        laterals = np.zeros(zone_count, dtype=np.int64)
+        laterals[:len(zone_laterals)] = zone_laterals
+        criticality["merged_laterals"], criticality["extra_laterals"] = merged(laterals)
+    return criticality
+
+
+def zone_lateral_counts(network: dict, seg_zone: np.ndarray, lateral_main: np.ndarray) -> np.ndarray:
+    """
+    Counts the laterals in every zone through the zone of their main
+
+    :param network: dict: Network from build_network
+    :param seg_zone: np.ndarray: Zone number for every segment
+    :param lateral_main: np.ndarray: Index of the main feature of every lateral, -1 for none
+    :return: np.ndarray: Number of laterals in every zone number
+    """
+    lateral_main = np.asarray(lateral_main, dtype=np.int64)
+    lateral_zone = feature_zones(network, seg_zone)[lateral_main[lateral_main >= 0]]
+    zone_count = seg_zone.max() + 1 if len(seg_zone) else 0
+    return np.bincount(lateral_zone[lateral_zone >= 0], minlength=zone_count)
+
+
+def subset_lines(lines: dict, keep: np.ndarray) -> dict:
+    """
+    Builds a line layer with only the features selected by a boolean mask
+
+    :param lines: dict: Line layer
+    :param keep: np.ndarray: Boolean mask over the features
+    :return: dict: Line layer with only the kept features, in the same order
+    """
+    counts = np.diff(lines["part_offsets"])
+    part_keep = keep[lines["part_features"]]
+    return {
+        "ids": lines["ids"][keep],
+        "coords": lines["coords"][np.repeat(part_keep, counts)],
+        "part_offsets": np.concatenate([[0], np.cumsum(counts[part_keep])]),
+        "part_features": (np.cumsum(keep) - 1)[lines["part_features"][part_keep]],
+    }
+
+
+def _features_near(lines: dict, points: np.ndarray, tolerance: float) -> np.ndarray:
+    # Features with a part whose bounding box comes within the tolerance of any of the points
+    near = np.zeros(len(lines["ids"]), dtype=bool)
+    counts = np.diff(lines["part_offsets"])
+    parts = np.flatnonzero(counts > 0)
+    if len(points) == 0 or len(parts) == 0:
+        return near
+    low = np.minimum.reduceat(lines["coords"], lines["part_offsets"][:-1][counts > 0])
+    high = np.maximum.reduceat(lines["coords"], lines["part_offsets"][:-1][counts > 0])
+    center = (low + high) / 2
+    radius = np.hypot(*(high - low).T) / 2 + tolerance
+    hits = cKDTree(points).query_ball_point(center, radius, return_length=True) > 0
+    near[lines["part_features"][parts[hits]]] = True
+    return near
+
+
+def _zone_number(name: str) -> int:
+    # Number at the end of a zone name, 0 when the name has none
+    match = re.search(r"(\d+)\s*$", str(name))
+    return int(match.group(1)) if match else 0
+
+
+def update_isolation_zones(
+    lines: dict,
+    valve_xy: np.ndarray,
+    previous_zones: pd.DataFrame,
+    changed_mains=(),
+    changed_valve_xy=None,
+    tolerance: float = DEFAULT_TOLERANCE,
+) -> dict:
+    """
+    Recomputes only the isolation zones touched by a set of network edits
+
+    The zones touched are the previous zones of the changed, added and deleted mains and of every main near a changed
+    valve location or a vertex of a changed main, plus any zone still connected to those through a node without a
+    valve. Only the mains in those zones are rebuilt into a network and relabeled.
+    Relabeled zones keep the name of the previous zone they share the most main length with, so untouched and
+    surviving zones keep their names and only split off zones get new ones.
+
+    :param lines: dict: Line layer of the current water mains
+    :param valve_xy: np.ndarray: (n x 2) current valve coordinates
+    :param previous_zones: pd.DataFrame: id, zone and zones of every main from the previous run
+    :param changed_mains: Ids of the mains that were edited, added and deleted mains are found automatically
+    :param changed_valve_xy: np.ndarray: Old and new coordinates of every added, moved or removed valve
+    :param tolerance: float: Snapping tolerance in map units
+    :return: dict: Updated main zones, geometries of the relabeled zones and the previous zone names they replace
+    """
+    previous = previous_zones.set_index("id")
+    ids = pd.Index(lines["ids"])
+    current_zone = previous["zone"].reindex(ids)
+
+    # Every zone each previous main spans, one row per main and zone
+    spans = (previous["zones"] if "zones" in previous.columns else previous["zone"]).str.split(";").explode()
+
+    # Mains missing from the previous run are new and count as changed
+    changed = ids.isin(list(changed_mains)) | current_zone.isna().to_numpy()
+    deleted = previous.index.difference(ids)
+
+    # Find the mains near the edits: the changed valve locations and every vertex of the changed mains
+    counts = np.diff(lines["part_offsets"])
+    changed_vertices = lines["coords"][np.repeat(changed[lines["part_features"]], counts)]
+    edit_points = np.concatenate([
+        np.asarray(changed_valve_xy if changed_valve_xy is not None else [], dtype=float).reshape(-1, 2),
+        changed_vertices,
+    ])
+    near = _features_near(lines, edit_points, tolerance)
+    edited = ids[near | changed].union(pd.Index(list(changed_mains))).union(deleted)
+    touched = set(spans[spans.index.isin(edited)])
+
+    # A main spanning a touched zone brings its other zones along, repeat until no new zone is added
+    while True:
+        members = spans.index[spans.isin(touched)]
+        new_zones = set(spans[spans.index.isin(members)]) - touched
+        if not new_zones:
+            break
+        touched |= new_zones
+    keep = ids.isin(spans.index[spans.isin(touched)]) | changed
+    valve_xy = np.asarray(valve_xy, dtype=float).reshape(-1, 2)
+
+    # Rebuild and relabel only the mains in the touched zones plus the changed mains
+    sub_lines = subset_lines(lines, keep)
+    if len(sub_lines["coords"]):
+        low = sub_lines["coords"].min(axis=0) - tolerance
+        high = sub_lines["coords"].max(axis=0) + tolerance
+        valve_xy = valve_xy[((valve_xy >= low) & (valve_xy <= high)).all(axis=1)]
+    network = build_network(sub_lines, valve_xy, tolerance)
+    seg_zone = label_zones(network)
+
+    # Give every new zone the previous name it shares the most main length with, longest overlaps first
+    lengths = _zone_lengths(network, seg_zone)
+    overlap = pd.DataFrame({
+        "zone": lengths["zone"].to_numpy(),
+        "previous": current_zone.reindex(sub_lines["ids"][lengths["feature"].to_numpy()]).to_numpy(),
+        "length": lengths["length"].to_numpy(),
+    }).dropna(subset=["previous"])
+    overlap = overlap.groupby(["zone", "previous"])["length"].sum().reset_index()
+    overlap = overlap.sort_values("length", ascending=False, kind="stable")
+    names = [None] * (seg_zone.max() + 1 if len(seg_zone) else 0)
+    used = set()
+    for zone, name in zip(overlap["zone"], overlap["previous"]):
+        if names[zone] is None and name not in used:
+            names[zone] = name
+            used.add(name)
+
+    # Zones that did not inherit a name are numbered after the highest previous zone
+    next_number = max((_zone_number(name) for name in spans), default=0)
+    for zone in range(len(names)):
+        if names[zone] is None:
+            names[zone] = zone_name(next_number)
+            next_number += 1
+
+    # Untouched mains keep their zone, relabeled mains replace theirs, in the order of the current mains
+    untouched = previous.loc[previous.index.isin(ids[~keep])].assign(zones=spans.groupby(level=0).agg(";".join))
+    relabeled = main_zones(network, seg_zone, names).set_index("id")
+    updated = pd.concat([untouched[["zone", "zones"]], relabeled])
+    updated = updated.reindex(ids[ids.isin(updated.index)])
+    return {
+        "main_zones": updated.rename_axis("id").reset_index(),
+        "zones": zone_geometries(network, seg_zone, names),
+        "removed": sorted(touched),
+    }
+
+
+def write_zones_geojson(path: str, zones: list):
+    """
+    Writes the zone geometries to a GeoJSON file with a zone property
+
+    :param path: str: Output GeoJSON path
+    :param zones: list: (zone name, parts) for every zone
+    """
+    features = [
+        {
+            "type": "Feature",
+            "properties": {"zone": name},
+            "geometry": {"type": "MultiLineString", "coordinates": [part.tolist() for part in parts]},
+        }
+        for name, parts in zones
+    ]
+    with open(path, "w") as file:
+        json.dump({"type": "FeatureCollection", "features": features}, file)
+
+
+def write_zones_featureclass(workspace: str, iso_zone_fc: str, zones: list, spatial_ref):
+    """
+    Creates the IsoZone polyline feature class with a zone text field and inserts every zone
+
+    :param workspace: str: Workspace to create the feature class in
+    :param iso_zone_fc: str: Name of the feature class
+    :param zones: list: (zone name, parts) for every zone
+    :param spatial_ref: arcpy.SpatialReference: Spatial reference of the water mains
+    """
+    import arcpy
+
+    arcpy.CreateFeatureclass_management(workspace, iso_zone_fc, "POLYLINE", spatial_reference=spatial_ref)
+    arcpy.AddField_management(iso_zone_fc, "zone", "TEXT")
+    with arcpy.da.InsertCursor(iso_zone_fc, ["SHAPE@", "zone"]) as cursor:
+        for name, parts in zones:
+            array = arcpy.Array([arcpy.Array([arcpy.Point(x, y) for x, y in part]) for part in parts])
+            cursor.insertRow([arcpy.Polyline(array, spatial_ref), name])
+
+
+def update_zones_geojson(path: str, removed, zones: list):
+    """
+    Replaces the removed zones in an IsoZone GeoJSON file with the relabeled zones
+
+    :param path: str: IsoZone GeoJSON path
+    :param removed: Names of the zones to remove
+    :param zones: list: (zone name, parts) for every relabeled zone
+    """
+    with open(path, "r") as file:
+        collection = json.load(file)
+    removed = set(removed)
+    features = [feature for feature in collection["features"] if feature["properties"].get("zone") not in removed]
+    features.extend(
+        {
+            "type": "Feature",
+            "properties": {"zone": name},
+            "geometry": {"type": "MultiLineString", "coordinates": [part.tolist() for part in parts]},
+        }
+        for name, parts in zones
+    )
+    with open(path, "w") as file:
+        json.dump({"type": "FeatureCollection", "features": features}, file)
+
+
+def update_zones_featureclass(iso_zone_fc: str, removed, zones: list, spatial_ref):
+    """
+    Replaces the removed zones in the IsoZone feature class with the relabeled zones
+
+    :param iso_zone_fc: str: IsoZone feature class
+    :param removed: Names of the zones to remove
+    :param zones: list: (zone name, parts) for every relabeled zone
+    :param spatial_ref: arcpy.SpatialReference: Spatial reference of the water mains
+    """
+    import arcpy
+
+    removed = set(removed)
+    with arcpy.da.UpdateCursor(iso_zone_fc, ["zone"]) as cursor:
+        for (zone,) in cursor:
+            if zone in removed:
+                cursor.deleteRow()
+    with arcpy.da.InsertCursor(iso_zone_fc, ["SHAPE@", "zone"]) as cursor:
+        for name, parts in zones:
+            array = arcpy.Array([arcpy.Array([arcpy.Point(x, y) for x, y in part]) for part in parts])
+            cursor.insertRow([arcpy.Polyline(array, spatial_ref), name])
+
+
+if __name__ == "__main__":
+    # Local mode that runs on GeoJSON files without a trace network
+    parser = argparse.ArgumentParser(description="Find water main isolation zones from local GeoJSON files")
+    parser.add_argument("mains", help="GeoJSON file of water mains")
+    parser.add_argument("valves", help="GeoJSON file of water valves")
+    parser.add_argument("output", help="GeoJSON file to write the IsoZone lines to")
+    parser.add_argument("--id-field", default=None, help="Water main unique id property")
+    parser.add_argument("--main-zones", default=None, help="CSV file to write the zone of each main to")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Snapping tolerance in map units")
+    parser.add_argument("--changed-mains", nargs="*", default=None, help="Ids of edited mains, updates the zones in place")
+    parser.add_argument("--changed-valves", default=None, help="GeoJSON file of the old and new locations of edited valves")
+    parser.add_argument("--criticality", default=None, help="CSV file to write the zones every valve would merge to")
+    parser.add_argument("--laterals", default=None, help="GeoJSON file of laterals, counts the laterals of the merges")
+    args = parser.parse_args()
+
+    lines = read_lines_geojson(args.mains, args.id_field)
+    valve_xy = read_points_geojson(args.valves)
+    if args.changed_mains is not None or args.changed_valves:
+        # Incremental mode: relabel only the zones the edits touch and update the output and main zones in place
+        lines["ids"] = lines["ids"].astype(str)
+        previous_zones = pd.read_csv(args.main_zones, dtype={"id": str})
+        changed_valve_xy = read_points_geojson(args.changed_valves) if args.changed_valves else None
+        result = update_isolation_zones(
+            lines, valve_xy, previous_zones, args.changed_mains or (), changed_valve_xy, args.tolerance
+        )
+        update_zones_geojson(args.output, result["removed"], result["zones"])
+    else:
+        result = find_isolation_zones(lines, valve_xy, args.tolerance)
+        write_zones_geojson(args.output, result["zones"])
+        if args.criticality:
+            zone_laterals = None
+            if args.laterals:
+                from ServiceConnections import lateral_mains
+
+                lateral_main = lateral_mains(line_geometries(read_lines_geojson(args.laterals)), line_geometries(lines))
+                zone_laterals = zone_lateral_counts(result["network"], result["seg_zone"], lateral_main)
+            valve_criticality(
+                result["network"], result["seg_zone"], valve_xy, zone_laterals, args.tolerance
+            ).to_csv(args.criticality, index=False)
+    if args.main_zones:
+        result["main_zones"].to_csv(args.main_zones, index=False)
+    print(len(result["zones"]))
@@ -0,0 +1,54 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+
+def score_service_life(
+    water_main_df: pd.DataFrame, service_life_df: pd.DataFrame, install_date: str, material: str, year: int = None
+) -> pd.DataFrame:
+    """
+    Scores the age of every main against the service life of its material, from 1 to 10
+
+    :param water_main_df: pd.DataFrame: Water mains with the install date and material fields
+    :param service_life_df: pd.DataFrame: Material and Service Life columns
+    :param install_date: str: Install date field
+    :param material: str: Material field
+    :param year: int: Year to take the age in, the current year when not given
+    :return: pd.DataFrame: Copy of the mains with the Age, Material, Service Life and Service Life Score columns
+    """
+    # copy the water main dataframe add rows for age, service life, and lof then calculate lof as age/service life
+    WM_sl_Calc_df = water_main_df.copy()
+    WM_sl_Calc_df['Age'] = (year or datetime.now().year) - WM_sl_Calc_df[install_date].dt.year
+    WM_sl_Calc_df = WM_sl_Calc_df.merge(service_life_df, left_on=material, right_on='Material', how='left')
+    WM_sl_Calc_df['Service Life Score'] = WM_sl_Calc_df['Age'] / WM_sl_Calc_df['Service Life'] * 10
+
+    # round the Service life score and adjusted service life score values to the next whole number
+    WM_sl_Calc_df['Service Life Score'] = np.ceil(WM_sl_Calc_df['Service Life Score'])
+
+    # if the service life score value is greater than 10, set it to 10
+    WM_sl_Calc_df.loc[WM_sl_Calc_df['Service Life Score'] > 10, 'Service Life Score'] = 10
+
+    # if the service life score is less than or equal to 0 set it to 1
+    WM_sl_Calc_df.loc[WM_sl_Calc_df['Service Life Score'] <= 0, 'Service Life Score'] = 1
+    return WM_sl_Calc_df
+
+
+def calculate_lof(LOF_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Calculates the LOF of every main from its service life score and, when there is one, its breaks score
+
+    Mains missing any value are dropped first.
+
+    :param LOF_df: pd.DataFrame: Mains with the Service Life Score column and optionally the Breaks_score column
+    :return: pd.DataFrame: The mains with a value in every column and the LOF column added
+    """
+    # drop missing values again
+    LOF_df = LOF_df.dropna()
+    # calculate the LOF as (Service Life Score x 0.50) + (Breaks Score x 0.50) if Breaks_score column exists
+    if 'Breaks_score' in LOF_df.columns:
+        LOF_df.loc[:, 'LOF'] = (LOF_df['Service Life Score'] * 0.5) + (LOF_df['Breaks_score'] * 0.5)
+    else:
+        LOF_df.loc[:, 'LOF'] = LOF_df['Service Life Score']
+    LOF_df.loc[:, 'LOF'] = np.ceil(LOF_df['LOF'])
+    return LOF_df
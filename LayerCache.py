@@ -0,0 +1,239 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime, timezone
+
+from FeatureExtractor import (
+    DEFAULT_MAX_WORKERS, DEFAULT_PAGE_SIZE, BoundedSession, _request, extract_layers, fetch_ids
+)
+from Instrumentation import span, tool
+
+# A cached layer is an Esri JSON feature set (the same file extract_layers writes) next to a small metadata file with
+# the edit state of the layer when it was cached. On the next run only the edit state is queried, unchanged layers are
+# used as they are and changed layers only download the features added or edited since they were cached.
+
+
+def _cache_key(url: str, out_sr: int = None) -> str:
+    # The same layer projected to another spatial reference is a separate cache entry
+    return hashlib.sha1(f"{url.rstrip('/')}|{out_sr}".encode()).hexdigest()[:16]
+
+
+def _read_meta(path: str):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_json(path: str, data: dict):
+    # Write next to the target and swap it in so an interrupted run never leaves a half written cache behind
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+
+def get_edit_state(session, url: str) -> dict:
+    """
+    Queries the edit state of a layer: the last edit date, the edit date field and the largest OBJECTID and count
+
+    :param session: requests.Session: Session to send the requests with
+    :param url: str: Feature service layer url
+    :return: dict: Edit state of the layer
+    """
+    info = _request(session, url, {"f": "json"})
+    oid_field = info.get("objectIdField") or "OBJECTID"
+    statistics = [
+        {"statisticType": "max", "onStatisticField": oid_field, "outStatisticFieldName": "max_oid"},
+        {"statisticType": "count", "onStatisticField": oid_field, "outStatisticFieldName": "feature_count"},
+    ]
+    result = _request(
+        session, url + "/query", {"where": "1=1", "outStatistics": json.dumps(statistics), "f": "json"}
+    )
+    attributes = (result.get("features") or [{"attributes": {}}])[0]["attributes"]
+    return {
+        "last_edit_date": (info.get("editingInfo") or {}).get("lastEditDate"),
+        "edit_date_field": (info.get("editFieldsInfo") or {}).get("editDateField"),
+        "oid_field": oid_field,
+        "max_oid": attributes.get("max_oid"),
+        "count": attributes.get("feature_count") or 0,
+        "max_record_count": info.get("maxRecordCount"),
+    }
+
+
+def is_unchanged(cached: dict, state: dict) -> bool:
+    """
+    Checks if a layer has not been edited since it was cached
+
+    :param cached: dict: Edit state stored with the cached layer
+    :param state: dict: Current edit state from get_edit_state
+    :return: bool: True when the cached layer can be used as it is
+    """
+    if cached is None:
+        return False
+    # Layers without edit tracking have no last edit date, the largest OBJECTID and count are all there is to go by
+    return all(cached.get(key) == state[key] for key in ("last_edit_date", "max_oid", "count"))
+
+
+def _edited_since(edit_date_field: str, last_edit_date: int) -> str:
+    # Edit dates are epoch milliseconds, the where clause compares to a UTC timestamp truncated to the second so
+    # features edited in the same second as the cached edit are fetched again rather than missed
+    timestamp = datetime.fromtimestamp(last_edit_date / 1000, tz=timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    return f"{edit_date_field} >= TIMESTAMP '{timestamp}'"
+
+
+def _fetch_delta(session, url: str, cached_path: str, cached: dict, state: dict, out_sr, page_size, pool):
+    # Find which features were added, edited or deleted since the layer was cached and fetch only those
+    ids = _request(session, url + "/query", {"where": "1=1", "returnIdsOnly": "true", "f": "json"})
+    current_ids = set(ids.get("objectIds") or [])
+    edited = _request(
+        session,
+        url + "/query",
+        {"where": _edited_since(state["edit_date_field"], cached["last_edit_date"]), "returnIdsOnly": "true", "f": "json"},
+    )
+
+    with open(cached_path) as f:
+        feature_set = json.load(f)
+    oid_field = state["oid_field"]
+    features = {feature["attributes"][oid_field]: feature for feature in feature_set["features"]}
+    fetch = sorted((current_ids - features.keys()) | (set(edited.get("objectIds") or []) & current_ids))
+
+    page_size = min(page_size, state["max_record_count"] or page_size)
+    pages = [fetch[start:start + page_size] for start in range(0, len(fetch), page_size)]
+    for page in pool.map(lambda page: fetch_ids(session, url, page, out_sr), pages):
+        for feature in page:
+            features[feature["attributes"][oid_field]] = feature
+
+    # Deleted features are the cached ones that are no longer in the layer
+    feature_set["features"] = [features[oid] for oid in sorted(features) if oid in current_ids]
+    _write_json(cached_path, feature_set)
+    return len(fetch)
+
+
+def sync_layer(
+    session,
+    url: str,
+    cache_folder: str,
+    out_sr: int = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    pool: ThreadPoolExecutor = None,
+) -> str:
+    """
+    Brings the cached copy of a layer up to date with the feature service
+
+    Unchanged layers are used from the cache. Layers with an edit date field only download the features added or
+    edited since they were cached and drop the deleted ones, other changed layers are downloaded again.
+
+    :param session: requests.Session: Session from get_session to send every request with
+    :param url: str: Feature service layer url
+    :param cache_folder: str: Folder that keeps the cached layers between runs
+    :param out_sr: int: WKID to project the geometry to, the layer's own spatial reference when not given
+    :param page_size: int: Largest number of features per page
+    :param max_workers: int: Largest number of requests in flight at once
+    :param pool: ThreadPoolExecutor: Pool to fetch the pages on, shared with other layers, a pool of max_workers is
+        made when not given
+    :return: str: Path of the up to date Esri JSON file of the layer
+    """
+    os.makedirs(cache_folder, exist_ok=True)
+    key = _cache_key(url, out_sr)
+    cached_path = os.path.join(cache_folder, key + ".json")
+    meta_path = os.path.join(cache_folder, key + ".meta.json")
+
+    state = get_edit_state(session, url)
+    cached = _read_meta(meta_path) if os.path.exists(cached_path) else None
+    if is_unchanged(cached, state):
+        return cached_path
+
+    with (ThreadPoolExecutor(max_workers=max_workers) if pool is None else nullcontext(pool)) as pool:
+        if cached is not None and state["edit_date_field"] and cached.get("last_edit_date") is not None:
+            _fetch_delta(session, url, cached_path, cached, state, out_sr, page_size, pool)
+        else:
+            # Drop the old edit state first, a download that does not finish must not be taken for an up to date cache
+            if os.path.exists(meta_path):
+                os.remove(meta_path)
+            extract_layers([(key, url)], cache_folder, session, page_size=page_size, out_sr=out_sr, pool=pool)
+
+    _write_json(meta_path, {"url": url, "out_sr": out_sr, **state})
+    return cached_path
+
+
+def layer_state(path: str) -> dict:
+    """
+    Reads the edit state stored with a cached layer, it changes whenever the cached features change
+
+    :param path: str: Path of the cached layer from sync_layer
+    :return: dict: Url, spatial reference, last edit date, largest OBJECTID and count of the cached layer
+    """
+    meta = _read_meta(path[:-len(".json")] + ".meta.json") or {}
+    return {key: meta.get(key) for key in ("url", "out_sr", "last_edit_date", "max_oid", "count")}
+
+
+def sync_layers(
+    feature_services,
+    cache_folder: str,
+    session,
+    out_sr: int = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+) -> dict:
+    """
+    Brings the cached copy of every layer up to date with sync_layer
+
+    :param feature_services: list: (name, url) of every layer
+    :param cache_folder: str: Folder that keeps the cached layers between runs
+    :param session: requests.Session: Session from get_session to send every request with
+    :param out_sr: int: WKID to project the geometry to, each layer's own spatial reference when not given
+    :param page_size: int: Largest number of features per page
+    :param max_workers: int: Largest number of requests in flight at once
+    :return: dict: Layer name to the path of its file
+    """
+    # Every layer is checked and synced at once and the pages of all layers are fetched on one shared pool, the session
+    # lets no more than max_workers requests be in flight at once across both pools
+    session = BoundedSession(session, max_workers)
+    with span("sync_layers", len(feature_services)) as record:
+        with ThreadPoolExecutor(max_workers=max_workers) as layer_pool, \
+                ThreadPoolExecutor(max_workers=max_workers) as page_pool:
+            futures = {
+                name: layer_pool.submit(
+                    sync_layer, session, url, cache_folder, out_sr, page_size, max_workers, page_pool
+                )
+                for name, url in feature_services
+            }
+            paths = {name: future.result() for name, future in futures.items()}
+        record["rows_out"] = sum(layer_state(path)["count"] or 0 for path in paths.values())
+    return paths
+
+
+def sync_to_workspace(feature_services, cache_folder: str, session, out_sr: int = None, **kwargs) -> dict:
+    """
+    Brings the cached layers up to date with sync_layers and loads each one into the arcpy workspace
+
+    :param feature_services: list: (name, url) of every layer, the name is used for the feature class
+    :param cache_folder: str: Folder that keeps the cached layers between runs
+    :param session: requests.Session: Session from get_session to send every request with
+    :param out_sr: int: WKID to project the geometry to
+    :return: dict: Layer name to the path of its file
+    """
+    import arcpy
+
+    paths = sync_layers(feature_services, cache_folder, session, out_sr=out_sr, **kwargs)
+    for name, path in paths.items():
+        tool(arcpy.conversion.JSONToFeatures, in_json_file=path, out_features=name)
+    return paths
+
+
+def load_to_workspace(paths: dict, names=None):
+    """
+    Loads cached layers into the arcpy workspace as they are needed, skipping the ones already loaded
+
+    :param paths: dict: Layer name to the path of its file from sync_layers
+    :param names: list: Layers to load, every layer when not given
+    """
+    import arcpy
+
+    for name in names or paths:
+        if not arcpy.Exists(name):
+            tool(arcpy.conversion.JSONToFeatures, in_json_file=paths[name], out_features=name)
@@ -0,0 +1,153 @@
+import numpy as np
+import pandas as pd
+import shapely
+
+from GeometryIO import geometries, read_layer
+
+# Same search radius the near tables used, in the units of the coordinate system (feet)
+DEFAULT_SEARCH_RADIUS = 10000
+
+
+def read_geometries_featureclass(feature_class: str):
+    """
+    Reads the OBJECTIDs and geometries of a layer once through GeometryIO
+
+    :param feature_class: str: Path or name of the feature class, or path of an Esri JSON, GeoJSON or GeoParquet file
+    :return: tuple: (np.ndarray of OBJECTIDs, np.ndarray of shapely geometries)
+    """
+    layer = read_layer(feature_class)
+    return layer["ids"], geometries(layer)
+
+
+def read_classed_geometries_featureclass(feature_class: str, class_field: str):
+    """
+    Reads the class and geometry of every feature of a layer once through GeometryIO
+
+    :param feature_class: str: Path or name of the feature class, or path of an Esri JSON, GeoJSON or GeoParquet file
+    :param class_field: str: Field with the class of every feature, e.g. the road type
+    :return: tuple: (np.ndarray of classes, np.ndarray of shapely geometries)
+    """
+    layer = read_layer(feature_class)
+    return layer["attributes"][class_field].to_numpy(dtype=object), geometries(layer)
+
+
+def nearest_distance_by_class(
+    geometries, near_geometries, near_classes, classes, search_radius: float = DEFAULT_SEARCH_RADIUS
+) -> np.ndarray:
+    """
+    Finds the distance from every geometry to the nearest geometry of every class of a layer read once
+
+    The layer is split by class code and every class gets its own STR-tree and one nearest query within the search
+    radius, so a class that is missing or far away costs no more than one that is near.
+
+    :param geometries: array-like: Shapely geometries to measure from
+    :param near_geometries: array-like: Shapely geometries of the near layer
+    :param near_classes: array-like: Class of every near geometry
+    :param classes: list: Classes to measure the distance to, features of other classes are left out
+    :param search_radius: float: Largest distance to search, in map units
+    :return: np.ndarray: (geometries x classes) distances, NaN when no feature of the class is within the search radius
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    distances = np.full((len(geometries), len(classes)), np.nan)
+    codes = pd.Index(list(classes)).get_indexer(pd.Series(near_classes, dtype=object))
+    near_geometries = np.asarray(near_geometries, dtype=object)
+    for code in range(len(classes)):
+        distances[:, code] = nearest_distance(geometries, near_geometries[codes == code], search_radius)
+    return distances
+
+
+def nearest_distance(geometries, near_geometries, search_radius: float = DEFAULT_SEARCH_RADIUS) -> np.ndarray:
+    """
+    Finds the distance from every geometry to the nearest geometry of another layer within a search radius
+
+    The near layer is bulk loaded into an STR-tree and all geometries are queried in one batch.
+
+    :param geometries: array-like: Shapely geometries to measure from
+    :param near_geometries: array-like: Shapely geometries of the near layer
+    :param search_radius: float: Largest distance to search, in map units
+    :return: np.ndarray: Distance for every geometry, NaN when nothing is within the search radius
+    """
+    distances = np.full(len(geometries), np.nan)
+    if len(geometries) == 0 or len(near_geometries) == 0:
+        return distances
+    tree = shapely.STRtree(near_geometries)
+    (source, _), found = tree.query_nearest(geometries, max_distance=search_radius, return_distance=True)
+    # Ties return every nearest geometry, they all have the same distance
+    distances[source] = found
+    return distances
+
+
+def near_distances(main_ids, main_geometries, near_layers: dict, search_radius: float = DEFAULT_SEARCH_RADIUS) -> pd.DataFrame:
+    """
+    Builds the wide near table of distances from every main to the nearest feature of each layer
+
+    :param main_ids: array-like: OBJECTID of every main
+    :param main_geometries: array-like: Shapely geometry of every main
+    :param near_layers: dict: Layer name to array of shapely geometries
+    :param search_radius: float: Largest distance to search, in map units
+    :return: pd.DataFrame: IN_FID column and one distance column per layer, NaN beyond the search radius
+    """
+    main_geometries = np.asarray(main_geometries, dtype=object)
+    near_results_df = pd.DataFrame({"IN_FID": np.asarray(main_ids)})
+    for name, near_geometries in near_layers.items():
+        near_results_df[name] = nearest_distance(main_geometries, np.asarray(near_geometries, dtype=object), search_radius)
+    return near_results_df
+
+
+def class_distances(
+    main_geometries, near_geometries, near_classes, class_columns: dict, search_radius: float = DEFAULT_SEARCH_RADIUS
+) -> pd.DataFrame:
+    """
+    Builds the near table columns of every class of one layer, e.g. every road type of the roadway layer
+
+    :param main_geometries: array-like: Shapely geometry of every main
+    :param near_geometries: array-like: Shapely geometries of the near layer
+    :param near_classes: array-like: Class of every near geometry
+    :param class_columns: dict: Class value to the name of its distance column
+    :param search_radius: float: Largest distance to search, in map units
+    :return: pd.DataFrame: One distance column per class, NaN beyond the search radius
+    """
+    distances = nearest_distance_by_class(main_geometries, near_geometries, near_classes, list(class_columns), search_radius)
+    return pd.DataFrame(distances, columns=list(class_columns.values()))
+
+
+def near_table_featureclasses(
+    water_main: str, near_feature_classes, search_radius: float = DEFAULT_SEARCH_RADIUS, classed_layer: str = None,
+    class_field: str = None, class_columns: dict = None, tile_size: float = None, max_workers: int = None,
+) -> pd.DataFrame:
+    """
+    Reads the water mains and each near layer once and builds the wide near table in memory
+
+    A classed layer such as the roadway is read once with its class field and measured by class in one pass, its
+    class columns come before the other feature classes. With a tile size the mains are measured tile by tile in a
+    process pool, see Tiling, with the same result.
+
+    :param water_main: str: Water main feature class
+    :param near_feature_classes: list or dict: Feature classes to measure the distance to, or distance column name to
+        the feature class or layer file of each
+    :param search_radius: float: Largest distance to search, in map units
+    :param classed_layer: str: Feature class or layer file to measure the distance to every class of
+    :param class_field: str: Field with the class of every feature of the classed layer
+    :param class_columns: dict: Class value to the name of its distance column
+    :param tile_size: float: Side of the tiles in map units, the mains are measured in one pass when not given
+    :param max_workers: int: Tiles running at once
+    :return: pd.DataFrame: IN_FID column and one distance column per class and feature class
+    """
+    main_ids, main_geometries = read_geometries_featureclass(water_main)
+    if not isinstance(near_feature_classes, dict):
+        near_feature_classes = {fc: fc for fc in near_feature_classes}
+    near_layers = {column: read_geometries_featureclass(fc)[1] for column, fc in near_feature_classes.items()}
+    if tile_size:
+        from Tiling import tiled_near_distances
+
+        classed = None
+        if classed_layer:
+            near_classes, near_geometries = read_classed_geometries_featureclass(classed_layer, class_field)
+            classed = (near_geometries, near_classes, class_columns)
+        return tiled_near_distances(main_ids, main_geometries, near_layers, search_radius, classed, tile_size, max_workers)
+    near_results_df = near_distances(main_ids, main_geometries, near_layers, search_radius)
+    if classed_layer:
+        near_classes, near_geometries = read_classed_geometries_featureclass(classed_layer, class_field)
+        by_class = class_distances(main_geometries, near_geometries, near_classes, class_columns, search_radius)
+        near_results_df = pd.concat([near_results_df[["IN_FID"]], by_class, near_results_df.drop(columns="IN_FID")], axis=1)
+    return near_results_df
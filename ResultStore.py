@@ -0,0 +1,177 @@
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from Instrumentation import span
+
+
+def _arrow_schema(df: pd.DataFrame, schema: dict) -> pa.Schema:
+    # Use the declared type for every column in the schema and the inferred type for anything else
+    inferred = pa.Schema.from_pandas(df, preserve_index=False)
+    fields = []
+    for field in inferred:
+        if schema and field.name in schema:
+            fields.append(pa.field(field.name, schema[field.name]))
+        else:
+            fields.append(field)
+    return pa.schema(fields)
+
+
+def _as_strings(df: pd.DataFrame, schema: dict) -> pd.DataFrame:
+    # Columns declared as strings get the text of their values, e.g. a numeric unique id, missing values stay missing
+    converted = {}
+    for column in df.columns:
+        if not schema or column not in schema or not pa.types.is_string(schema[column]):
+            continue
+        series = df[column]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            if pd.api.types.infer_dtype(series.cat.categories, skipna=True) not in ("string", "empty"):
+                converted[column] = series.cat.rename_categories([str(value) for value in series.cat.categories])
+        elif pd.api.types.infer_dtype(series, skipna=True) not in ("string", "empty"):
+            values = series.astype(object)
+            converted[column] = values.where(values.isna(), values.astype(str))
+    return df.assign(**converted) if converted else df
+
+
+def result_paths(results_folder: str, names, export_csv: bool = False) -> list:
+    """
+    Paths of the files write_result writes for stage outputs, e.g. the declared outputs of a StageCache stage
+
+    :param results_folder: str: Folder of the result store
+    :param names: list: Names of the stage outputs
+    :param export_csv: bool: Include the CSV copies
+    :return: list: Path of every Parquet file and CSV copy
+    """
+    extensions = (".parquet", ".csv") if export_csv else (".parquet",)
+    return [os.path.join(results_folder, name + extension) for name in names for extension in extensions]
+
+
+def write_result(
+    df: pd.DataFrame, results_folder: str, name: str, schema: dict = None, export_csv: bool = False, sort_by: str = None
+) -> str:
+    """
+    Writes a stage output to the columnar result store as a Parquet file with an explicit schema
+
+    :param df: pd.DataFrame: Stage output
+    :param results_folder: str: Folder of the result store
+    :param name: str: Name of the stage output, e.g. "Final_COF"
+    :param schema: dict: Column name to pyarrow type for the columns with a declared type
+    :param export_csv: bool: Also write a CSV copy next to the Parquet file
+    :param sort_by: str: Column to sort the rows by, so the result can be merged in batches with read_result_batches
+    :return: str: Path of the Parquet file
+    """
+    with span(f"write_result {name}", len(df)):
+        # converted before sorting so numeric ids are sorted as the strings they are stored as
+        df = _as_strings(df, schema)
+        if sort_by:
+            # categorical columns are sorted by their values rather than the order of their categories
+            df = df.sort_values(
+                sort_by, kind="stable", na_position="last",
+                key=lambda column: column.astype(object) if isinstance(column.dtype, pd.CategoricalDtype) else column,
+            )
+        table = pa.Table.from_pandas(df, schema=_arrow_schema(df, schema), preserve_index=False)
+        output_path = os.path.join(results_folder, name + ".parquet")
+        pq.write_table(table, output_path)
+        if export_csv:
+            df.to_csv(os.path.join(results_folder, name + ".csv"), index=False)
+    return output_path
+
+
+def write_result_batches(
+    batches, results_folder: str, name: str, schema: dict = None, export_csv: bool = False
+) -> dict:
+    """
+    Writes a stage output to the result store batch by batch, only one batch is held in memory at a time
+
+    The file is written next to the result and swapped in when every batch is written.
+
+    :param batches: iterable: DataFrames with the same columns
+    :param results_folder: str: Folder of the result store
+    :param name: str: Name of the stage output, e.g. "Final_Risk"
+    :param schema: dict: Column name to pyarrow type for the columns with a declared type
+    :param export_csv: bool: Also write a CSV copy next to the Parquet file
+    :return: dict: path of the Parquet file and the number of rows written
+    """
+    output_path = os.path.join(results_folder, name + ".parquet")
+    csv_path = os.path.join(results_folder, name + ".csv")
+    writer = None
+    empty = None
+    rows = 0
+    with span(f"write_result_batches {name}") as record:
+        try:
+            for df in batches:
+                df = _as_strings(df, schema)
+                if len(df) == 0:
+                    # the types of an empty batch can not be inferred, it is only written when every batch is empty
+                    empty = df if empty is None else empty
+                    continue
+                if writer is None:
+                    # the types of the first batch are used for every batch
+                    arrow_schema = _arrow_schema(df, schema)
+                    writer = pq.ParquetWriter(output_path + ".tmp", arrow_schema)
+                writer.write_table(pa.Table.from_pandas(df, schema=arrow_schema, preserve_index=False))
+                if export_csv:
+                    df.to_csv(csv_path + ".tmp", index=False, mode="w" if rows == 0 else "a", header=rows == 0)
+                rows += len(df)
+        finally:
+            if writer is not None:
+                writer.close()
+        if writer is None:
+            if empty is None:
+                raise ValueError(f"No batches to write to {name}")
+            write_result(empty, results_folder, name, schema, export_csv)
+        else:
+            os.replace(output_path + ".tmp", output_path)
+            if export_csv:
+                os.replace(csv_path + ".tmp", csv_path)
+        record["rows_out"] = rows
+    return {"path": output_path, "rows": rows}
+
+
+def read_result_batches(results_folder: str, name: str, columns=None, batch_size: int = 100000):
+    """
+    Reads a stage output from the result store in batches of rows, in the order they were written
+
+    :param results_folder: str: Folder of the result store
+    :param name: str: Name of the stage output, e.g. "Final_COF"
+    :param columns: list: Columns to read, all columns when not given
+    :param batch_size: int: Largest number of rows per batch
+    :return: iterator: DataFrame of every batch
+    """
+    parquet_file = pq.ParquetFile(os.path.join(results_folder, name + ".parquet"), memory_map=True)
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+        yield batch.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def read_result(results_folder: str, name: str, columns=None, schema: dict = None) -> pd.DataFrame:
+    """
+    Reads a stage output from the result store, only loading the columns asked for
+
+    The Parquet file is memory mapped so the columns are read straight from the file. Results written before the
+    store existed are read from their CSV with the declared types.
+
+    :param results_folder: str: Folder of the result store
+    :param name: str: Name of the stage output, e.g. "Final_COF"
+    :param columns: list: Columns to read, all columns when not given
+    :param schema: dict: Column name to pyarrow type, only used for the CSV fallback
+    :return: pd.DataFrame: Stage output
+    """
+    parquet_path = os.path.join(results_folder, name + ".parquet")
+    if os.path.exists(parquet_path):
+        with span(f"read_result {name}") as record:
+            table = pq.read_table(parquet_path, columns=columns, memory_map=True)
+            record["rows_out"] = table.num_rows
+            return table.to_pandas(split_blocks=True, self_destruct=True)
+
+    csv_path = os.path.join(results_folder, name + ".csv")
+    schema = schema or {}
+    header = pd.read_csv(csv_path, nrows=0).columns
+    wanted = [column for column in (columns or header) if column in schema]
+    string_columns = {column: str for column in wanted if pa.types.is_string(schema[column])}
+    date_columns = [column for column in wanted if pa.types.is_timestamp(schema[column])]
+    df = pd.read_csv(csv_path, usecols=columns, dtype=string_columns, parse_dates=date_columns)
+    if schema:
+        table = pa.Table.from_pandas(df, schema=_arrow_schema(df, schema), preserve_index=False)
+        df = table.to_pandas()
+    return df
@@ -0,0 +1,287 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+# Explicit schemas for the output of each stage
+# Field names that change between cities are passed in, any column a stage adds that is not listed here keeps the
+# type pyarrow infers for it.
+#
+# The stages keep their DataFrames in the compact dtypes of the *_dtypes functions while they work, enforced with
+# enforce_dtypes: scores in uint8, counts in uint32, distances and other measures in float32, and material, zone,
+# connection status and the unique id as categoricals, which store every value once and an integer code per row. The
+# result store files keep the types of the schemas.
+
+# Compact dtype of a score column, uint8 when every score is a whole number that fits, float32 when some are missing
+SCORE = "score"
+# Compact dtype of a count column, uint32 when every count is a whole number that fits, float32 when some are missing
+COUNT = "count"
+MEASURE = "float32"
+CATEGORY = "category"
+
+# Score columns added by the COF scoring
+COF_SCORE_COLUMNS = [
+    'DIAMETER_score',
+    'Railroad_score',
+    'Roadway_score',
+    'Buildings_score',
+    'affected_lats_score',
+    'WaterBodies_score',
+    'medical_score',
+    'school_childcare_score',
+    'critical_cust_score',
+]
+
+
+def breaks_schema(unique_id: str) -> dict:
+    """
+    Schema of the per main break counts written by the LOF stage
+
+    :param unique_id: str: Water main unique id field
+    :return: dict: Column name to pyarrow type
+    """
+    return {
+        unique_id: pa.string(),
+        'Breaks': pa.int64(),
+        'Breaks_score': pa.int64(),
+        'Break_Rate': pa.float64(),
+    }
+
+
+def lof_schema(unique_id: str, install_date: str, material: str) -> dict:
+    """
+    Schema of the Final_LOF output
+
+    :param unique_id: str: Water main unique id field
+    :param install_date: str: Install date field
+    :param material: str: Material field
+    :return: dict: Column name to pyarrow type
+    """
+    return {
+        unique_id: pa.string(),
+        install_date: pa.timestamp('us'),
+        material: pa.string(),
+        'Age': pa.float64(),
+        'Material': pa.string(),
+        'Service Life': pa.float64(),
+        'Service Life Score': pa.float64(),
+        # the same types as in Breaks, null for the mains without breaks
+        'Breaks': pa.int64(),
+        'Breaks_score': pa.int64(),
+        'Break_Rate': pa.float64(),
+        'LOF': pa.float64(),
+    }
+
+
+def near_results_schema(unique_id: str, install_date: str, material: str, near_columns) -> dict:
+    """
+    Schema of the NearResults output, the water main attributes with a distance column per near layer
+
+    :param unique_id: str: Water main unique id field
+    :param install_date: str: Install date field
+    :param material: str: Material field
+    :param near_columns: list: Names of the near distance columns
+    :return: dict: Column name to pyarrow type
+    """
+    schema = {
+        'OBJECTID': pa.int64(),
+        unique_id: pa.string(),
+        install_date: pa.timestamp('us'),
+        material: pa.string(),
+        'LENGTH': pa.float64(),
+    }
+    schema.update({column: pa.float64() for column in near_columns})
+    return schema
+
+
+def cof_schema(unique_id: str, install_date: str, material: str, near_columns, connection_columns) -> dict:
+    """
+    Schema of the Final_COF output
+
+    :param unique_id: str: Water main unique id field
+    :param install_date: str: Install date field
+    :param material: str: Material field
+    :param near_columns: list: Names of the near distance columns
+    :param connection_columns: list: Names of the critical customer connection columns
+    :return: dict: Column name to pyarrow type
+    """
+    schema = near_results_schema(unique_id, install_date, material, near_columns)
+    schema.update({'zone': pa.string(), 'affected_lats': pa.float64()})
+    schema.update({column: pa.string() for column in connection_columns})
+    schema.update({column: pa.float64() for column in COF_SCORE_COLUMNS})
+    schema['COF'] = pa.int64()
+    return schema
+
+
+def risk_schema(unique_id: str) -> dict:
+    """
+    Schema of the Final_Risk output
+
+    :param unique_id: str: Water main unique id field
+    :return: dict: Column name to pyarrow type
+    """
+    return {
+        unique_id: pa.string(),
+        'COF': pa.int64(),
+        'LOF': pa.float64(),
+        'COF_normalized': pa.int64(),
+        'LOF_normalized': pa.int64(),
+        'RISK': pa.int64(),
+    }
+
+
+def risk_matrix_schema(length_column: str) -> dict:
+    """
+    Schema of the RiskMatrix output, the length and number of mains in every LOF x COF cell
+
+    :param length_column: str: Name of the length column
+    :return: dict: Column name to pyarrow type
+    """
+    return {
+        'LOF': pa.int64(),
+        'COF': pa.int64(),
+        length_column: pa.float64(),
+        'Count': pa.int64(),
+    }
+
+
+def sensitivity_schema(unique_id: str) -> dict:
+    """
+    Schema of the COFSensitivity output, the COF, COF rank and risk rank of every main under the default weights with
+    their smallest and largest value over the weight scenarios, missing for mains with a missing score
+
+    :param unique_id: str: Water main unique id field
+    :return: dict: Column name to pyarrow type
+    """
+    schema = {unique_id: pa.string()}
+    for measure in ('COF', 'COF_rank', 'Risk_rank'):
+        schema.update({measure + suffix: pa.float64() for suffix in ('', '_min', '_max')})
+        if measure != 'COF':
+            schema[measure + '_range'] = pa.float64()
+    return schema
+
+
+def _compact_whole(series: pd.Series, dtype) -> pd.Series:
+    # Unsigned integers when every value is a whole number in range, float32 otherwise so missing values stay NaN
+    values = pd.to_numeric(series, errors="coerce").to_numpy(dtype=float)
+    whole = ~np.isnan(values).any() and np.array_equal(values, np.round(values))
+    if whole and (len(values) == 0 or (values.min() >= 0 and values.max() <= np.iinfo(dtype).max)):
+        return pd.Series(values.astype(dtype), index=series.index)
+    return pd.Series(values.astype(np.float32), index=series.index)
+
+
+def enforce_dtypes(df: pd.DataFrame, dtypes: dict) -> pd.DataFrame:
+    """
+    Converts the columns of a stage DataFrame to their compact dtypes, columns that are not in the DataFrame are skipped
+
+    :param df: pd.DataFrame: Stage DataFrame
+    :param dtypes: dict: Column name to SCORE, COUNT, MEASURE or CATEGORY, from a *_dtypes function
+    :return: pd.DataFrame: The DataFrame with the columns converted
+    """
+    for column, dtype in dtypes.items():
+        if column not in df.columns:
+            continue
+        if dtype == SCORE:
+            df[column] = _compact_whole(df[column], np.uint8)
+        elif dtype == COUNT:
+            df[column] = _compact_whole(df[column], np.uint32)
+        elif dtype == CATEGORY:
+            if not isinstance(df[column].dtype, pd.CategoricalDtype):
+                df[column] = df[column].astype(CATEGORY)
+        else:
+            df[column] = pd.to_numeric(df[column], errors="coerce").astype(dtype)
+    return df
+
+
+def near_results_dtypes(unique_id: str, material: str, near_columns) -> dict:
+    """
+    Compact dtypes of the NearResults DataFrame
+
+    :param unique_id: str: Water main unique id field
+    :param material: str: Material field
+    :param near_columns: list: Names of the near distance columns
+    :return: dict: Column name to compact dtype
+    """
+    dtypes = {unique_id: CATEGORY, material: CATEGORY, 'LENGTH': MEASURE}
+    dtypes.update({column: MEASURE for column in near_columns})
+    return dtypes
+
+
+def zone_dtypes(unique_id: str) -> dict:
+    """
+    Compact dtypes of the isolation zone and affected laterals of every main
+
+    :param unique_id: str: Water main unique id field
+    :return: dict: Column name to compact dtype
+    """
+    return {unique_id: CATEGORY, 'zone': CATEGORY, 'affected_lats': COUNT}
+
+
+def connection_dtypes(unique_id: str, connection_columns) -> dict:
+    """
+    Compact dtypes of the critical customer connection status of every main
+
+    :param unique_id: str: Water main unique id field
+    :param connection_columns: list: Names of the critical customer connection columns
+    :return: dict: Column name to compact dtype
+    """
+    dtypes = {unique_id: CATEGORY}
+    dtypes.update({column: CATEGORY for column in connection_columns})
+    return dtypes
+
+
+def cof_dtypes(unique_id: str, material: str, near_columns, connection_columns) -> dict:
+    """
+    Compact dtypes of the COF scoring DataFrame
+
+    :param unique_id: str: Water main unique id field
+    :param material: str: Material field
+    :param near_columns: list: Names of the near distance columns
+    :param connection_columns: list: Names of the critical customer connection columns
+    :return: dict: Column name to compact dtype
+    """
+    dtypes = near_results_dtypes(unique_id, material, near_columns)
+    dtypes.update(zone_dtypes(unique_id))
+    dtypes.update(connection_dtypes(unique_id, connection_columns))
+    dtypes.update({column: SCORE for column in COF_SCORE_COLUMNS})
+    dtypes['COF'] = SCORE
+    return dtypes
+
+
+def lof_dtypes(unique_id: str, material: str) -> dict:
+    """
+    Compact dtypes of the LOF scoring DataFrame
+
+    :param unique_id: str: Water main unique id field
+    :param material: str: Material field
+    :return: dict: Column name to compact dtype
+    """
+    return {
+        unique_id: CATEGORY,
+        material: CATEGORY,
+        'Material': CATEGORY,
+        'Age': MEASURE,
+        'Service Life': MEASURE,
+        'Service Life Score': SCORE,
+        'Breaks': COUNT,
+        'Breaks_score': SCORE,
+        'Break_Rate': MEASURE,
+        'LOF': SCORE,
+    }
+
+
+def risk_dtypes(unique_id: str) -> dict:
+    """
+    Compact dtypes of the risk DataFrame
+
+    :param unique_id: str: Water main unique id field
+    :return: dict: Column name to compact dtype
+    """
+    return {
+        unique_id: CATEGORY,
+        'COF': SCORE,
+        'LOF': SCORE,
+        'COF_normalized': SCORE,
+        'LOF_normalized': SCORE,
+        'RISK': SCORE,
+        'LENGTH': MEASURE,
+    }
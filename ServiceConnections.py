@@ -0,0 +1,194 @@
+import numpy as np
+import pandas as pd
+import shapely
+from scipy import sparse
+
+from GeometryIO import geometries, read_layer
+
+# Features closer than this touch, the default XY tolerance of 1 mm in feet
+DEFAULT_TOLERANCE = 0.0033
+# Laterals are drawn to their main, this only allows for small gaps in the drawing
+LATERAL_SEARCH_RADIUS = 10
+
+
+def _touching(tree_geometries, geometries, tolerance: float) -> sparse.csr_matrix:
+    # Sparse matrix of which geometries touch which tree geometries, one STR-tree query for all of them
+    tree = shapely.STRtree(tree_geometries)
+    source, target = tree.query(geometries, predicate="dwithin", distance=tolerance)
+    values = np.ones(len(source), dtype=np.int32)
+    return sparse.csr_matrix((values, (source, target)), shape=(len(geometries), len(tree_geometries)))
+
+
+def build_connection_index(parcel_geometries, lateral_geometries, main_geometries, tolerance: float = DEFAULT_TOLERANCE) -> dict:
+    """
+    Builds the parcel to main service connection index once for every critical customer category
+
+    A parcel is served by the mains touching the service lines of the parcel, the laterals touching the parcel and the
+    laterals touching those on the other side of the service.
+
+    :param parcel_geometries: array-like: Shapely geometry of every parcel
+    :param lateral_geometries: array-like: Shapely geometry of every lateral
+    :param main_geometries: array-like: Shapely geometry of every main
+    :param tolerance: float: Largest gap between features that still touch, in map units
+    :return: dict: STR-tree of the parcels and the sparse parcel by main connection matrix
+    """
+    parcel_geometries = np.asarray(parcel_geometries, dtype=object)
+    lateral_geometries = np.asarray(lateral_geometries, dtype=object)
+    main_geometries = np.asarray(main_geometries, dtype=object)
+
+    parcel_laterals = _touching(lateral_geometries, parcel_geometries, tolerance)
+    # Every lateral touches itself so the service keeps the laterals in the parcel
+    service_laterals = _touching(lateral_geometries, lateral_geometries, tolerance)
+    lateral_mains = _touching(main_geometries, lateral_geometries, tolerance)
+
+    parcel_mains = (parcel_laterals @ service_laterals).astype(bool).astype(np.int32) @ lateral_mains
+    return {
+        "parcel_tree": shapely.STRtree(parcel_geometries),
+        "parcel_mains": parcel_mains.astype(bool).tocsr(),
+        "tolerance": tolerance,
+    }
+
+
+def connected_mains(index: dict, customer_geometries) -> np.ndarray:
+    """
+    Finds the mains serving the parcels of a critical customer category with a point in parcel lookup
+
+    :param index: dict: Connection index from build_connection_index
+    :param customer_geometries: array-like: Shapely geometry of every critical customer
+    :return: np.ndarray: True for every main that serves a critical customer
+    """
+    parcel_mains = index["parcel_mains"]
+    customer_geometries = np.asarray(customer_geometries, dtype=object)
+    if len(customer_geometries) == 0:
+        return np.zeros(parcel_mains.shape[1], dtype=bool)
+    _, parcels = index["parcel_tree"].query(customer_geometries, predicate="dwithin", distance=index["tolerance"])
+    critical_parcels = np.zeros(parcel_mains.shape[0], dtype=bool)
+    critical_parcels[parcels] = True
+    return parcel_mains[critical_parcels].getnnz(axis=0) > 0
+
+
+def critical_connections(main_ids, index: dict, customer_layers: dict) -> pd.DataFrame:
+    """
+    Marks the mains serving each critical customer category as "Connected"
+
+    :param main_ids: array-like: Unique id of every main, in the order the index was built
+    :param index: dict: Connection index from build_connection_index
+    :param customer_layers: dict: Connection column name to array of shapely geometries of the category
+    :return: pd.DataFrame: One row per connected main id with a column per category, "Connected" or None
+    """
+    connections_df = pd.DataFrame({"main_id": np.asarray(main_ids)})
+    for column, customer_geometries in customer_layers.items():
+        connections_df[column] = np.where(connected_mains(index, customer_geometries), "Connected", None)
+    connected = connections_df[list(customer_layers)].notna().any(axis=1)
+    # A main id split into several features is connected when any of its features is
+    connections_df = connections_df[connected].groupby("main_id", sort=False).first()
+    return connections_df.reset_index()
+
+
+def critical_connections_featureclasses(
+    water_main_fc: str, unique_id: str, parcels_fc: str, laterals_fc: str, customer_feature_classes: dict,
+    tolerance: float = DEFAULT_TOLERANCE, tile_size: float = None, max_workers: int = None,
+) -> pd.DataFrame:
+    """
+    Reads the mains, parcels and laterals once and resolves every critical customer feature class against one
+    connection index
+
+    :param water_main_fc: str: Water main feature class or layer file
+    :param unique_id: str: Water main unique id field
+    :param parcels_fc: str: Parcels feature class or layer file
+    :param laterals_fc: str: Laterals feature class or layer file
+    :param customer_feature_classes: dict: Connection column name to critical customer feature class or layer file
+    :param tolerance: float: Largest gap between features that still touch, in map units
+    :param tile_size: float: Side of the tiles the index is built in, in map units, one pass when not given
+    :param max_workers: int: Tiles running at once
+    :return: pd.DataFrame: unique_id column and a column per category, "Connected" or None
+    """
+    from NearDistance import read_geometries_featureclass
+
+    mains = read_layer(water_main_fc, unique_id)
+    main_geometries = geometries(mains)
+    parcel_geometries = read_geometries_featureclass(parcels_fc)[1]
+    lateral_geometries = read_geometries_featureclass(laterals_fc)[1]
+    if tile_size:
+        from Tiling import tiled_connection_index
+
+        index = tiled_connection_index(
+            parcel_geometries, lateral_geometries, main_geometries, tolerance, tile_size, max_workers
+        )
+    else:
+        index = build_connection_index(parcel_geometries, lateral_geometries, main_geometries, tolerance)
+    customer_layers = {column: read_geometries_featureclass(fc)[1] for column, fc in customer_feature_classes.items()}
+    connections_df = critical_connections(mains["ids"], index, customer_layers)
+    return connections_df.rename(columns={"main_id": unique_id})
+
+
+def lateral_mains(lateral_geometries, main_geometries, search_radius: float = LATERAL_SEARCH_RADIUS) -> np.ndarray:
+    """
+    Assigns every lateral to the nearest main with one STR-tree query
+
+    A lateral equally near several mains, e.g. at the joint of two mains, goes to the first of them so the assignment
+    does not depend on the order of the tree.
+
+    :param lateral_geometries: array-like: Shapely geometry of every lateral
+    :param main_geometries: array-like: Shapely geometry of every main
+    :param search_radius: float: Largest distance from a lateral to its main, in map units
+    :return: np.ndarray: Index of the main of every lateral, -1 when no main is within the search radius
+    """
+    lateral_main = np.full(len(lateral_geometries), -1, dtype=np.int64)
+    if len(lateral_geometries) == 0 or len(main_geometries) == 0:
+        return lateral_main
+    tree = shapely.STRtree(np.asarray(main_geometries, dtype=object))
+    laterals, mains = tree.query_nearest(
+        np.asarray(lateral_geometries, dtype=object), max_distance=search_radius, all_matches=True
+    )
+    nearest = np.full(len(lateral_geometries), np.iinfo(np.int64).max)
+    np.minimum.at(nearest, laterals, mains)
+    lateral_main[laterals] = nearest[laterals]
+    return lateral_main
+
+
+def laterals_per_zone(lateral_main: np.ndarray, main_zones) -> pd.DataFrame:
+    """
+    Counts the laterals in every isolation zone through the zone of their main
+
+    :param lateral_main: np.ndarray: Index of the main of every lateral from lateral_mains, -1 for none
+    :param main_zones: array-like: Isolation zone name of every main, null when the main is in no zone
+    :return: pd.DataFrame: zone and FREQUENCY columns for every zone with laterals
+    """
+    zone_codes, zones = pd.factorize(pd.Series(main_zones, dtype=object))
+    lateral_zone = zone_codes[lateral_main[lateral_main >= 0]]
+    counts = np.bincount(lateral_zone[lateral_zone >= 0], minlength=len(zones))
+    has_laterals = counts > 0
+    return pd.DataFrame({"zone": np.asarray(zones, dtype=object)[has_laterals], "FREQUENCY": counts[has_laterals]})
+
+
+def laterals_per_zone_featureclasses(
+    water_main_fc: str, unique_id: str, laterals_fc: str, mains_zone_df: pd.DataFrame,
+    search_radius: float = LATERAL_SEARCH_RADIUS, tile_size: float = None, max_workers: int = None,
+) -> pd.DataFrame:
+    """
+    Reads the mains and laterals once and counts the laterals in every isolation zone
+
+    :param water_main_fc: str: Water main feature class or layer file
+    :param unique_id: str: Water main unique id field
+    :param laterals_fc: str: Laterals feature class or layer file
+    :param mains_zone_df: pd.DataFrame: unique_id and zone columns, the isolation zone of every main
+    :param search_radius: float: Largest distance from a lateral to its main, in map units
+    :param tile_size: float: Side of the tiles the laterals are assigned in, in map units, one pass when not given
+    :param max_workers: int: Tiles running at once
+    :return: pd.DataFrame: zone and FREQUENCY columns for every zone with laterals
+    """
+    from NearDistance import read_geometries_featureclass
+
+    mains = read_layer(water_main_fc, unique_id)
+    main_geometries = geometries(mains)
+    zone_by_id = mains_zone_df.drop_duplicates(unique_id).set_index(unique_id)["zone"]
+    main_zones = zone_by_id.reindex(mains["ids"]).to_numpy()
+    lateral_geometries = read_geometries_featureclass(laterals_fc)[1]
+    if tile_size:
+        from Tiling import tiled_lateral_mains
+
+        lateral_main = tiled_lateral_mains(lateral_geometries, main_geometries, search_radius, tile_size, max_workers)
+    else:
+        lateral_main = lateral_mains(lateral_geometries, main_geometries, search_radius)
+    return laterals_per_zone(lateral_main, main_zones)
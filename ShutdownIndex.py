@@ -0,0 +1,223 @@
+import argparse
+import json
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+import numpy as np
+import pandas as pd
+
+# The shutdown plan of a main is what a crew needs when it breaks: its isolation zone, the valves to close, the
+# laterals that lose service and the critical customers in the zone. The plans of every main are precomputed into a
+# folder of .npy arrays, sorted by main id so a lookup is one binary search, and every array is loaded memory-mapped so
+# opening the index reads nothing until a main is looked up.
+
+# Arrays of the index, each saved as {name}.npy in the index folder
+INDEX_ARRAYS = (
+    "ids", "main_zone", "zone_names", "zone_laterals", "zone_flags", "valve_offsets", "valves", "valve_ids", "valve_xy",
+)
+
+
+def zone_flags(main_zone: np.ndarray, connected: np.ndarray, zone_count: int) -> np.ndarray:
+    """
+    Marks every zone with a main serving a critical customer of each category
+
+    :param main_zone: np.ndarray: Zone number of every main, -1 for none
+    :param connected: np.ndarray: (mains x categories) True where the main serves a critical customer of the category
+    :param zone_count: int: Number of zones
+    :return: np.ndarray: (zones x categories) True where a main in the zone serves a critical customer
+    """
+    connected = np.asarray(connected, dtype=bool).reshape(len(main_zone), -1)
+    flags = np.zeros((zone_count, connected.shape[1]), dtype=bool)
+    in_zone = main_zone >= 0
+    np.logical_or.at(flags, main_zone[in_zone], connected[in_zone])
+    return flags
+
+
+def build_shutdown_index(
+    main_ids,
+    main_zone: np.ndarray,
+    zone_names,
+    boundary_valves: dict,
+    valve_xy: np.ndarray,
+    zone_laterals: np.ndarray,
+    flags: np.ndarray = None,
+    flag_names=(),
+    valve_ids=None,
+) -> dict:
+    """
+    Builds the shutdown plan index of every main
+
+    :param main_ids: array-like: Unique id of every main
+    :param main_zone: np.ndarray: Zone number of every main, -1 for none
+    :param zone_names: list: Name of every zone number
+    :param boundary_valves: dict: Valves on the boundary of every zone from IsolationZoneEngine.zone_boundary_valves
+    :param valve_xy: np.ndarray: (n x 2) valve coordinates
+    :param zone_laterals: np.ndarray: Number of laterals in every zone number
+    :param flags: np.ndarray: (zones x categories) critical customer flags of every zone from zone_flags
+    :param flag_names: list: Name of every critical customer category
+    :param valve_ids: array-like: Id of every valve, the valve position when not given
+    :return: dict: The index arrays and the flag names, mains sorted by id
+    """
+    ids = np.asarray(main_ids).astype(str)
+    order = np.argsort(ids, kind="stable")
+    zone_count = len(zone_names)
+    flags = np.zeros((zone_count, 0), dtype=bool) if flags is None else np.asarray(flags, dtype=bool)
+    valve_xy = np.asarray(valve_xy, dtype=float).reshape(-1, 2)
+    laterals = np.zeros(zone_count, dtype=np.int64)
+    laterals[:len(zone_laterals)] = zone_laterals
+    return {
+        # fixed width strings so the ids can be memory-mapped and searched
+        "ids": ids[order],
+        "main_zone": np.asarray(main_zone, dtype=np.int32)[order],
+        "zone_names": np.asarray(zone_names).astype(str),
+        "zone_laterals": laterals.astype(np.int32),
+        # one bit per critical customer category
+        "zone_flags": (flags * (1 << np.arange(flags.shape[1]))).sum(axis=1).astype(np.uint32),
+        "valve_offsets": np.asarray(boundary_valves["offsets"], dtype=np.int64),
+        "valves": np.asarray(boundary_valves["valves"], dtype=np.int32),
+        "valve_ids": (np.arange(len(valve_xy)) if valve_ids is None else np.asarray(valve_ids)).astype(str),
+        "valve_xy": valve_xy,
+        "flag_names": list(flag_names),
+    }
+
+
+def save_shutdown_index(index: dict, index_folder: str) -> str:
+    """
+    Saves the shutdown plan index as one .npy file per array and the flag names to flags.json
+
+    :param index: dict: Index from build_shutdown_index
+    :param index_folder: str: Folder to write the index to
+    :return: str: The index folder
+    """
+    os.makedirs(index_folder, exist_ok=True)
+    for name in INDEX_ARRAYS:
+        np.save(os.path.join(index_folder, name + ".npy"), index[name])
+    with open(os.path.join(index_folder, "flags.json"), "w") as file:
+        json.dump(index["flag_names"], file)
+    return index_folder
+
+
+def load_shutdown_index(index_folder: str, mmap: bool = True) -> dict:
+    """
+    Opens a saved shutdown plan index
+
+    :param index_folder: str: Folder of the index
+    :param mmap: bool: Memory-map the arrays instead of reading them
+    :return: dict: The index arrays and the flag names
+    """
+    index = {name: np.load(os.path.join(index_folder, name + ".npy"), mmap_mode="r" if mmap else None)
+             for name in INDEX_ARRAYS}
+    with open(os.path.join(index_folder, "flags.json"), "r") as file:
+        index["flag_names"] = json.load(file)
+    return index
+
+
+def lookup(index: dict, main_id) -> dict:
+    """
+    Looks up the shutdown plan of a main with one binary search
+
+    :param index: dict: Index from build_shutdown_index or load_shutdown_index
+    :param main_id: Unique id of the main
+    :return: dict: id, zone, the valves to close with their id and x, y, the laterals in the zone and the critical
+        customer categories in the zone, None when the main is not in the index
+    """
+    main_id = str(main_id)
+    ids = index["ids"]
+    position = int(np.searchsorted(ids, main_id))
+    if position >= len(ids) or ids[position] != main_id:
+        return None
+    zone = int(index["main_zone"][position])
+    if zone < 0:
+        return {"id": main_id, "zone": None, "valves": [], "laterals": 0, "critical": []}
+    start, end = index["valve_offsets"][zone], index["valve_offsets"][zone + 1]
+    valves = index["valves"][start:end]
+    flags = int(index["zone_flags"][zone])
+    return {
+        "id": main_id,
+        "zone": str(index["zone_names"][zone]),
+        "valves": [
+            {"id": str(index["valve_ids"][valve]), "x": float(index["valve_xy"][valve, 0]),
+             "y": float(index["valve_xy"][valve, 1])}
+            for valve in valves
+        ],
+        "laterals": int(index["zone_laterals"][zone]),
+        "critical": [name for bit, name in enumerate(index["flag_names"]) if flags >> bit & 1],
+    }
+
+
+def shutdown_index_from_zones(
+    result: dict, valve_xy: np.ndarray, zone_laterals: np.ndarray, connections_df: pd.DataFrame = None,
+    unique_id: str = "FACILITYID", flag_names=(), valve_ids=None,
+) -> dict:
+    """
+    Builds the shutdown plan index from the isolation zones and the critical connections the COF pipeline found
+
+    :param result: dict: Result of IsolationZoneEngine.find_isolation_zones
+    :param valve_xy: np.ndarray: (n x 2) valve coordinates the zones were found with
+    :param zone_laterals: np.ndarray: Number of laterals in every zone number from zone_lateral_counts
+    :param connections_df: pd.DataFrame: unique_id and a column per critical customer category, "Connected" for the
+        mains serving one, e.g. the columns of Final_COF
+    :param unique_id: str: Water main unique id field
+    :param flag_names: list: Critical customer category columns of connections_df
+    :param valve_ids: array-like: Id of every valve, the valve position when not given
+    :return: dict: Index from build_shutdown_index
+    """
+    from IsolationZoneEngine import feature_zones, zone_boundary_valves, zone_name
+
+    network, seg_zone = result["network"], result["seg_zone"]
+    main_zone = feature_zones(network, seg_zone)
+    zone_count = seg_zone.max() + 1 if len(seg_zone) else 0
+    flags = None
+    if connections_df is not None and len(flag_names):
+        connections_df = connections_df.drop_duplicates(unique_id)
+        connections_df = connections_df.set_index(connections_df[unique_id].astype(str))
+        connected = connections_df[list(flag_names)].reindex(np.asarray(network["ids"]).astype(str))
+        flags = zone_flags(main_zone, (connected == "Connected").to_numpy(), zone_count)
+    return build_shutdown_index(
+        network["ids"], main_zone, [zone_name(zone) for zone in range(zone_count)],
+        zone_boundary_valves(network, seg_zone, valve_xy), valve_xy, zone_laterals, flags, flag_names, valve_ids,
+    )
+
+
+def serve(index: dict, port: int = 8765, host: str = "127.0.0.1"):
+    """
+    Answers GET /mains/{id} with the shutdown plan of the main as JSON, until stopped
+
+    :param index: dict: Index from load_shutdown_index
+    :param port: int: Port to listen on
+    :param host: str: Address to listen on, only this machine by default
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = urlparse(self.path).path.rstrip("/")
+            plan = lookup(index, unquote(path[len("/mains/"):])) if path.startswith("/mains/") else None
+            body = json.dumps(plan if plan is not None else {"error": "main not found"}).encode()
+            self.send_response(200 if plan is not None else 404)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    with ThreadingHTTPServer((host, port), Handler) as server:
+        print(f"Serving shutdown plans on http://{host}:{port}/mains/<id>")
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Look up the shutdown plan of water mains in a shutdown plan index")
+    parser.add_argument("index", help="Folder of the shutdown plan index")
+    parser.add_argument("ids", nargs="*", help="Unique ids of the mains to look up")
+    parser.add_argument("--serve", action="store_true", help="Answer lookups over HTTP at /mains/<id>")
+    parser.add_argument("--port", type=int, default=8765, help="Port of the HTTP lookup")
+    args = parser.parse_args()
+
+    shutdown_index = load_shutdown_index(args.index)
+    for main in args.ids:
+        print(json.dumps(lookup(shutdown_index, main), indent=2))
+    if args.serve:
+        serve(shutdown_index, args.port)
@@ -0,0 +1,244 @@
+import ast
+import glob
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import types
+
+import pandas as pd
+
+from Instrumentation import span
+
+# Every stage output is cached under a key hashed from the stage name, the code of the stage, its parameters and the
+# keys of the stages it reads from. The code is the source of the stage function and of the functions of its module it
+# calls, and the contents of every module of the repository it calls into and the modules those import, so a change to
+# e.g. the near distance engine reruns the stages that use it. A stage whose key is already cached is not run again, so
+# after a change only the stages downstream of it run. The files a stage writes outside the cache, e.g. its result
+# store outputs, are declared as its outputs and fingerprinted when it runs, a stage whose outputs are missing or were
+# overwritten since runs again so they are written for the cached key.
+
+
+def fingerprint(*parts) -> str:
+    """
+    Hashes stage parameters, upstream keys and other JSON serializable values into a cache key
+
+    :param parts: Values to hash, dicts are hashed with sorted keys
+    :return: str: Hex digest of the values
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(json.dumps(part, sort_keys=True, default=str).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()[:20]
+
+
+def file_fingerprint(path: str) -> str:
+    """
+    Hashes the contents of a file, for inputs that come from outside the stage graph
+
+    :param path: str: Path of the file
+    :return: str: Hex digest of the file, "missing" when it does not exist
+    """
+    if not os.path.exists(path):
+        return "missing"
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()[:20]
+
+
+def _source(func) -> str:
+    try:
+        return inspect.getsource(func)
+    except (OSError, TypeError):
+        return getattr(func, "__qualname__", repr(func))
+
+
+def _code_names(code) -> set:
+    # Global and imported names used by a code object and the functions, lambdas and comprehensions nested in it
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _code_names(const)
+    return names
+
+
+def _module_path(name: str, folder: str):
+    # Path of a module of the repository, None for modules from outside it
+    path = os.path.join(folder, name.split(".")[0] + ".py")
+    return path if os.path.exists(path) else None
+
+
+def _imported_paths(path: str, folder: str, paths: set):
+    # Adds a module and every module of the repository it imports, also inside functions, to the paths
+    if path in paths:
+        return
+    paths.add(path)
+    with open(path, "r", encoding="utf-8") as f:
+        tree = ast.parse(f.read(), path)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            names = [node.module]
+        else:
+            continue
+        for name in names:
+            imported = _module_path(name, folder)
+            if imported:
+                _imported_paths(imported, folder, paths)
+
+
+def code_fingerprint(func) -> dict:
+    """
+    Hashes the code a stage runs: the source of the stage function and of the functions of its own module it calls,
+    and the contents of the modules of the repository it calls into with everything they import
+
+    :param func: callable: Stage function
+    :return: dict: Source hash of the stage and file_fingerprint of every module it calls into, by module file name
+    """
+    module = inspect.getmodule(func)
+    if module is None or not getattr(module, "__file__", None):
+        return {"source": fingerprint(_source(func))}
+    folder = os.path.dirname(os.path.abspath(module.__file__))
+    sources, paths = [], set()
+    pending, seen = [func], set()
+    while pending:
+        function = pending.pop()
+        if function in seen:
+            continue
+        seen.add(function)
+        sources.append(_source(function))
+        for name in _code_names(function.__code__):
+            value = function.__globals__.get(name)
+            if isinstance(value, types.FunctionType) and value.__module__ == module.__name__:
+                # helpers of the stage module are followed by their source, not the whole module
+                pending.append(value)
+                continue
+            if isinstance(value, (int, float, str, tuple, list, dict)):
+                # constants, e.g. default tolerances, are hashed by value
+                sources.append(f"{name} = {value!r}")
+                continue
+            if isinstance(value, types.ModuleType):
+                path = getattr(value, "__file__", None)
+            elif value is not None:
+                path = getattr(inspect.getmodule(value), "__file__", None)
+            else:
+                # modules imported inside the function are not in its globals
+                path = _module_path(name, folder)
+            if path and os.path.dirname(os.path.abspath(path)) == folder \
+                    and os.path.abspath(path) != os.path.abspath(module.__file__):
+                _imported_paths(os.path.abspath(path), folder, paths)
+    code = {"source": fingerprint(*sources)}
+    code.update({os.path.basename(path): file_fingerprint(path) for path in sorted(paths)})
+    return code
+
+
+class StageCache:
+    """
+    Runs named stages and memoizes their outputs in a cache folder
+
+    :param cache_folder: str: Folder to keep the stage outputs in between runs
+    :param enabled: bool: Run every stage and skip the cache when False
+    """
+
+    def __init__(self, cache_folder: str, enabled: bool = True):
+        self.cache_folder = cache_folder
+        self.enabled = enabled
+        self.keys = {}
+        self.values = {}
+        self.ran = []
+        os.makedirs(cache_folder, exist_ok=True)
+
+    def _paths(self, name: str, key: str):
+        base = os.path.join(self.cache_folder, f"{name}-{key}")
+        return base + ".parquet", base + ".pkl"
+
+    def _outputs_path(self, name: str, key: str) -> str:
+        return os.path.join(self.cache_folder, f"{name}-{key}.outputs.json")
+
+    def _cached(self, name: str, key: str, outputs: list) -> bool:
+        if not any(os.path.exists(path) for path in self._paths(name, key)):
+            return False
+        if not outputs:
+            return True
+        # the outputs written by the run that cached the key, unchanged since
+        outputs_path = self._outputs_path(name, key)
+        if not os.path.exists(outputs_path):
+            return False
+        with open(outputs_path) as f:
+            written = json.load(f)
+        return all(written.get(path) == file_fingerprint(path) for path in outputs)
+
+    def _save(self, name: str, key: str, value, outputs: list):
+        # Only the latest output of every stage is kept
+        for old_path in glob.glob(os.path.join(self.cache_folder, f"{name}-*")):
+            os.remove(old_path)
+        if outputs:
+            with open(self._outputs_path(name, key), "w") as f:
+                json.dump({path: file_fingerprint(path) for path in outputs}, f)
+        parquet_path, pickle_path = self._paths(name, key)
+        if isinstance(value, pd.DataFrame):
+            value.to_parquet(parquet_path + ".tmp")
+            os.replace(parquet_path + ".tmp", parquet_path)
+        else:
+            with open(pickle_path + ".tmp", "wb") as f:
+                pickle.dump(value, f)
+            os.replace(pickle_path + ".tmp", pickle_path)
+
+    def get(self, name: str):
+        """
+        Gets the output of a stage, outputs found in the cache are only read when they are asked for
+
+        :param name: str: Name of a stage already run
+        :return: Output of the stage
+        """
+        if name not in self.values:
+            parquet_path, pickle_path = self._paths(name, self.keys[name])
+            if os.path.exists(parquet_path):
+                self.values[name] = pd.read_parquet(parquet_path)
+            else:
+                with open(pickle_path, "rb") as f:
+                    self.values[name] = pickle.load(f)
+        return self.values[name]
+
+    def run(
+        self, name: str, func, params: dict = None, upstream: dict = None, inputs: dict = None, outputs: list = None
+    ) -> bool:
+        """
+        Runs a stage unless its output for the same code, parameters and upstream outputs is cached and the files it
+        writes are as it wrote them, see code_fingerprint for the code
+
+        :param name: str: Name of the stage, unique in the graph
+        :param func: callable: Stage function, called with the parameters and upstream outputs as keyword arguments
+        :param params: dict: Keyword arguments of the stage function, JSON serializable
+        :param upstream: dict: Keyword argument name to the name of the stage whose output it gets
+        :param inputs: dict: Fingerprints of inputs from outside the graph, e.g. file_fingerprint of a source file
+        :param outputs: list: Paths of the files the stage writes outside the cache, e.g. from result_paths, the stage
+            runs again when one of them is missing or changed since it ran
+        :return: bool: True when the stage ran, False when its output came from the cache
+        """
+        params = params or {}
+        upstream = upstream or {}
+        upstream_keys = {argument: self.keys[stage] for argument, stage in upstream.items()}
+        key = fingerprint(name, code_fingerprint(func), params, inputs or {}, upstream_keys)
+        self.keys[name] = key
+        self.values.pop(name, None)
+        if self.enabled and self._cached(name, key, outputs):
+            with span(f"stage {name} (cached)", cached=True):
+                pass
+            return False
+        with span(f"stage {name}", cached=False) as record:
+            arguments = {argument: self.get(stage) for argument, stage in upstream.items()}
+            rows = [len(value) for value in arguments.values() if isinstance(value, pd.DataFrame)]
+            record["rows_in"] = sum(rows) if rows else None
+            value = func(**params, **arguments)
+            record["rows_out"] = len(value) if isinstance(value, pd.DataFrame) else None
+            self.values[name] = value
+            self.ran.append(name)
+            if self.enabled:
+                self._save(name, key, value, outputs)
+        return True
@@ -0,0 +1,263 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import shapely
+
+# Synthetic water systems for testing and benchmarking the pipeline without a city's feature services. The mains follow
+# a jittered street grid, every other layer is placed relative to the mains so the topology is consistent: mains meet
+# at shared nodes, valves and laterals sit on the mains, laterals run into their parcels and breaks lie next to mains.
+
+BLOCK_LENGTH = 400
+ORIGIN = (13_000_000.0, 500_000.0)
+MATERIALS = ['Cast Iron', 'Ductile Iron', 'Polyvinyl Chloride', 'Asbestos Cement', 'High Density Polyethylene']
+MATERIAL_WEIGHTS = [0.3, 0.25, 0.3, 0.1, 0.05]
+# Same service lives as the example table in WaterMainLOF
+SERVICE_LIFE = {
+    'Cast Iron': 75, 'Ductile Iron': 90, 'Polyvinyl Chloride': 90, 'Asbestos Cement': 70,
+    'High Density Polyethylene': 100, 'Copper': 100, 'Galvanized Pipe': 50,
+}
+# Rivers and rail lines cross the system this far apart
+CROSSING_SPACING = 12000
+DIAMETERS = [4, 6, 8, 10, 12, 16, 24]
+DIAMETER_WEIGHTS = [0.05, 0.35, 0.35, 0.05, 0.12, 0.05, 0.03]
+
+
+def _grid_edges(n_mains: int, rng: np.random.Generator):
+    # Node coordinates and the (start, end) node of every edge of a street grid, ordered row by row so the first
+    # n_mains edges are one connected system
+    k = int(np.ceil(np.sqrt(n_mains / 2))) + 1
+    jj, ii = np.divmod(np.arange(k * k), k)
+    nodes = np.column_stack([ii * BLOCK_LENGTH, jj * BLOCK_LENGTH]).astype(float)
+    nodes += rng.uniform(-30, 30, nodes.shape) + ORIGIN
+    node = np.arange(k * k).reshape(k, k)
+    edges = []
+    for row in range(k):
+        edges.append(np.column_stack([node[row, :-1], node[row, 1:]]))
+        if row < k - 1:
+            edges.append(np.column_stack([node[row], node[row + 1]]))
+    edges = np.concatenate(edges)[:n_mains]
+    # Every fifth street is a major road
+    major = np.zeros(len(edges), dtype=bool)
+    start_i, start_j = ii[edges[:, 0]], jj[edges[:, 0]]
+    end_i, end_j = ii[edges[:, 1]], jj[edges[:, 1]]
+    horizontal = start_j == end_j
+    major[horizontal] = start_j[horizontal] % 5 == 0
+    major[~horizontal] = start_i[~horizontal] % 5 == 0
+    return nodes, edges, major
+
+
+def _rectangles(origin: np.ndarray, along: np.ndarray, across: np.ndarray, length, width) -> np.ndarray:
+    # Rectangles with a corner at origin, length along the unit vector along and width along the unit vector across
+    length = np.asarray(length, dtype=float).reshape(-1, 1)
+    width = np.asarray(width, dtype=float).reshape(-1, 1)
+    a = origin
+    b = origin + along * length
+    c = b + across * width
+    d = origin + across * width
+    return shapely.polygons(np.stack([a, b, c, d, a], axis=1))
+
+
+def _points_on(geometries, count: int, rng: np.random.Generator) -> np.ndarray:
+    # Points inside randomly chosen polygons
+    chosen = rng.choice(len(geometries), size=min(count, len(geometries)), replace=False)
+    return shapely.point_on_surface(geometries[chosen])
+
+
+def generate_network(n_mains: int, seed: int = 0, laterals_per_main: int = 4, valve_probability: float = 0.35,
+                     breaks_per_main: float = 0.05) -> dict:
+    """
+    Generates a synthetic water system of any size with consistent topology
+
+    :param n_mains: int: Number of mains
+    :param seed: int: Random seed, the same seed always gives the same system
+    :param laterals_per_main: int: Number of laterals and parcels along every main
+    :param valve_probability: float: Chance of a valve on each main at each of its ends
+    :param breaks_per_main: float: Average number of breaks per main
+    :return: dict: Layer name to a DataFrame with the attributes and a geometry column of shapely geometries
+    """
+    rng = np.random.default_rng(seed)
+    nodes, edges, major = _grid_edges(n_mains, rng)
+    n_mains = len(edges)
+    start, end = nodes[edges[:, 0]], nodes[edges[:, 1]]
+    vector = end - start
+    length = np.hypot(vector[:, 0], vector[:, 1])
+    along = vector / length[:, None]
+    across = np.column_stack([-along[:, 1], along[:, 0]])
+
+    facility_ids = np.char.add("WM-", np.char.zfill(np.arange(1, n_mains + 1).astype(str), 7))
+    install_year = rng.integers(1920, 2021, n_mains)
+    install_date = pd.to_datetime(
+        pd.DataFrame({"year": install_year, "month": rng.integers(1, 13, n_mains), "day": rng.integers(1, 29, n_mains)})
+    )
+    layers = {"mains": pd.DataFrame({
+        "FACILITYID": facility_ids,
+        "PLACEDINSE": install_date,
+        "MATERIAL": rng.choice(MATERIALS, n_mains, p=MATERIAL_WEIGHTS),
+        "DIAMETER": rng.choice(DIAMETERS, n_mains, p=DIAMETER_WEIGHTS),
+        "geometry": shapely.linestrings(np.stack([start, end], axis=1)),
+    })}
+
+    # Valves 15 ft in from either end of a main
+    valve_main = np.concatenate([np.arange(n_mains), np.arange(n_mains)])
+    valve_end = np.repeat([0, 1], n_mains)
+    keep = rng.random(len(valve_main)) < valve_probability
+    valve_main, valve_end = valve_main[keep], valve_end[keep]
+    offset = np.where(valve_end == 0, 15.0, length[valve_main] - 15.0)
+    valve_xy = start[valve_main] + along[valve_main] * offset[:, None]
+    layers["valves"] = pd.DataFrame({"geometry": shapely.points(valve_xy)})
+
+    # Laterals evenly spaced along every main, alternating sides of the street, each running 40 ft into a parcel that
+    # starts 35 ft back from the main
+    lateral_main = np.repeat(np.arange(n_mains), laterals_per_main)
+    position = np.tile((np.arange(laterals_per_main) + 1) / (laterals_per_main + 1), n_mains)
+    side = np.where(np.tile(np.arange(laterals_per_main), n_mains) % 2 == 0, 1.0, -1.0)[:, None]
+    tap = start[lateral_main] + along[lateral_main] * (position * length[lateral_main])[:, None]
+    lateral_across = across[lateral_main] * side
+    layers["laterals"] = pd.DataFrame({
+        "geometry": shapely.linestrings(np.stack([tap, tap + lateral_across * 40], axis=1)),
+    })
+    parcel_width = np.minimum(60.0, length[lateral_main] / (laterals_per_main + 1) - 10)
+    parcel_origin = tap + lateral_across * 35 - along[lateral_main] * (parcel_width / 2)[:, None]
+    parcels = _rectangles(parcel_origin, along[lateral_main], lateral_across, parcel_width, 80)
+    layers["parcels"] = pd.DataFrame({
+        "PARCELID": np.char.add("P-", np.arange(1, len(parcels) + 1).astype(str)),
+        "geometry": parcels,
+    })
+
+    # Buildings inside most parcels
+    has_building = rng.random(len(parcels)) < 0.8
+    building_origin = parcel_origin[has_building] + lateral_across[has_building] * 20 + along[lateral_main][has_building] * 8
+    layers["buildings"] = pd.DataFrame({"geometry": _rectangles(
+        building_origin, along[lateral_main][has_building], lateral_across[has_building],
+        np.maximum(parcel_width[has_building] - 16, 4), 40,
+    )})
+
+    # Roads run 12 ft off the mains, intersections sit at the grid nodes
+    road_start = start + across * 12
+    road_end = end + across * 12
+    used_nodes, node_index = np.unique(edges, return_inverse=True)
+    node_major = np.zeros(len(used_nodes), dtype=bool)
+    np.logical_or.at(node_major, node_index.reshape(-1, 2)[:, 0], major)
+    np.logical_or.at(node_major, node_index.reshape(-1, 2)[:, 1], major)
+    layers["roadway"] = pd.DataFrame({
+        "Road": np.concatenate([
+            np.where(major, "Major Road", "Minor Road"),
+            np.where(node_major, "Major Intersection", "Minor Intersection"),
+        ]),
+        "geometry": np.concatenate([
+            shapely.linestrings(np.stack([road_start, road_end], axis=1)),
+            shapely.points(nodes[used_nodes] + 12),
+        ]),
+    })
+    layers["row"] = pd.DataFrame({"geometry": _rectangles(start - across * 25, along, across, length, 50)})
+
+    # Water bodies, rivers and rail lines spread over the extent often enough that every main is within the 10000 ft
+    # near search radius of each layer
+    low, high = nodes[used_nodes].min(axis=0), nodes[used_nodes].max(axis=0) + 1
+    lake_x = np.arange(low[0], high[0], CROSSING_SPACING) + CROSSING_SPACING / 2
+    lake_y = np.arange(low[1], high[1], CROSSING_SPACING) + CROSSING_SPACING / 2
+    lake_center = np.stack(np.meshgrid(lake_x, lake_y), axis=-1).reshape(-1, 2)
+    lake_center = lake_center + rng.uniform(-1000, 1000, lake_center.shape)
+    n_lakes = len(lake_center)
+    layers["water_areas"] = pd.DataFrame({
+        "geometry": shapely.buffer(shapely.points(lake_center), rng.uniform(50, 400, n_lakes), quad_segs=8),
+    })
+    n_rivers = int(np.ceil((high[1] - low[1]) / CROSSING_SPACING))
+    river_x = np.linspace(low[0] - BLOCK_LENGTH, high[0] + BLOCK_LENGTH, 20)
+    river_y = (low[1] + (np.arange(n_rivers)[:, None] + 0.5) * CROSSING_SPACING
+               + np.cumsum(rng.normal(0, 150, (n_rivers, 20)), axis=1))
+    layers["water_lines"] = pd.DataFrame({
+        "geometry": shapely.linestrings(np.stack([np.broadcast_to(river_x, river_y.shape), river_y], axis=2)),
+    })
+    n_rails = int(np.ceil((high[0] - low[0]) / CROSSING_SPACING))
+    rail_x = low[0] + (np.arange(n_rails) + 0.5) * CROSSING_SPACING
+    rail_start = np.column_stack([rail_x + rng.uniform(-1000, 1000, n_rails), np.full(n_rails, low[1] - BLOCK_LENGTH)])
+    rail_end = np.column_stack([rail_x + rng.uniform(-1000, 1000, n_rails), np.full(n_rails, high[1] + BLOCK_LENGTH)])
+    layers["railroad"] = pd.DataFrame({"geometry": shapely.linestrings(np.stack([rail_start, rail_end], axis=1))})
+
+    # Breaks next to mains, up to 3 ft off the line, more on older mains
+    age_weight = (2021 - install_year).astype(float)
+    n_breaks = int(n_mains * breaks_per_main)
+    break_main = rng.choice(n_mains, n_breaks, p=age_weight / age_weight.sum())
+    break_xy = (start[break_main] + along[break_main] * (rng.random(n_breaks) * length[break_main])[:, None]
+                + across[break_main] * rng.uniform(-3, 3, (n_breaks, 1)))
+    break_days = rng.integers(0, 20 * 365, n_breaks)
+    layers["breaks"] = pd.DataFrame({
+        "BREAKDATE": pd.Timestamp("2005-01-01") + pd.to_timedelta(break_days, unit="D"),
+        "geometry": shapely.points(break_xy),
+    })
+
+    # Critical customers inside parcels
+    for name, count in (("critical_customers", n_mains // 300), ("schools", n_mains // 500), ("healthcare", n_mains // 1000)):
+        layers[name] = pd.DataFrame({"geometry": _points_on(parcels, max(1, count), rng)})
+    return layers
+
+
+def write_geojson(layers: dict, output_folder: str) -> dict:
+    """
+    Writes every layer of a synthetic system to a GeoJSON file
+
+    :param layers: dict: Layers from generate_network
+    :param output_folder: str: Folder to write the files to
+    :return: dict: Layer name to the path of its file
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    paths = {}
+    for name, df in layers.items():
+        properties = df.drop(columns="geometry")
+        for column in properties.columns:
+            if pd.api.types.is_datetime64_any_dtype(properties[column]):
+                properties[column] = properties[column].dt.strftime("%Y-%m-%d")
+        # a frame without columns has no records, the features still need their empty properties
+        records = properties.to_dict("records") if len(properties.columns) else [{}] * len(properties)
+        geometries = shapely.to_geojson(df["geometry"].to_numpy())
+        paths[name] = os.path.join(output_folder, name + ".geojson")
+        with open(paths[name], "w") as f:
+            f.write('{"type": "FeatureCollection", "features": [')
+            for index, (record, geometry) in enumerate(zip(records, geometries)):
+                f.write((", " if index else "") + f'{{"type": "Feature", "properties": {json.dumps(record, default=str)}, '
+                        f'"geometry": {geometry}}}')
+            f.write("]}")
+    return paths
+
+
+def write_geoparquet(layers: dict, output_folder: str) -> dict:
+    """
+    Writes every layer of a synthetic system to a GeoParquet file
+
+    :param layers: dict: Layers from generate_network
+    :param output_folder: str: Folder to write the files to
+    :return: dict: Layer name to the path of its file
+    """
+    from GeometryIO import from_geometries, write_geoparquet as write_layer
+
+    os.makedirs(output_folder, exist_ok=True)
+    return {
+        name: write_layer(
+            from_geometries(df["geometry"].to_numpy(), df.drop(columns="geometry")),
+            os.path.join(output_folder, name + ".parquet"),
+        )
+        for name, df in layers.items()
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic water system as GeoJSON or GeoParquet files")
+    parser.add_argument("mains", type=int, help="Number of mains")
+    parser.add_argument("output", help="Folder to write the files to")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--laterals-per-main", type=int, default=4, help="Laterals and parcels along every main")
+    parser.add_argument("--format", choices=["geojson", "geoparquet"], default="geojson", help="Format of the files")
+    args = parser.parse_args(argv)
+
+    layers = generate_network(args.mains, args.seed, args.laterals_per_main)
+    write = write_geoparquet if args.format == "geoparquet" else write_geojson
+    for name, path in write(layers, args.output).items():
+        print(f"{name}: {len(layers[name])} features -> {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import shapely
+from scipy import sparse
+
+from NearDistance import DEFAULT_SEARCH_RADIUS, class_distances, near_distances
+from ServiceConnections import DEFAULT_TOLERANCE, LATERAL_SEARCH_RADIUS, build_connection_index, lateral_mains
+
+# The COF geometry stages can run tile by tile in a process pool for large regional systems. The features a stage
+# works on (mains, laterals or parcels) are grouped into square tiles by the center of their bounding box, and every
+# tile gets the features of the other layers within a halo around the extent of its own features. The halo is as wide
+# as anything can reach: the search radius for the near distances and the lateral assignment, and two laterals and
+# the touching tolerance for the service connections. Every feature the untiled run could find is therefore in its
+# tile, and the results are put back in the order of the features, so a tiled run gives the same output as an
+# untiled one.
+
+# Side of a tile in map units (feet), several times the near search radius so the halos stay a small part of a tile
+DEFAULT_TILE_SIZE = 50000
+DEFAULT_MAX_WORKERS = 4
+
+
+def tile_groups(geometries, tile_size: float = DEFAULT_TILE_SIZE) -> list:
+    """
+    Groups geometries into square tiles by the center of their bounding box
+
+    :param geometries: array-like: Shapely geometries
+    :param tile_size: float: Side of a tile in map units
+    :return: list: Index array of the geometries of every tile with any, tiles in row then column order
+    """
+    bounds = shapely.bounds(np.asarray(geometries, dtype=object))
+    center = (bounds[:, :2] + bounds[:, 2:]) / 2
+    valid = np.isfinite(center).all(axis=1)
+    cells = np.floor(center[valid] / tile_size).astype(np.int64)
+    indexes = np.flatnonzero(valid)
+    keys, tile = np.unique(cells[:, ::-1], axis=0, return_inverse=True)
+    order = np.argsort(tile.ravel(), kind="stable")
+    return np.split(indexes[order], np.cumsum(np.bincount(tile.ravel(), minlength=len(keys)))[:-1])
+
+
+def _halo(geometries, halo: float):
+    # Box around the extent of the geometries grown by the halo
+    bounds = shapely.bounds(geometries)
+    low = np.nanmin(bounds[:, :2], axis=0) - halo
+    high = np.nanmax(bounds[:, 2:], axis=0) + halo
+    return shapely.box(low[0], low[1], high[0], high[1])
+
+
+def _in_halo(tree, geometries, box) -> np.ndarray:
+    # Sorted index of the tree geometries whose bounding box meets the halo box
+    return np.sort(tree.query(box)) if len(geometries) else np.empty(0, dtype=np.int64)
+
+
+def _map(func, tasks: list, max_workers: int) -> list:
+    # Results of every task in task order, in a spawned process pool unless one worker is asked for
+    if max_workers is None or max_workers <= 1 or len(tasks) <= 1:
+        return [func(*task) for task in tasks]
+    with ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return list(pool.map(func, *zip(*tasks)))
+
+
+def _near_tile(main_geometries, near_layers, classed, search_radius):
+    near_df = near_distances(np.zeros(len(main_geometries)), main_geometries, near_layers, search_radius)
+    near_df = near_df.drop(columns="IN_FID")
+    if classed is not None:
+        near_geometries, near_classes, class_columns = classed
+        by_class = class_distances(main_geometries, near_geometries, near_classes, class_columns, search_radius)
+        near_df = pd.concat([by_class, near_df], axis=1)
+    return near_df
+
+
+def tiled_near_distances(
+    main_ids,
+    main_geometries,
+    near_layers: dict,
+    search_radius: float = DEFAULT_SEARCH_RADIUS,
+    classed_layer: tuple = None,
+    tile_size: float = DEFAULT_TILE_SIZE,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+) -> pd.DataFrame:
+    """
+    Builds the wide near table tile by tile, the same table as near_distances and class_distances
+
+    :param main_ids: array-like: OBJECTID of every main
+    :param main_geometries: array-like: Shapely geometry of every main
+    :param near_layers: dict: Layer name to array of shapely geometries
+    :param search_radius: float: Largest distance to search, in map units, and the halo of the tiles
+    :param classed_layer: tuple: (geometries, classes, class value to column name) of a layer measured by class, its
+        columns come first
+    :param tile_size: float: Side of a tile in map units
+    :param max_workers: int: Tiles running at once
+    :return: pd.DataFrame: IN_FID column and one distance column per class and layer, in the order of the mains
+    """
+    main_geometries = np.asarray(main_geometries, dtype=object)
+    layers = {name: np.asarray(geometries, dtype=object) for name, geometries in near_layers.items()}
+    trees = {name: shapely.STRtree(geometries) for name, geometries in layers.items()}
+    if classed_layer is not None:
+        classed_geometries = np.asarray(classed_layer[0], dtype=object)
+        classed_classes = np.asarray(classed_layer[1], dtype=object)
+        classed_tree = shapely.STRtree(classed_geometries)
+
+    groups = tile_groups(main_geometries, tile_size)
+    tasks = []
+    for group in groups:
+        box = _halo(main_geometries[group], search_radius)
+        tile_layers = {name: layers[name][_in_halo(trees[name], layers[name], box)] for name in layers}
+        classed = None
+        if classed_layer is not None:
+            kept = _in_halo(classed_tree, classed_geometries, box)
+            classed = (classed_geometries[kept], classed_classes[kept], classed_layer[2])
+        tasks.append((main_geometries[group], tile_layers, classed, search_radius))
+
+    columns = (list(classed_layer[2].values()) if classed_layer is not None else []) + list(layers)
+    distances = np.full((len(main_geometries), len(columns)), np.nan)
+    for group, tile_df in zip(groups, _map(_near_tile, tasks, max_workers)):
+        distances[group] = tile_df[columns].to_numpy(dtype=float)
+    near_results_df = pd.DataFrame(distances, columns=columns)
+    near_results_df.insert(0, "IN_FID", np.asarray(main_ids))
+    return near_results_df
+
+
+def _lateral_tile(lateral_geometries, main_geometries, main_index, search_radius):
+    lateral_main = lateral_mains(lateral_geometries, main_geometries, search_radius)
+    return np.where(lateral_main >= 0, main_index[np.maximum(lateral_main, 0)], -1)
+
+
+def tiled_lateral_mains(
+    lateral_geometries,
+    main_geometries,
+    search_radius: float = LATERAL_SEARCH_RADIUS,
+    tile_size: float = DEFAULT_TILE_SIZE,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+) -> np.ndarray:
+    """
+    Assigns every lateral to the nearest main tile by tile, the same assignment as lateral_mains
+
+    :param lateral_geometries: array-like: Shapely geometry of every lateral
+    :param main_geometries: array-like: Shapely geometry of every main
+    :param search_radius: float: Largest distance from a lateral to its main, in map units
+    :param tile_size: float: Side of a tile in map units
+    :param max_workers: int: Tiles running at once
+    :return: np.ndarray: Index of the main of every lateral, -1 when no main is within the search radius
+    """
+    lateral_geometries = np.asarray(lateral_geometries, dtype=object)
+    main_geometries = np.asarray(main_geometries, dtype=object)
+    lateral_main = np.full(len(lateral_geometries), -1, dtype=np.int64)
+    if len(lateral_geometries) == 0 or len(main_geometries) == 0:
+        return lateral_main
+    main_tree = shapely.STRtree(main_geometries)
+    groups = tile_groups(lateral_geometries, tile_size)
+    tasks = []
+    for group in groups:
+        # the mains are kept in their order so equally near mains break the tie the same way
+        main_index = _in_halo(main_tree, main_geometries, _halo(lateral_geometries[group], search_radius))
+        tasks.append((lateral_geometries[group], main_geometries[main_index], main_index, search_radius))
+    for group, tile_main in zip(groups, _map(_lateral_tile, tasks, max_workers)):
+        lateral_main[group] = tile_main
+    return lateral_main
+
+
+def _connection_tile(parcel_geometries, lateral_geometries, main_geometries, main_index, parcel_index, tolerance):
+    parcel_mains = build_connection_index(parcel_geometries, lateral_geometries, main_geometries, tolerance)["parcel_mains"]
+    parcel_mains = parcel_mains.tocoo()
+    return parcel_index[parcel_mains.row], main_index[parcel_mains.col]
+
+
+def tiled_connection_index(
+    parcel_geometries,
+    lateral_geometries,
+    main_geometries,
+    tolerance: float = DEFAULT_TOLERANCE,
+    tile_size: float = DEFAULT_TILE_SIZE,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+) -> dict:
+    """
+    Builds the parcel to main service connection index tile by tile, the same index as build_connection_index
+
+    A parcel reaches its mains through at most two laterals, so every tile of parcels gets the laterals and mains
+    within two of the longest lateral and the touching tolerance of it.
+
+    :param parcel_geometries: array-like: Shapely geometry of every parcel
+    :param lateral_geometries: array-like: Shapely geometry of every lateral
+    :param main_geometries: array-like: Shapely geometry of every main
+    :param tolerance: float: Largest gap between features that still touch, in map units
+    :param tile_size: float: Side of a tile in map units
+    :param max_workers: int: Tiles running at once
+    :return: dict: STR-tree of the parcels and the sparse parcel by main connection matrix
+    """
+    parcel_geometries = np.asarray(parcel_geometries, dtype=object)
+    lateral_geometries = np.asarray(lateral_geometries, dtype=object)
+    main_geometries = np.asarray(main_geometries, dtype=object)
+    lateral_bounds = shapely.bounds(lateral_geometries)
+    longest = np.nanmax(np.hypot(*(lateral_bounds[:, 2:] - lateral_bounds[:, :2]).T)) if len(lateral_geometries) else 0
+    halo = 2 * longest + 3 * tolerance
+    lateral_tree = shapely.STRtree(lateral_geometries)
+    main_tree = shapely.STRtree(main_geometries)
+
+    tasks = []
+    for group in tile_groups(parcel_geometries, tile_size):
+        box = _halo(parcel_geometries[group], halo)
+        lateral_index = _in_halo(lateral_tree, lateral_geometries, box)
+        main_index = _in_halo(main_tree, main_geometries, box)
+        tasks.append((
+            parcel_geometries[group], lateral_geometries[lateral_index], main_geometries[main_index], main_index, group,
+            tolerance,
+        ))
+    pairs = _map(_connection_tile, tasks, max_workers)
+    rows = np.concatenate([row for row, _ in pairs]) if pairs else np.empty(0, dtype=np.int64)
+    cols = np.concatenate([col for _, col in pairs]) if pairs else np.empty(0, dtype=np.int64)
+    parcel_mains = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=bool), (rows, cols)), shape=(len(parcel_geometries), len(main_geometries))
+    )
+    return {
+        "parcel_tree": shapely.STRtree(parcel_geometries),
+        "parcel_mains": parcel_mains,
+        "tolerance": tolerance,
+    }
@@ -7,14 +7,23 @@ import numpy as np
 from sklearn.cluster import KMeans
 from arcgis.gis import GIS
 import yaml
-
-# sign into arcgis online with user credentials
-# Load credentials from CityLogins.yaml
-with open("../CityLogins.yaml", "r") as file:
-    config = yaml.safe_load(file)
+from FeatureExtractor import get_session
+from Instrumentation import Trace, call, tool
+from LayerCache import sync_layers, layer_state
+from StageCache import StageCache, file_fingerprint
+from ResultStore import result_paths, write_result
+from Schemas import breaks_schema, enforce_dtypes, lof_dtypes, lof_schema
+from LOFScoring import score_service_life, calculate_lof
+from BreakMatching import DEFAULT_BREAK_TOLERANCE
+from BreakHistory import break_history_featureclasses, break_table, breaks_outside_window, window_table
+from GeometryIO import GeometryCache, read_layer
 
 # Function to get GIS object from city name
-def get_gis(city_name):
+def get_gis(city_name: str, config_file: str) -> GIS:
+    # sign into arcgis online with user credentials
+    # Load credentials from CityLogins.yaml
+    with open(config_file, "r") as file:
+        config = yaml.safe_load(file)
     city_config = config['cities'][city_name]
     url = city_config['url']
     username = city_config['username']
@@ -22,153 +31,234 @@ def get_gis(city_name):
     gis = GIS(url, username, password)
     return gis
 
-# Define your User
-user = 'Abonmarche'
-
-# Connect to GIS
-user_gis = get_gis(user)
-
-# User Variables
-workspace = r"memory"
-results_folder = r"C:\Users\ggarcia\OneDrive - Abonmarche\Documents\GitHub\Utility-System-Risk\AlleganSecondResults"
-service_life_table = r"C:\Users\ggarcia\OneDrive - Abonmarche\Documents\GitHub\Utility-System-Risk\AlleganServiceLife.csv"
-water_main_url = "https://services6.arcgis.com/o5a9nldztUcivksS/arcgis/rest/services/Allegan_Water/FeatureServer/6"
-breaks_url = "https://services6.arcgis.com/o5a9nldztUcivksS/arcgis/rest/services/Allegan_Water/FeatureServer/5"
-UniqueID = "FACILITYID"
-InstallDate = "PLACEDINSE"
-Material = "MATERIAL"
-
-arcpy.env.workspace = workspace
-arcpy.env.overwriteOutput = True
-arcpy.env.maintainAttachments = False
-dir_path = os.getcwd()
-
-# export the water main feature service to a feature class
-arcpy.conversion.ExportFeatures(water_main_url, "WaterMainFC")
-
-# export the breaks feature service to a feature class
-arcpy.conversion.ExportFeatures(breaks_url, "BreaksFC")
-
-water_main = "WaterMainFC"
-# breaks = "BreaksFC"
-columns = [UniqueID, InstallDate, Material]
-
-# Water main feature class to pandas dataframe
-water_main_df = pd.DataFrame.spatial.from_featureclass(water_main)
-# keep only columns as specified in list
-water_main_df = water_main_df[columns]
-water_main_df = water_main_df.replace(r'^\s*$', np.nan, regex=True)
-water_main_df = water_main_df.dropna()
-# make sure UniqueID and material are strings and InstallDate is a datetime object
-water_main_df[UniqueID] = water_main_df[UniqueID].astype(str)
-water_main_df[Material] = water_main_df[Material].astype(str)
-water_main_df[InstallDate] = pd.to_datetime(water_main_df[InstallDate], errors='coerce')
-
-# # make a dataframe to store service life of different pipe materials
-# pipe_materials = ['Cast Iron', 'Ductile Iron', 'Polyvinyl Chloride', 'Asbestos Cement', 'High Density Polyethylene', 'Copper', 'Galvanized Pipe']
-# pipe_service_life = [75, 90, 90, 70, 100, 100, 50]
-# pipe_service_life_df = pd.DataFrame({Material: pipe_materials, 'Service Life': pipe_service_life})
-
-# read the service life table into a dataframe
-pipe_service_life_df = pd.read_csv(service_life_table)
-
-# copy the water main dataframe add rows for age, service life, and lof then calculate lof as age/service life
-WM_sl_Calc_df = water_main_df.copy()
-WM_sl_Calc_df['Age'] = datetime.now().year - WM_sl_Calc_df[InstallDate].dt.year
-WM_sl_Calc_df = WM_sl_Calc_df.merge(pipe_service_life_df, left_on=Material, right_on='Material', how='left')
-WM_sl_Calc_df['Service Life Score'] = WM_sl_Calc_df['Age'] / WM_sl_Calc_df['Service Life'] * 10
-
-# round the Service life score and adjusted service life score values to the next whole number
-WM_sl_Calc_df['Service Life Score'] = np.ceil(WM_sl_Calc_df['Service Life Score'])
-
-# if the service life score value is greater than 10, set it to 10
-WM_sl_Calc_df.loc[WM_sl_Calc_df['Service Life Score'] > 10, 'Service Life Score'] = 10
-
-# if the service life score is less than or equal to 0 set it to 1
-WM_sl_Calc_df.loc[WM_sl_Calc_df['Service Life Score'] <= 0, 'Service Life Score'] = 1
-
-# save to csv
-# output_path = os.path.join(results_folder, "Service_Life.csv")
-# WM_sl_Calc_df.to_csv(output_path, index=False)
-
-try:
-    # spatial join water mains to breaks to get the pipe FacilityID into the breaks table
-    if breaks and breaks != "":
-        breaks_mains_join = "breaks_mains_join"
-        arcpy.analysis.SpatialJoin(
-            target_features=breaks,
-            join_features=water_main,
-            out_feature_class=breaks_mains_join,
-            join_operation="JOIN_ONE_TO_ONE",
-            join_type="KEEP_COMMON",
-            match_option="INTERSECT"
-        )
+def read_service_life_table(service_life_table) -> pd.DataFrame:
+    """
+    Reads the service life of each pipe material
+
+    :param service_life_table: str or dict: Path of a CSV with Material and Service Life columns, or material to
+        service life in years
+    :return: pd.DataFrame: Material and Service Life columns
+    """
+    if isinstance(service_life_table, dict):
+        return pd.DataFrame({'Material': list(service_life_table), 'Service Life': list(service_life_table.values())})
+    return pd.read_csv(service_life_table)
+
+def break_history_stage(paths: dict, unique_id: str, break_date: str, break_tolerance: float) -> dict:
+    """
+    Break history stage: snaps every break to its nearest main within the break tolerance and indexes the break dates
+    of every main, the mains and breaks are read from their layer cache files
+
+    :return: dict: Break history index, see BreakHistory.build_break_history
+    """
+    return call(
+        "break_history", break_history_featureclasses, paths["WaterMainFC"], unique_id, paths["BreaksFC"], break_date,
+        break_tolerance,
+    )
+
+
+def lof_stage(
+    paths: dict,
+    results_folder: str,
+    service_life_table,
+    unique_id: str,
+    install_date: str,
+    material: str,
+    export_csv: bool,
+    break_history: dict = None,
+    break_window: float = None,
+    break_half_life: float = None,
+) -> pd.DataFrame:
+    """
+    LOF stage: scores the service life and breaks of every main, saved to Final_LOF
+
+    :return: pd.DataFrame: Final_LOF
+    """
+    columns = [unique_id, install_date, material]
 
-        # check the number of features in the spatial join result
-        result_count = arcpy.management.GetCount(breaks_mains_join)
-        if int(result_count.getOutput(0)) > 0:
-            # convert the spatial join result to a pandas dataframe
-            breaks_mains_join_df = pd.DataFrame.spatial.from_featureclass(breaks_mains_join)
-            breaks_mains_join_df = breaks_mains_join_df[['OBJECTID', 'Join_Count', UniqueID]]
-            breaks_mains_join_df = breaks_mains_join_df.dropna()
-
-            # make a dataframe from the mains and only keep facilityid, and drop rows with null values
-            water_main_df = pd.DataFrame.spatial.from_featureclass(water_main)
-            water_main_df = water_main_df[[UniqueID]]
-            water_main_df = water_main_df.dropna()
-
-            # Ensure UniqueID columns are of the same type
-            breaks_mains_join_df[UniqueID] = breaks_mains_join_df[UniqueID].astype(str)
-            water_main_df[UniqueID] = water_main_df[UniqueID].astype(str)
-            WM_sl_Calc_df[UniqueID] = WM_sl_Calc_df[UniqueID].astype(str)
-
-            # use the breaks dataframe to get the count of breaks for each pipe and add it to the water main dataframe in a Breaks column
-            # Group the breaks_mains_join_df by UniqueID and count the number of breaks for each UniqueID
-            breaks_count = breaks_mains_join_df.groupby(UniqueID).size().reset_index(name='Breaks')
-
-            # Merge the water_main_df with the breaks_count dataframe on UniqueID
-            breaks_df = pd.merge(water_main_df, breaks_count, on=UniqueID, how='left')
-
-            # Fill NaN values in the 'Breaks' column with 0
-            breaks_df['Breaks'] = breaks_df['Breaks'].fillna(0)
-            # remove rows where Breaks is 0
-            breaks_df = breaks_df[breaks_df['Breaks'] > 0]
-
-            # score the breaks
-            def score_breaks(breaks):
-                if breaks == 1:
-                    return 8
-                elif breaks >= 2:
-                    return 10
-
-            # Apply the function to the 'Breaks' column to calculate the 'Breaks_score'
-            breaks_df['Breaks_score'] = breaks_df['Breaks'].apply(score_breaks)
-            # save to csv
-            output_path = os.path.join(results_folder, "Breaks.csv")
-            breaks_df.to_csv(output_path, index=False)
-
-            # Merge the dataframes on UniqueID
-            LOF_df = pd.merge(WM_sl_Calc_df, breaks_df, on=UniqueID, how='left')
+    # Water main attributes from the layer cache file, read once for the run with the break history's mains, every main
+    # is kept including the mains without a geometry
+    water_main_df = read_layer(paths["WaterMainFC"])["all_attributes"]
+    # keep only columns as specified in list
+    water_main_df = water_main_df[columns]
+    water_main_df = water_main_df.replace(r'^\s*$', np.nan, regex=True)
+    water_main_df = water_main_df.dropna()
+    # make sure unique_id and material are strings and install_date is a datetime object
+    water_main_df[unique_id] = water_main_df[unique_id].astype(str)
+    water_main_df[material] = water_main_df[material].astype(str)
+    water_main_df[install_date] = pd.to_datetime(water_main_df[install_date], errors='coerce')
+
+    # read the service life table into a dataframe
+    pipe_service_life_df = read_service_life_table(service_life_table)
+
+    # score the age of every main against the service life of its material
+    WM_sl_Calc_df = call("score_service_life", score_service_life, water_main_df, pipe_service_life_df, install_date, material)
+
+    # count and score the breaks of every main in the break window from the break history
+    if break_history is not None:
+        breaks_df = call("break_table", break_table, break_history, unique_id, break_window, break_half_life)
+        if break_window is not None:
+            outside, dated = breaks_outside_window(break_history, break_window)
+            if outside:
+                print(f"{outside} of {dated} dated breaks are outside the {break_window:g} year break window")
+        # summarize the dated breaks over the standard windows to compare them
+        if (break_history["days"] > 0).any():
+            write_result(window_table(break_history, unique_id), results_folder, "BreakWindows", export_csv=export_csv)
+        if len(breaks_df) > 0:
+            # Ensure unique_id columns are of the same type
+            breaks_df[unique_id] = breaks_df[unique_id].astype(str)
+            WM_sl_Calc_df[unique_id] = WM_sl_Calc_df[unique_id].astype(str)
+            # save to the result store
+            write_result(breaks_df, results_folder, "Breaks", breaks_schema(unique_id), export_csv)
+
+            # Merge the dataframes on unique_id
+            LOF_df = call("merge", pd.merge, WM_sl_Calc_df, breaks_df, on=unique_id, how='left')
 
         else:
-            print("No features in the spatial join result")
+            print("No breaks within the break tolerance of a main in the break window")
             LOF_df = WM_sl_Calc_df.copy()
-except NameError:
-    print("Variable 'breaks' is not defined")
-    LOF_df = WM_sl_Calc_df.copy()
-
-# drop missing values again
-LOF_df= LOF_df.dropna()
-# calculate the LOF as (Service Life Score x 0.50) + (Breaks Score x 0.50) if Breaks_score column exists
-if 'Breaks_score' in LOF_df.columns:
-    LOF_df.loc[:, 'LOF'] = (LOF_df['Service Life Score'] * 0.5) + (LOF_df['Breaks_score'] * 0.5)
-else:
-    LOF_df.loc[:, 'LOF'] = LOF_df['Service Life Score']
-LOF_df.loc[:, 'LOF'] = np.ceil(LOF_df['LOF'])
-
-# Save the final dataframe to a csv file
-output_path = os.path.join(results_folder, "Final_LOF.csv")
-LOF_df.to_csv(output_path, index=False)
-
-# erase the memory workspace
-arcpy.management.Delete(workspace)
\ No newline at end of file
+    else:
+        print("No breaks layer given")
+        LOF_df = WM_sl_Calc_df.copy()
+
+    # calculate the LOF from the service life and breaks scores
+    LOF_df = call("calculate_lof", calculate_lof, LOF_df)
+    # keep the scores in uint8 and the id and material as categoricals
+    LOF_df = enforce_dtypes(LOF_df, lof_dtypes(unique_id, material))
+
+    # Save the final dataframe to the result store
+    write_result(
+        LOF_df, results_folder, "Final_LOF", lof_schema(unique_id, install_date, material), export_csv, sort_by=unique_id
+    )
+
+    return LOF_df
+
+
+def run_lof(
+    gis: GIS,
+    results_folder: str,
+    water_main_url: str,
+    service_life_table,
+    breaks_url: str = None,
+    unique_id: str = "FACILITYID",
+    install_date: str = "PLACEDINSE",
+    material: str = "MATERIAL",
+    workspace: str = r"memory",
+    export_csv: bool = False,
+    use_cache: bool = True,
+    break_tolerance: float = DEFAULT_BREAK_TOLERANCE,
+    break_date: str = None,
+    break_window: float = None,
+    break_half_life: float = None,
+    coordinate_system: int = 102690,
+) -> pd.DataFrame:
+    """
+    Runs the likelihood of failure analysis for one city and saves Final_LOF to its result store
+
+    The analysis runs as the extract, break history and LOF stages, the break history and LOF stages only run again when
+    the layers, the service life table or their parameters changed since their outputs were cached in the StageCache
+    folder of the results folder. Both stages read the water main layer cache file through one GeometryCache, so the
+    mains are read once per run. Changing the break window or half life only reruns the LOF stage. The
+    time, memory and row counts of every stage and geoprocessing call are written to a JSON trace in the Traces folder
+    of the results folder and printed as a table at the end.
+
+    :param gis: GIS: Signed in GIS object of the city from get_gis
+    :param results_folder: str: Folder of the city's result store
+    :param water_main_url: str: Water main feature service layer url
+    :param service_life_table: str or dict: Service life table, see read_service_life_table
+    :param breaks_url: str: Breaks feature service layer url, breaks are not scored when not given
+    :param unique_id: str: Water main unique id field
+    :param install_date: str: Water main install date field
+    :param material: str: Water main material field
+    :param workspace: str: Workspace for the intermediate feature classes
+    :param export_csv: bool: Also write CSV copies of the results next to the result store files
+    :param use_cache: bool: Reuse the cached stage outputs, every stage runs when False
+    :param break_tolerance: float: Largest distance from a break to the main it is snapped to, in the units of the
+        coordinate system
+    :param break_date: str: Break date field, needed for the break window, the break rate and BreakWindows
+    :param break_window: float: Only score the breaks of the last this many years, every break ever when not given,
+        needs break_date
+    :param break_half_life: float: Add the recency weighted break rate with this half life in years to Breaks, needs
+        break_date
+    :param coordinate_system: int: WKID of the coordinate system the layers are extracted in, the break tolerance is in
+        its units
+    :return: pd.DataFrame: Final_LOF results
+    """
+    if (break_window is not None or break_half_life is not None) and not break_date:
+        raise ValueError("break_window and break_half_life need the break_date field, every break would be undated")
+    coordinate_system = arcpy.SpatialReference(coordinate_system)
+    arcpy.env.workspace = workspace
+    arcpy.env.overwriteOutput = True
+    arcpy.env.maintainAttachments = False
+    arcpy.env.outputCoordinateSystem = coordinate_system
+    with Trace("LOF", os.path.join(results_folder, "Traces")), GeometryCache():
+        stages = StageCache(os.path.join(results_folder, "StageCache"), enabled=use_cache)
+
+        # Extract stage, always run
+        # bring the cached water main and breaks layers up to date over the signed in session, only downloading the
+        # features edited since the last run, projected to the coordinate system so the break tolerance is in its
+        # units, the stages that run read the cached files through GeometryIO without loading them into feature
+        # classes
+        layers = [("WaterMainFC", water_main_url)]
+        if breaks_url:
+            layers.append(("BreaksFC", breaks_url))
+        layer_cache_folder = os.path.join(results_folder, "LayerCache")
+        paths = sync_layers(layers, layer_cache_folder, get_session(gis), out_sr=coordinate_system.factoryCode)
+
+        layer_states = {name: layer_state(path) for name, path in paths.items()}
+        upstream = {}
+        if breaks_url:
+            # the break history is only built again when the mains or breaks are edited or the tolerance changes
+            stages.run(
+                "break_history", break_history_stage,
+                params=dict(paths=paths, unique_id=unique_id, break_date=break_date, break_tolerance=break_tolerance),
+                inputs=layer_states,
+            )
+            upstream["break_history"] = "break_history"
+
+        # the age of the mains changes with the year, the break windows with the day
+        inputs = {**layer_states, "year": datetime.now().year}
+        if break_date and breaks_url:
+            inputs["day"] = datetime.now().date().isoformat()
+        if not isinstance(service_life_table, dict):
+            inputs["service_life_table"] = file_fingerprint(service_life_table)
+        stages.run(
+            "lof", lof_stage,
+            params=dict(
+                paths=paths, results_folder=results_folder, service_life_table=service_life_table, unique_id=unique_id,
+                install_date=install_date, material=material, export_csv=export_csv, break_window=break_window,
+                break_half_life=break_half_life,
+            ),
+            upstream=upstream,
+            inputs=inputs,
+            outputs=result_paths(results_folder, ["BreakWindows", "Breaks", "Final_LOF"], export_csv),
+        )
+
+        # erase the memory workspace
+        tool(arcpy.management.Delete, workspace, count=False)
+    return stages.get("lof")
+
+
+if __name__ == "__main__":
+    # Define your User
+    config_file = "../CityLogins.yaml"
+    user = 'Abonmarche'
+
+    # Connect to GIS
+    user_gis = get_gis(user, config_file)
+
+    # User Variables
+    results_folder = r"C:\Users\ggarcia\OneDrive - Abonmarche\Documents\GitHub\Utility-System-Risk\AlleganSecondResults"
+    service_life_table = r"C:\Users\ggarcia\OneDrive - Abonmarche\Documents\GitHub\Utility-System-Risk\AlleganServiceLife.csv"
+    water_main_url = "https://services6.arcgis.com/o5a9nldztUcivksS/arcgis/rest/services/Allegan_Water/FeatureServer/6"
+    # set to "https://services6.arcgis.com/o5a9nldztUcivksS/arcgis/rest/services/Allegan_Water/FeatureServer/5" to score breaks
+    breaks_url = None
+    UniqueID = "FACILITYID"
+    InstallDate = "PLACEDINSE"
+    Material = "MATERIAL"
+    # also write CSV copies of the results next to the result store files
+    export_csv = False
+
+    run_lof(
+        user_gis, results_folder, water_main_url, service_life_table, breaks_url,
+        unique_id=UniqueID, install_date=InstallDate, material=Material, export_csv=export_csv,
+    )
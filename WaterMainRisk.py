@@ -1,6 +1,33 @@
+import os
+import numpy as np
 import pandas as pd
-import math
-import plotly.express as px
+import plotly.graph_objects as go
+import plotly.io
+from Instrumentation import Trace, call, span
+from ResultStore import read_result, read_result_batches, result_paths, write_result, write_result_batches
+from Schemas import enforce_dtypes, risk_dtypes, risk_matrix_schema, risk_schema
+from StageCache import StageCache, file_fingerprint
+
+# The normalized COF and LOF scores run from 1 to this, the risk matrix has a cell for every pair
+RISK_LEVELS = 10
+# Rows per batch of the streaming risk merge
+STREAM_BATCH_SIZE = 100000
+
+
+def normalize_values(values, min_value, max_value):
+    """
+    Normalizes values to a scale from 1 to 10 given the smallest and largest value, rounding up
+
+    :param values: array-like: Values to normalize
+    :param min_value: float: Smallest value
+    :param max_value: float: Largest value
+    :return: array-like: Normalized values, the values as they are when every value is the same
+    """
+    # Avoid division by zero if all values are the same
+    if min_value == max_value:
+        return values
+    return np.ceil((values - min_value) * (9 / (max_value - min_value)) + 1)
+
 
 def normalize_column(df, column_name):
     """
@@ -16,82 +43,438 @@ def normalize_column(df, column_name):
     # Define the new column name for normalized scores
     normalized_column_name = column_name + '_normalized'
     
-    # Avoid division by zero if all values are the same
-    if min_value == max_value:
-        df[normalized_column_name] = df[column_name]
-    else:
-        df[normalized_column_name] = ((df[column_name] - min_value) * (9 / (max_value - min_value)) + 1).apply(math.ceil)
-    
+    df[normalized_column_name] = normalize_values(df[column_name], min_value, max_value)
     return df
 
-def create_heatmap(df: pd.DataFrame, lof_column: str, cof_column: str, length_column: str):
-    """
-    Creates a plotly heatmap of COF vs LOF
-
-    :param df: DataFrame containing the data
-    :type df: pd.DataFrame
-    :param lof_column: Name of the LOF column
-    :type lof_column: str
-    :param cof_column: Name of the COF column
-    :type cof_column: str
-    :param length_column: Name of the length column
-    :type length_column: str
-    """
-    # Create the density heatmap
-    fig = px.density_heatmap(
-        df,
-        x=lof_column,
-        y=cof_column,
-        z=length_column,
-        histfunc='sum',
-        text_auto=True,
-        nbinsx=11,  # Ensure bins match with x-axis range
-        nbinsy=11   # Ensure bins match with y-axis range
+def risk_matrix(
+    df: pd.DataFrame, lof_column: str = 'LOF_normalized', cof_column: str = 'COF_normalized', length_column: str = 'LENGTH'
+) -> pd.DataFrame:
+    """
+    Sums the length and counts the mains in every LOF x COF cell with a 2-D bincount
+
+    Scores are rounded up and clipped to 1 to RISK_LEVELS, mains missing a score are left out and a missing length
+    counts as 0.
+
+    :param df: pd.DataFrame: Risk results with the normalized scores and length
+    :param lof_column: str: Name of the LOF column
+    :param cof_column: str: Name of the COF column
+    :param length_column: str: Name of the length column
+    :return: pd.DataFrame: LOF, COF, length and Count columns, one row per cell with LOF changing fastest
+    """
+    return matrix_frame(*matrix_cells(df, lof_column, cof_column, length_column), length_column)
+
+
+def matrix_cells(df: pd.DataFrame, lof_column: str, cof_column: str, length_column: str):
+    """
+    Length and number of mains in every cell of the risk matrix, the cells of batches of rows add up
+
+    :return: tuple: (np.ndarray of the length of every cell, np.ndarray of the count of every cell), LOF changing fastest
+    """
+    lof = df[lof_column].to_numpy(dtype=float)
+    cof = df[cof_column].to_numpy(dtype=float)
+    length = np.nan_to_num(df[length_column].to_numpy(dtype=float))
+    scored = ~(np.isnan(lof) | np.isnan(cof))
+    lof_index = np.clip(np.ceil(lof[scored]), 1, RISK_LEVELS).astype(np.int64) - 1
+    cof_index = np.clip(np.ceil(cof[scored]), 1, RISK_LEVELS).astype(np.int64) - 1
+    cells = cof_index * RISK_LEVELS + lof_index
+    return (
+        np.bincount(cells, weights=length[scored], minlength=RISK_LEVELS ** 2),
+        np.bincount(cells, minlength=RISK_LEVELS ** 2),
     )
 
-    # Adjust the layout, including the plot_bgcolor to make 'empty' cells visible (as white)
+
+def matrix_frame(lengths: np.ndarray, counts: np.ndarray, length_column: str) -> pd.DataFrame:
+    """
+    :return: pd.DataFrame: The risk matrix cells from matrix_cells as LOF, COF, length and Count columns
+    """
+    levels = np.arange(1, RISK_LEVELS + 1)
+    return pd.DataFrame({
+        'LOF': np.tile(levels, RISK_LEVELS),
+        'COF': np.repeat(levels, RISK_LEVELS),
+        length_column: lengths,
+        'Count': counts,
+    })
+
+
+def create_matrix_heatmap(matrix_df: pd.DataFrame, length_column: str):
+    """
+    Creates a plotly heatmap of COF vs LOF from the risk matrix, its size does not depend on the number of mains
+
+    :param matrix_df: pd.DataFrame: Risk matrix from risk_matrix
+    :param length_column: str: Name of the length column
+    :return: go.Figure: Heatmap of the length in every cell, with the number of mains on hover
+    """
+    levels = np.arange(1, RISK_LEVELS + 1)
+    lengths = matrix_df[length_column].to_numpy().reshape(RISK_LEVELS, RISK_LEVELS)
+    counts = matrix_df['Count'].to_numpy().reshape(RISK_LEVELS, RISK_LEVELS)
+    fig = go.Figure(go.Heatmap(
+        x=levels,
+        y=levels,
+        # empty cells are left blank
+        z=np.where(counts > 0, lengths, np.nan),
+        customdata=counts,
+        texttemplate='%{z:.0f}',
+        hovertemplate='LOF %{x}<br>COF %{y}<br>Length %{z:,.0f}<br>Mains %{customdata:,}<extra></extra>',
+        coloraxis='coloraxis',
+    ))
+
+    # Transparent background so the blank cells show as empty
     fig.update_layout(
-        plot_bgcolor='rgba(0,0,0,0)',  # Set background to transparent
-        width=900,  # Adjust as needed
-        height=750,  # Adjust as needed
-        margin=dict(t=50, l=50, r=50, b=50),  # Adjust margins if needed
-        coloraxis_colorbar=dict(title='sum of Length (Ft)')  # Set colorbar title
+        plot_bgcolor='rgba(0,0,0,0)',
+        width=900,
+        height=750,
+        margin=dict(t=50, l=50, r=50, b=50),
+        coloraxis_colorbar=dict(title='sum of Length (Ft)'),
+        xaxis_title='LOF_normalized',
+        yaxis_title='COF_normalized',
     )
+    fig.update_xaxes(range=[-0.5, RISK_LEVELS + 0.5], dtick=1)
+    fig.update_yaxes(range=[-0.5, RISK_LEVELS + 0.5], dtick=1)
+    return fig
 
-    # Update axes ranges to ensure cells are not cut off
-    fig.update_xaxes(range=[-0.5, 10.5])
-    fig.update_yaxes(range=[-0.5, 10.5])
 
-    # Return the figure object
-    return fig
+def risk_merge_stage(
+    results_folder: str, unique_id: str, cof_columns=None, lof_columns=None, export_csv: bool = False
+) -> pd.DataFrame:
+    """
+    Risk merge stage: merges the COF and LOF results and scores the risk, saved to Final_Risk
+
+    :return: pd.DataFrame: Final_Risk
+    """
+    # load only the needed columns of the COF and LOF results
+    cof_df = read_result(results_folder, "Final_COF", cof_columns)
+    lof_df = read_result(results_folder, "Final_LOF", lof_columns)
+
+    # merge the two dfs
+    risk_df = call("merge", pd.merge, cof_df, lof_df, on=unique_id, suffixes=('_cof', '_lof'))
+
+    # Normalize the COF and LOF columns
+    risk_df = call("normalize_column", normalize_column, risk_df, 'COF')
+    risk_df = call("normalize_column", normalize_column, risk_df, 'LOF')
 
-# File paths for the COF and LOF CSV files
-cof_file_path = r"C:\Users\ggarcia\OneDrive - Abonmarche\Documents\GitHub\Utility-System-Risk\AlleganSecondResults\Final_COF.csv"
-lof_file_path = r"C:\Users\ggarcia\OneDrive - Abonmarche\Documents\GitHub\Utility-System-Risk\AlleganSecondResults\Final_LOF.csv"
-risk_file_path = r"C:\Users\ggarcia\OneDrive - Abonmarche\Documents\GitHub\Utility-System-Risk\AlleganSecondResults\Final_Risk.csv"
-unique_id = 'FACILITYID'
-length_column = 'LENGTH'
-image_path = r"C:\Users\ggarcia\OneDrive - Abonmarche\Documents\GitHub\Utility-System-Risk\AlleganSecondResults\heatmap.html"
+    # Calculate the risk score as COF * LOF
+    risk_df['RISK'] = risk_df['COF_normalized'] * risk_df['LOF_normalized']
+    risk_df = enforce_dtypes(risk_df, risk_dtypes(unique_id))
 
-# make dfs from csv files
-cof_df = pd.read_csv(cof_file_path)
-lof_df = pd.read_csv(lof_file_path)
+    # save the risk_df to the result store
+    write_result(risk_df, results_folder, "Final_Risk", risk_schema(unique_id), export_csv)
+    return risk_df
 
-# merge the two dfs
-risk_df = pd.merge(cof_df, lof_df, on=unique_id, suffixes=('_cof', '_lof'))
 
-# Normalize the COF and LOF columns
-risk_df = normalize_column(risk_df, 'COF')
-risk_df = normalize_column(risk_df, 'LOF')
+def sorted_batches(results_folder: str, name: str, unique_id: str, columns=None, batch_size: int = STREAM_BATCH_SIZE):
+    """
+    Reads a result in batches, checking it is sorted by the unique id, rows without an id are dropped
+
+    :param results_folder: str: Folder of the result store
+    :param name: str: Name of the result, written with write_result(sort_by=unique_id)
+    :param unique_id: str: Water main unique id field
+    :param columns: list: Columns to read, all columns when not given
+    :param batch_size: int: Largest number of rows per batch
+    :return: iterator: DataFrame of every batch
+    """
+    previous = None
+    for df in read_result_batches(results_folder, name, columns, batch_size):
+        df = df[df[unique_id].notna()]
+        if len(df) == 0:
+            continue
+        ids = df[unique_id].to_numpy()
+        if (previous is not None and ids[0] < previous) or (ids[1:] < ids[:-1]).any():
+            raise ValueError(f"{name} is not sorted by {unique_id}, run its stage again to write it sorted")
+        previous = ids[-1]
+        yield df
+
+
+def _with_end(batches):
+    # The batches followed by None, to merge the rows held back from the last batch
+    yield from batches
+    yield None
+
+
+def merge_sorted(left_batches, right_batches, on: str, suffixes=('_x', '_y')):
+    """
+    Inner merges two inputs sorted by a key batch by batch, like pd.merge but holding about one batch of each in memory
 
-# Calculate the risk score as COF * LOF
-risk_df['RISK'] = risk_df['COF_normalized'] * risk_df['LOF_normalized']
+    Rows of the left batch with its last key are held back for the next batch so every key is merged at once, and the
+    right input is read just far enough to hold every right row with a key in the left batch.
+
+    :param left_batches: iterable: DataFrames sorted by the key, from sorted_batches
+    :param right_batches: iterable: DataFrames sorted by the key, from sorted_batches
+    :param on: str: Key column
+    :param suffixes: tuple: Suffixes of the overlapping columns, as in pd.merge
+    :return: iterator: Merged DataFrame of every batch
+    """
+    right_batches = iter(right_batches)
+    right = None
+    right_done = False
+    carry = None
+    for left in _with_end(left_batches):
+        if left is None:
+            chunk, carry = carry, None
+        else:
+            chunk = left if carry is None else pd.concat([carry, left], ignore_index=True)
+            # the rows with the last key may go on in the next batch
+            held = (chunk[on] == chunk[on].iat[-1]).to_numpy()
+            chunk, carry = chunk[~held], chunk[held]
+        if chunk is None or len(chunk) == 0:
+            continue
+        last_key = chunk[on].iat[-1]
+        while not right_done and (right is None or len(right) == 0 or not right[on].iat[-1] > last_key):
+            batch = next(right_batches, None)
+            if batch is None:
+                right_done = True
+            else:
+                right = batch if right is None else pd.concat([right, batch], ignore_index=True)
+        if right is None:
+            continue
+        # right rows up to the last key are merged now, the ones before the first key match nothing
+        taken = (right[on] <= last_key).to_numpy()
+        merged = pd.merge(chunk, right[taken], on=on, suffixes=suffixes)
+        right = right[~taken]
+        yield merged
+
+
+def streaming_risk_merge_stage(
+    results_folder: str,
+    unique_id: str,
+    cof_columns=None,
+    lof_columns=None,
+    length_column: str = 'LENGTH',
+    batch_size: int = STREAM_BATCH_SIZE,
+    export_csv: bool = False,
+) -> dict:
+    """
+    Streaming risk merge stage: merges the COF and LOF results and scores the risk batch by batch, saved to Final_Risk
+
+    The results are merged twice in batches by the unique id: the first pass only reads the ids and scores for the
+    smallest and largest COF and LOF, the second normalizes and multiplies every batch and writes it to Final_Risk.
+    The risk matrix is summed up in the second pass as well. Memory stays about the size of a batch however large the
+    results are, they are written sorted by the unique id by the COF and LOF stages.
+
+    :return: dict: path and rows of Final_Risk, the smallest and largest COF and LOF, and the risk matrix lengths and
+        counts from matrix_cells
+    """
+    # pass 1: the smallest and largest COF and LOF of the merged mains
+    limits = {'COF': [np.inf, -np.inf], 'LOF': [np.inf, -np.inf]}
+    with span("risk limits") as record:
+        rows = 0
+        for merged in merge_sorted(
+            sorted_batches(results_folder, "Final_COF", unique_id, [unique_id, 'COF'], batch_size),
+            sorted_batches(results_folder, "Final_LOF", unique_id, [unique_id, 'LOF'], batch_size),
+            unique_id,
+        ):
+            for column, limit in limits.items():
+                limit[0] = min(limit[0], merged[column].min())
+                limit[1] = max(limit[1], merged[column].max())
+            rows += len(merged)
+        record["rows_out"] = rows
+
+    # pass 2: normalize and multiply every merged batch and sum up the risk matrix
+    lengths = np.zeros(RISK_LEVELS ** 2)
+    counts = np.zeros(RISK_LEVELS ** 2, dtype=np.int64)
+
+    def risk_batches():
+        nonlocal lengths, counts
+        for risk_df in merge_sorted(
+            sorted_batches(results_folder, "Final_COF", unique_id, cof_columns, batch_size),
+            sorted_batches(results_folder, "Final_LOF", unique_id, lof_columns, batch_size),
+            unique_id, suffixes=('_cof', '_lof'),
+        ):
+            for column, (min_value, max_value) in limits.items():
+                risk_df[column + '_normalized'] = normalize_values(risk_df[column], min_value, max_value)
+            risk_df['RISK'] = risk_df['COF_normalized'] * risk_df['LOF_normalized']
+            # the id is left as read, categories differing between batches would not concatenate as categoricals
+            risk_df = enforce_dtypes(risk_df, {
+                column: dtype for column, dtype in risk_dtypes(unique_id).items() if column != unique_id
+            })
+            if length_column in risk_df.columns:
+                cell_lengths, cell_counts = matrix_cells(risk_df, 'LOF_normalized', 'COF_normalized', length_column)
+                lengths += cell_lengths
+                counts += cell_counts
+            yield risk_df
+
+    written = write_result_batches(risk_batches(), results_folder, "Final_Risk", risk_schema(unique_id), export_csv)
+    return {
+        **written,
+        "limits": {column: [float(value) for value in limit] for column, limit in limits.items()},
+        "matrix_lengths": lengths,
+        "matrix_counts": counts,
+    }
+
+
+def streaming_risk_matrix_stage(
+    risk_summary: dict, results_folder: str, length_column: str, export_csv: bool = False
+) -> pd.DataFrame:
+    """
+    Streaming risk matrix stage: the risk matrix summed up by the streaming risk merge, saved to RiskMatrix
+
+    :return: pd.DataFrame: RiskMatrix
+    """
+    matrix_df = matrix_frame(risk_summary["matrix_lengths"], risk_summary["matrix_counts"], length_column)
+    write_result(matrix_df, results_folder, "RiskMatrix", risk_matrix_schema(length_column), export_csv)
+    return matrix_df
+
+
+def risk_matrix_stage(
+    risk_df: pd.DataFrame, results_folder: str, length_column: str, export_csv: bool = False
+) -> pd.DataFrame:
+    """
+    Risk matrix stage: the length and number of mains in every LOF x COF cell of the risk results, saved to RiskMatrix
+
+    :return: pd.DataFrame: RiskMatrix
+    """
+    matrix_df = call("risk_matrix", risk_matrix, risk_df, 'LOF_normalized', 'COF_normalized', length_column)
+    write_result(matrix_df, results_folder, "RiskMatrix", risk_matrix_schema(length_column), export_csv)
+    return matrix_df
+
+
+def heatmap_stage(matrix_df: pd.DataFrame, length_column: str) -> str:
+    """
+    Heatmap stage: the COF vs LOF heatmap of the risk matrix
+
+    :return: str: Plotly JSON of the heatmap figure
+    """
+    # create the heatmap
+    plot = call("create_matrix_heatmap", create_matrix_heatmap, matrix_df, length_column)
+    return plot.to_json()
+
+
+def _run_risk_stages(
+    results_folder: str, unique_id: str, length_column: str, image_path: str, cof_columns, lof_columns,
+    export_csv: bool, use_cache: bool, streaming: bool, batch_size: int,
+) -> StageCache:
+    # Runs the risk merge, risk matrix and heatmap stages in memory or in batches and saves the heatmap
+    image_path = image_path or os.path.join(results_folder, "heatmap.html")
+    with Trace("Risk", os.path.join(results_folder, "Traces")):
+        stages = StageCache(os.path.join(results_folder, "StageCache"), enabled=use_cache)
+
+        inputs = {
+            name: file_fingerprint(os.path.join(results_folder, name + ".parquet")) for name in ("Final_COF", "Final_LOF")
+        }
+        if streaming:
+            stages.run(
+                "risk_merge", streaming_risk_merge_stage,
+                params=dict(
+                    results_folder=results_folder, unique_id=unique_id, cof_columns=cof_columns, lof_columns=lof_columns,
+                    length_column=length_column, batch_size=batch_size, export_csv=export_csv,
+                ),
+                inputs=inputs,
+                outputs=result_paths(results_folder, ["Final_Risk"], export_csv),
+            )
+            stages.run(
+                "risk_matrix", streaming_risk_matrix_stage,
+                params=dict(results_folder=results_folder, length_column=length_column, export_csv=export_csv),
+                upstream={"risk_summary": "risk_merge"},
+                outputs=result_paths(results_folder, ["RiskMatrix"], export_csv),
+            )
+        else:
+            stages.run(
+                "risk_merge", risk_merge_stage,
+                params=dict(
+                    results_folder=results_folder, unique_id=unique_id, cof_columns=cof_columns, lof_columns=lof_columns,
+                    export_csv=export_csv,
+                ),
+                inputs=inputs,
+                outputs=result_paths(results_folder, ["Final_Risk"], export_csv),
+            )
+            stages.run(
+                "risk_matrix", risk_matrix_stage,
+                params=dict(results_folder=results_folder, length_column=length_column, export_csv=export_csv),
+                upstream={"risk_df": "risk_merge"},
+                outputs=result_paths(results_folder, ["RiskMatrix"], export_csv),
+            )
+        stages.run("heatmap", heatmap_stage, params=dict(length_column=length_column), upstream={"matrix_df": "risk_matrix"})
+
+        # Save the heatmap as an image file
+        with span("write_html"):
+            plotly.io.from_json(stages.get("heatmap")).write_html(image_path)
+    return stages
+
+
+def run_risk(
+    results_folder: str,
+    unique_id: str = 'FACILITYID',
+    length_column: str = 'LENGTH',
+    image_path: str = None,
+    cof_columns=None,
+    lof_columns=None,
+    export_csv: bool = False,
+    use_cache: bool = True,
+) -> pd.DataFrame:
+    """
+    Merges a city's COF and LOF results into risk scores, saves Final_Risk and the heatmap
+
+    The analysis runs as the risk merge, risk matrix and heatmap stages, they only run again when the COF or LOF
+    results or the parameters changed since their outputs were cached in the StageCache folder of the results folder.
+    The heatmap is drawn from the risk matrix, so its size does not grow with the number of mains. The time, memory and
+    row counts of every stage are written to a JSON trace in the Traces folder of the results folder and printed as a
+    table at the end. For systems too large to hold the COF and LOF results in memory use run_risk_streaming.
+
+    :param results_folder: str: Folder of the city's result store with the COF and LOF results
+    :param unique_id: str: Water main unique id field
+    :param length_column: str: Name of the length column
+    :param image_path: str: Path of the heatmap html file, heatmap.html in the results folder when not given
+    :param cof_columns: list: COF columns to read, every column is carried into the risk results when not given
+    :param lof_columns: list: LOF columns to read, every column is carried into the risk results when not given
+    :param export_csv: bool: Also write a CSV copy of the risk results next to the result store file
+    :param use_cache: bool: Reuse the cached stage outputs, every stage runs when False
+    :return: pd.DataFrame: Final_Risk results
+    """
+    stages = _run_risk_stages(
+        results_folder, unique_id, length_column, image_path, cof_columns, lof_columns, export_csv, use_cache,
+        streaming=False, batch_size=None,
+    )
+    return stages.get("risk_merge")
+
+
+def run_risk_streaming(
+    results_folder: str,
+    unique_id: str = 'FACILITYID',
+    length_column: str = 'LENGTH',
+    image_path: str = None,
+    cof_columns=None,
+    lof_columns=None,
+    export_csv: bool = False,
+    use_cache: bool = True,
+    batch_size: int = STREAM_BATCH_SIZE,
+) -> dict:
+    """
+    Merges a city's COF and LOF results into risk scores batch by batch in bounded memory, the same stages and outputs
+    as run_risk with the risk merge and risk matrix of streaming_risk_merge_stage and streaming_risk_matrix_stage
+
+    Final_Risk is written to the result store without being held in memory, so the summary of the merge is returned
+    rather than the results, read them with read_result or read_result_batches.
+
+    :param results_folder: str: Folder of the city's result store with the COF and LOF results
+    :param unique_id: str: Water main unique id field
+    :param length_column: str: Name of the length column
+    :param image_path: str: Path of the heatmap html file, heatmap.html in the results folder when not given
+    :param cof_columns: list: COF columns to read, every column is carried into the risk results when not given
+    :param lof_columns: list: LOF columns to read, every column is carried into the risk results when not given
+    :param export_csv: bool: Also write a CSV copy of the risk results next to the result store file
+    :param use_cache: bool: Reuse the cached stage outputs, every stage runs when False
+    :param batch_size: int: Rows per batch
+    :return: dict: Summary from streaming_risk_merge_stage, with the path and rows of Final_Risk
+    """
+    stages = _run_risk_stages(
+        results_folder, unique_id, length_column, image_path, cof_columns, lof_columns, export_csv, use_cache,
+        streaming=True, batch_size=batch_size,
+    )
+    return stages.get("risk_merge")
 
-# create the heatmap
-plot = create_heatmap(risk_df, 'LOF_normalized', 'COF_normalized', length_column)
 
-# Save the heatmap as an image file
-plot.write_html(image_path)
+if __name__ == "__main__":
+    # Folder of the result store with the COF and LOF results
+    results_folder = r"C:\Users\ggarcia\OneDrive - Abonmarche\Documents\GitHub\Utility-System-Risk\AlleganSecondResults"
+    unique_id = 'FACILITYID'
+    length_column = 'LENGTH'
+    image_path = r"C:\Users\ggarcia\OneDrive - Abonmarche\Documents\GitHub\Utility-System-Risk\AlleganSecondResults\heatmap.html"
+    # Columns to read from each result, set to None to carry every column into the risk results
+    cof_columns = [unique_id, 'COF', length_column]
+    lof_columns = [unique_id, 'LOF']
+    # also write a CSV copy of the risk results next to the result store file
+    export_csv = False
+    # merge the results in batches, for systems too large to hold the results in memory
+    streaming = False
 
-# save the risk_df as a csv
-risk_df.to_csv(risk_file_path, index=False)
\ No newline at end of file
+    run = run_risk_streaming if streaming else run_risk
+    run(results_folder, unique_id, length_column, image_path, cof_columns, lof_columns, export_csv)
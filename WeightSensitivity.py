@@ -0,0 +1,259 @@
+import os
+import numpy as np
+import pandas as pd
+from COFScoring import COF_WEIGHTS, normalize_weights, weighted_sum
+from Instrumentation import Trace, call, span
+from ResultStore import read_result, write_result
+from Schemas import COF_SCORE_COLUMNS, sensitivity_schema
+
+# The COF weights are judgement calls, the sensitivity analysis scores every main under many weight scenarios at once
+# and reports how far its COF and its COF and risk rank move. The scores of Final_COF are multiplied by a
+# (scores x scenarios) weight matrix in blocks of scenarios, so thousands of scenarios take seconds rather than
+# thousands of COF runs. Scenario 0 is always the weights the COF was scored with.
+
+# Number of weight scenarios sampled around the weights
+DEFAULT_SCENARIOS = 1000
+# Concentration of the Dirichlet distribution the scenarios are sampled from, the larger the closer to the weights
+DEFAULT_CONCENTRATION = 50
+# Scenarios scored at once, the working memory is about mains x this many float64
+SCENARIO_BATCH_SIZE = 64
+
+
+def sample_weights(
+    weights: dict = COF_WEIGHTS, scenarios: int = DEFAULT_SCENARIOS, concentration: float = DEFAULT_CONCENTRATION,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """
+    Samples weight scenarios from a Dirichlet distribution centered on the weights
+
+    Every scenario sums to 1 and has the normalized weights as its mean, a weight of 0 stays 0.
+
+    :param weights: dict: Weight for each score column
+    :param scenarios: int: Number of scenarios to sample
+    :param concentration: float: Larger values keep the scenarios closer to the weights
+    :param seed: int: Random seed
+    :return: pd.DataFrame: One row per scenario and one column per score column
+    """
+    base = np.array(list(weights.values()), dtype=float)
+    base = base / base.sum()
+    sampled = np.zeros((scenarios, len(base)))
+    positive = base > 0
+    rng = np.random.default_rng(seed)
+    sampled[:, positive] = rng.dirichlet(base[positive] * concentration, size=scenarios)
+    return pd.DataFrame(sampled, columns=list(weights))
+
+
+def read_weight_scenarios(scenario_file: str) -> pd.DataFrame:
+    """
+    Reads weight scenarios from a CSV file with one row per scenario and a column per score column
+
+    :param scenario_file: str: Path of the CSV file, the score columns it does not have get a weight of 0
+    :return: pd.DataFrame: One row per scenario and one column per score column in COF_SCORE_COLUMNS it has
+    """
+    scenarios_df = pd.read_csv(scenario_file)
+    unknown = [column for column in scenarios_df.columns if column not in COF_SCORE_COLUMNS]
+    if unknown:
+        raise ValueError(f"{scenario_file} has columns that are not COF scores: {', '.join(unknown)}")
+    return scenarios_df.fillna(0)
+
+
+def weight_matrix(scenarios_df: pd.DataFrame, columns) -> np.ndarray:
+    """
+    Normalizes every scenario over the score columns that are available, like normalize_weights
+
+    :param scenarios_df: pd.DataFrame: One row per scenario and one column per score column
+    :param columns: list: Available score columns, in the order of the score matrix
+    :return: np.ndarray: (scores x scenarios) weight matrix, every column sums to 1
+    """
+    matrix = scenarios_df.reindex(columns=list(columns), fill_value=0).to_numpy(dtype=float).T
+    # summed in column order like normalize_weights so scenario 0 gets the exact weights the COF was scored with
+    totals = np.zeros(matrix.shape[1])
+    for row in matrix:
+        totals = totals + row
+    if (totals <= 0).any():
+        raise ValueError("Every weight scenario needs a positive weight on an available score column")
+    return matrix / totals
+
+
+def rank_descending(values: np.ndarray) -> np.ndarray:
+    """
+    Ranks the mains by whole number values in every scenario, 1 for the highest, tied mains share the best rank
+
+    Counting the values of every scenario with one bincount makes it linear in the number of mains and scenarios.
+
+    :param values: np.ndarray: (mains x scenarios) whole numbers from 0 up, NaN for mains that are not ranked
+    :return: np.ndarray: (mains x scenarios) rank of every main, NaN where the value is NaN
+    """
+    n_mains, n_scenarios = values.shape
+    ranked = ~np.isnan(values)
+    if not ranked.any():
+        return np.full(values.shape, np.nan)
+    codes = np.where(ranked, values, 0).astype(np.int64)
+    levels = int(codes.max()) + 1
+    cells = codes + np.arange(n_scenarios) * levels
+    counts = np.bincount(cells[ranked], minlength=n_scenarios * levels).reshape(n_scenarios, levels)
+    # number of mains with a higher value than every level of every scenario
+    higher = np.cumsum(counts[:, ::-1], axis=1)[:, ::-1] - counts
+    ranks = (higher.ravel()[cells] + 1).astype(float)
+    ranks[~ranked] = np.nan
+    return ranks
+
+
+def _normalize_scenarios(values: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    # normalize_values of every scenario column over the given rows, missing values are left out of the limits
+    with np.errstate(all="ignore"):
+        min_values = np.nanmin(values[rows], axis=0)
+        max_values = np.nanmax(values[rows], axis=0)
+        normalized = np.ceil((values - min_values) * (9 / (max_values - min_values)) + 1)
+    return np.where(min_values == max_values, values, normalized)
+
+
+def cof_sensitivity(
+    score_matrix: np.ndarray, weights: np.ndarray, lof_normalized: np.ndarray = None,
+    batch_size: int = SCENARIO_BATCH_SIZE,
+) -> dict:
+    """
+    Scores every main under every weight scenario and keeps the smallest and largest COF, COF rank and risk rank
+
+    The risk of a scenario is its COF normalized over the mains with a LOF times the normalized LOF, as the risk merge
+    scores it.
+
+    :param score_matrix: np.ndarray: (mains x scores) matrix
+    :param weights: np.ndarray: (scores x scenarios) weight matrix from weight_matrix
+    :param lof_normalized: np.ndarray: Normalized LOF of every main, NaN for mains without a LOF, no risk ranks when
+        not given
+    :param batch_size: int: Scenarios scored at once
+    :return: dict: Arrays of every main: COF, COF_rank and optionally Risk_rank under scenario 0, and the min and max
+        of each over the scenarios
+    """
+    n_mains = score_matrix.shape[0]
+    measures = ["COF", "COF_rank"] + (["Risk_rank"] if lof_normalized is not None else [])
+    result = {}
+    for measure in measures:
+        result[measure + "_min"] = np.full(n_mains, np.inf)
+        result[measure + "_max"] = np.full(n_mains, -np.inf)
+    if lof_normalized is not None:
+        has_lof = ~np.isnan(lof_normalized)
+
+    for start in range(0, weights.shape[1], batch_size):
+        values = {"COF": np.ceil(weighted_sum(score_matrix, weights[:, start:start + batch_size]))}
+        values["COF_rank"] = rank_descending(values["COF"])
+        if lof_normalized is not None:
+            risk = _normalize_scenarios(values["COF"], has_lof) * lof_normalized[:, None]
+            values["Risk_rank"] = rank_descending(risk)
+        for measure in measures:
+            if start == 0:
+                result[measure] = values[measure][:, 0]
+            # a main with a missing value in any scenario gets a missing min and max
+            result[measure + "_min"] = np.minimum(result[measure + "_min"], values[measure].min(axis=1))
+            result[measure + "_max"] = np.maximum(result[measure + "_max"], values[measure].max(axis=1))
+    return result
+
+
+def sensitivity_table(main_ids, sensitivity: dict, unique_id: str) -> pd.DataFrame:
+    """
+    :return: pd.DataFrame: unique_id and the values of cof_sensitivity, with the range of every rank
+    """
+    sensitivity_df = pd.DataFrame({unique_id: np.asarray(main_ids)})
+    for measure in ("COF", "COF_rank", "Risk_rank"):
+        if measure not in sensitivity:
+            continue
+        for suffix in ("", "_min", "_max"):
+            sensitivity_df[measure + suffix] = sensitivity[measure + suffix]
+        if measure != "COF":
+            sensitivity_df[measure + "_range"] = sensitivity[measure + "_max"] - sensitivity[measure + "_min"]
+    return sensitivity_df
+
+
+def sensitivity_stage(
+    results_folder: str,
+    unique_id: str,
+    scenarios_df: pd.DataFrame,
+    weights: dict = COF_WEIGHTS,
+    batch_size: int = SCENARIO_BATCH_SIZE,
+    export_csv: bool = False,
+) -> pd.DataFrame:
+    """
+    Sensitivity stage: the range of the COF, COF rank and risk rank of every main over the weight scenarios, saved to
+    COFSensitivity with the weight matrix saved to WeightScenarios
+
+    :return: pd.DataFrame: COFSensitivity
+    """
+    cof_df = read_result(results_folder, "Final_COF")
+    columns = list(normalize_weights(weights, cof_df.columns))
+    base_df = pd.DataFrame([weights])
+    weights_matrix = weight_matrix(pd.concat([base_df, scenarios_df], ignore_index=True), columns)
+    score_matrix = cof_df[columns].to_numpy(dtype=float)
+
+    lof_normalized = None
+    if os.path.exists(os.path.join(results_folder, "Final_LOF.parquet")):
+        lof = read_result(results_folder, "Final_LOF", [unique_id, "LOF"]).drop_duplicates(unique_id)
+        lof_values = cof_df[unique_id].astype(object).map(lof.set_index(unique_id)["LOF"]).to_numpy(dtype=float)
+        has_lof = ~np.isnan(lof_values)
+        if has_lof.any():
+            lof_min, lof_max = lof_values[has_lof].min(), lof_values[has_lof].max()
+            lof_normalized = lof_values if lof_min == lof_max else np.ceil(
+                (lof_values - lof_min) * (9 / (lof_max - lof_min)) + 1
+            )
+
+    sensitivity = call(
+        "cof_sensitivity", cof_sensitivity, score_matrix, weights_matrix, lof_normalized, batch_size=batch_size
+    )
+    sensitivity_df = sensitivity_table(cof_df[unique_id].to_numpy(), sensitivity, unique_id)
+
+    weights_df = pd.DataFrame(weights_matrix.T, columns=columns)
+    weights_df.insert(0, "Scenario", np.arange(len(weights_df)))
+    write_result(weights_df, results_folder, "WeightScenarios", export_csv=export_csv)
+    write_result(sensitivity_df, results_folder, "COFSensitivity", sensitivity_schema(unique_id), export_csv)
+    return sensitivity_df
+
+
+def run_sensitivity(
+    results_folder: str,
+    unique_id: str = 'FACILITYID',
+    scenarios: int = DEFAULT_SCENARIOS,
+    weights: dict = COF_WEIGHTS,
+    scenario_file: str = None,
+    concentration: float = DEFAULT_CONCENTRATION,
+    seed: int = 0,
+    batch_size: int = SCENARIO_BATCH_SIZE,
+    export_csv: bool = False,
+) -> pd.DataFrame:
+    """
+    Scores the COF of every main under many weight scenarios and saves the range of its COF and its COF and risk rank
+
+    Reads the score columns of Final_COF, and Final_LOF for the risk ranks, so it runs after the COF and LOF pipelines.
+    The time and memory of the run are written to a JSON trace in the Traces folder of the results folder.
+
+    :param results_folder: str: Folder of the city's result store
+    :param unique_id: str: Water main unique id field
+    :param scenarios: int: Number of scenarios to sample around the weights, when no scenario file is given
+    :param weights: dict: Weight for each score column the COF was scored with, scenario 0
+    :param scenario_file: str: CSV file of weight scenarios to use instead of sampling them
+    :param concentration: float: Larger values sample scenarios closer to the weights
+    :param seed: int: Random seed of the sampled scenarios
+    :param batch_size: int: Scenarios scored at once
+    :param export_csv: bool: Also write CSV copies next to the result store files
+    :return: pd.DataFrame: COFSensitivity
+    """
+    with Trace("Sensitivity", os.path.join(results_folder, "Traces")):
+        with span("weight scenarios") as record:
+            if scenario_file:
+                scenarios_df = read_weight_scenarios(scenario_file)
+            else:
+                scenarios_df = sample_weights(weights, scenarios, concentration, seed)
+            record["rows_out"] = len(scenarios_df)
+        return sensitivity_stage(results_folder, unique_id, scenarios_df, weights, batch_size, export_csv)
+
+
+if __name__ == "__main__":
+    # Folder of the result store with the COF and LOF results
+    results_folder = r"C:\Users\ggarcia\OneDrive - Abonmarche\Documents\GitHub\Utility-System-Risk\AlleganSecondResults"
+    unique_id = 'FACILITYID'
+    # number of weight scenarios to sample around the COF weights
+    scenarios = 1000
+    # CSV file of weight scenarios to use instead, one column per score column, set to None to sample them
+    scenario_file = None
+    export_csv = False
+
+    run_sensitivity(results_folder, unique_id, scenarios, scenario_file=scenario_file, export_csv=export_csv)
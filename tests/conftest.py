@@ -0,0 +1,136 @@
+import json
+import os
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+# The modules live at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class StandInService:
+    # Local stand-in for ArcGIS feature service layers, answering the layer description (?f=json) and the /query
+    # requests for object ids, edit statistics, OBJECTID ranges and object id lists
+
+    def __init__(self, max_record_count: int = 5, delay: float = 0.02):
+        self.layers = {}
+        self.max_record_count = max_record_count
+        self.delay = delay
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def add_layer(self, name: str, object_ids, last_edit_date: int = 1700000000000) -> str:
+        # Point features with an id, an edit date and a geometry, the url of the layer is returned
+        self.layers[name] = {
+            "last_edit_date": last_edit_date,
+            "features": {
+                int(oid): {"attributes": {"OBJECTID": int(oid), "EDITED": 0}, "geometry": {"x": float(oid), "y": 0.0}}
+                for oid in object_ids
+            },
+        }
+        return f"http://127.0.0.1:{self.server.server_address[1]}/arcgis/rest/services/{name}/FeatureServer/0"
+
+    def edit(self, name: str, object_ids, edit_date: int):
+        # Marks features as edited at the date, adding the ones that are new
+        layer = self.layers[name]
+        for oid in object_ids:
+            layer["features"][int(oid)] = {
+                "attributes": {"OBJECTID": int(oid), "EDITED": edit_date}, "geometry": {"x": float(oid), "y": 1.0}
+            }
+        layer["last_edit_date"] = edit_date
+
+    def queries(self, name: str, kind: str) -> list:
+        return [params for layer, query, params in self.requests if layer == name and query == kind]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _answer(self, name: str, path: str, params: dict) -> dict:
+        layer = self.layers[name]
+        features = layer["features"]
+        if not path.endswith("/query"):
+            self.requests.append((name, "info", params))
+            return {
+                "objectIdField": "OBJECTID",
+                "geometryType": "esriGeometryPoint",
+                "maxRecordCount": self.max_record_count,
+                "fields": [{"name": "OBJECTID", "type": "esriFieldTypeOID"}, {"name": "EDITED", "type": "esriFieldTypeDate"}],
+                "extent": {"spatialReference": {"wkid": 102690}},
+                "editingInfo": {"lastEditDate": layer["last_edit_date"]},
+                "editFieldsInfo": {"editDateField": "EDITED"},
+            }
+        where = params.get("where", "")
+        if "outStatistics" in params:
+            self.requests.append((name, "statistics", params))
+            return {"features": [{"attributes": {"max_oid": max(features, default=None), "feature_count": len(features)}}]}
+        if params.get("returnIdsOnly") == "true":
+            self.requests.append((name, "ids", params))
+            if where.startswith("EDITED >= "):
+                ids = [oid for oid, feature in features.items() if feature["attributes"]["EDITED"]]
+            else:
+                ids = list(features)
+            # services return the ids in no particular order
+            return {"objectIdFieldName": "OBJECTID", "objectIds": ids[::-1]}
+        if "objectIds" in params:
+            self.requests.append((name, "objectIds", params))
+            ids = [int(oid) for oid in params["objectIds"].split(",")]
+            found = [features[oid] for oid in ids if oid in features]
+        else:
+            first, last = (int(value) for value in re.findall(r"OBJECTID [<>]= (\d+)", where))
+            self.requests.append((name, "page", params))
+            found = [features[oid] for oid in sorted(features) if first <= oid <= last]
+        if len(found) > self.max_record_count:
+            return {"error": {"message": "More features than maxRecordCount"}}
+        return {"features": found}
+
+    def _handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+                params = {key: values[0] for key, values in parse_qs(body).items()}
+                url = urlparse(self.path)
+                name = url.path.split("/services/")[1].split("/")[0]
+                with service.lock:
+                    service.in_flight += 1
+                    service.max_in_flight = max(service.max_in_flight, service.in_flight)
+                try:
+                    with service.lock:
+                        answer = service._answer(name, url.path, params)
+                    first = re.search(r"OBJECTID >= (\d+)", params.get("where", ""))
+                    # the first pages answer last so the pages of a layer arrive out of order
+                    time.sleep(service.delay * (1 + (3 / (1 + int(first.group(1))) if first else 0)))
+                finally:
+                    with service.lock:
+                        service.in_flight -= 1
+                data = json.dumps(answer).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+@pytest.fixture
+def service():
+    stand_in = StandInService()
+    yield stand_in
+    stand_in.close()
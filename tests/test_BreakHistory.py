@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+
+from BreakHistory import breaks_outside_window, break_table, build_break_history, decay_rates, window_counts, window_table
+
+AS_OF = "2024-01-01"
+# 5 years back from AS_OF is 1826 days, to 2019-01-01, and 20 years is 7305 days, to 2004-01-01
+BREAKS = pd.DataFrame({
+    "main": [0, 0, 0, 0, 1, 1, -1],
+    "date": ["2019-01-01", "2019-01-02", "2024-01-01", None, "2024-01-02", "2010-06-01", "2020-01-01"],
+})
+
+
+def _history():
+    # A has breaks on the first day of the 5 year window, the day after, the end date and one undated break, B has one
+    # break after the end date and one old break, C has none and the last break is farther than the tolerance
+    return build_break_history(["A", "B", "C"], BREAKS["main"].to_numpy(), BREAKS["date"])
+
+
+def _rate(*ages_in_days, half_life=10):
+    return sum(0.5 ** (age / 365.25 / half_life) for age in ages_in_days) * np.log(2) / half_life
+
+
+def test_window_counts():
+    history = _history()
+    # every break ever, undated ones included, the unmatched break is dropped
+    assert window_counts(history).tolist() == [4, 2, 0]
+    # the first day of the window is left out, the end date is counted and the break after it is not
+    assert window_counts(history, 5, AS_OF).tolist() == [2, 0, 0]
+    assert window_counts(history, [5, 20], AS_OF).tolist() == [[2, 3], [0, 1], [0, 0]]
+    assert window_counts(history, 5, "2024-01-02").tolist() == [1, 1, 0]
+
+
+def test_decay_rates():
+    # undated breaks and breaks after the end date are left out, a main without breaks has no rate
+    rates = decay_rates(_history(), 10, AS_OF)
+    assert np.allclose(rates, [_rate(1826, 1825, 0), _rate(4962), 0])
+
+
+def test_breaks_outside_window():
+    # of the 5 dated breaks of A and B, the first day of the window, the break after the end and the old break are out
+    assert breaks_outside_window(_history(), 5, AS_OF) == (3, 5)
+    assert breaks_outside_window(_history(), 20, AS_OF) == (1, 5)
+
+
+def test_break_table():
+    # only mains with breaks in the window are listed
+    breaks_df = break_table(_history(), "FACILITYID", 5, 10, AS_OF)
+    assert breaks_df["FACILITYID"].tolist() == ["A"]
+    assert breaks_df["Breaks"].tolist() == [2]
+    assert breaks_df["Breaks_score"].tolist() == [10]
+    assert np.allclose(breaks_df["Break_Rate"], [_rate(1826, 1825, 0)])
+    assert break_table(_history(), "FACILITYID", 20, as_of=AS_OF)["Breaks_score"].tolist() == [10, 8]
+
+
+def test_window_table():
+    window_df = window_table(_history(), "FACILITYID", as_of=AS_OF)
+    assert window_df["FACILITYID"].tolist() == ["A", "B"]
+    assert window_df["Breaks"].tolist() == [4, 2]
+    assert window_df["Breaks_5y"].tolist() == [2, 0]
+    assert window_df["Breaks_10y"].tolist() == [3, 0]
+    assert window_df["Breaks_20y"].tolist() == [3, 1]
+
+
+def test_no_breaks():
+    history = build_break_history(["A", "B"], np.array([], dtype=np.int64), [])
+    assert window_counts(history).tolist() == [0, 0]
+    assert window_counts(history, 5, AS_OF).tolist() == [0, 0]
+    assert decay_rates(history, 10, AS_OF).tolist() == [0, 0]
+    assert breaks_outside_window(history, 5, AS_OF) == (0, 0)
+    assert len(break_table(history, "FACILITYID", 5, 10, AS_OF)) == 0
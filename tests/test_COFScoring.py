@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from COFScoring import score_affected_lats, score_buildings, score_diameter, score_railroad, score_waterbodies
+
+NAN = np.nan
+# Just below and just above a breakpoint
+EPS = 1e-9
+
+# (value, score) at, just below and just above every breakpoint of the baseline if/elif scorers, NaN where they
+# returned None
+DIAMETER = [
+    (4 - EPS, 1), (4, 4), (4 + EPS, 4),
+    (8 - EPS, 4), (8, 4), (8 + EPS, 7),
+    (16 - EPS, 7), (16, 7), (16 + EPS, 10),
+    (NAN, NAN),
+]
+PROXIMITY = [
+    (0 - EPS, NAN), (0, 10), (0 + EPS, 9),
+    (10 - EPS, 9), (10, 9), (10 + EPS, 7),
+    (50 - EPS, 7), (50, 7), (50 + EPS, 5),
+    (100 - EPS, 5), (100, 5), (100 + EPS, 0),
+    (NAN, NAN),
+]
+BUILDINGS = [
+    (0 - EPS, NAN), (0, 10), (0 + EPS, 10),
+    (5 - EPS, 10), (5, 10), (5 + EPS, 5),
+    (20 - EPS, 5), (20, 5), (20 + EPS, 0),
+    (NAN, NAN),
+]
+AFFECTED_LATS = [
+    (0 - EPS, NAN), (0, 0), (0 + EPS, NAN),
+    (1 - EPS, NAN), (1, 1), (1 + EPS, 1),
+    (10 - EPS, 1), (10, 1), (10 + EPS, NAN),
+    (11 - EPS, NAN), (11, 5), (11 + EPS, 5),
+    (30 - EPS, 5), (30, 5), (30 + EPS, NAN),
+    (31 - EPS, NAN), (31, 8), (31 + EPS, 8),
+    (50 - EPS, 8), (50, 8), (50 + EPS, 10),
+    # a zone without a lateral count scores 0
+    (NAN, 0),
+]
+
+
+@pytest.mark.parametrize("scorer, cases", [
+    (score_diameter, DIAMETER),
+    (score_railroad, PROXIMITY),
+    (score_buildings, BUILDINGS),
+    (score_affected_lats, AFFECTED_LATS),
+], ids=["diameter", "railroad", "buildings", "affected_lats"])
+def test_breakpoints(scorer, cases):
+    values, expected = zip(*cases)
+    np.testing.assert_array_equal(scorer(np.array(values)), np.array(expected, dtype=float))
+
+
+def test_waterbodies():
+    # the closer of the water areas and water lines, the water lines only when strictly closer as with min()
+    values, expected = zip(*PROXIMITY)
+    np.testing.assert_array_equal(
+        score_waterbodies(np.array(values), np.full(len(values), 1000.0)), np.array(expected, dtype=float)
+    )
+    np.testing.assert_array_equal(
+        score_waterbodies([0, 20, NAN, 5, 10], [20, 0, 5, NAN, 10 + EPS]), [10, 10, NAN, 9, 9]
+    )
+
+
+def test_diameter_text():
+    # a diameter that is not a number gets the default score, a missing one scores NaN
+    np.testing.assert_array_equal(score_diameter(["6", "unknown", None, 12]), [4, 0, NAN, 7])
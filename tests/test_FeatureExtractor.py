@@ -0,0 +1,78 @@
+import json
+import os
+
+import pytest
+
+from FeatureExtractor import extract_layers, get_session
+
+# OBJECTIDs with gaps, as left by deleted features
+OBJECT_IDS = [1, 2, 3, 5, 8, 9, 10, 11, 12, 20, 21, 22, 23, 30, 31, 32, 40, 41, 50, 60, 61, 62, 70]
+
+
+def test_object_id_range_paging(service, tmp_path):
+    url = service.add_layer("Mains", OBJECT_IDS)
+    paths = extract_layers([("Mains", url)], str(tmp_path), get_session(), max_workers=3, page_size=100)
+
+    # every page is one OBJECTID range of at most maxRecordCount features, together they cover every id once
+    pages = service.queries("Mains", "page")
+    ranges = sorted(
+        tuple(int(value) for value in params["where"].replace("OBJECTID >= ", "").split(" AND OBJECTID <= "))
+        for params in pages
+    )
+    assert len(pages) == -(-len(OBJECT_IDS) // service.max_record_count)
+    assert [oid for oid in OBJECT_IDS if any(first <= oid <= last for first, last in ranges)] == OBJECT_IDS
+    assert all(ranges[index][1] < ranges[index + 1][0] for index in range(len(ranges) - 1))
+
+    # the pages arrive out of order but are written in OBJECTID order
+    with open(paths["Mains"]) as f:
+        feature_set = json.load(f)
+    assert [feature["attributes"]["OBJECTID"] for feature in feature_set["features"]] == OBJECT_IDS
+    assert feature_set["objectIdFieldName"] == "OBJECTID"
+    assert feature_set["spatialReference"] == {"wkid": 102690}
+
+
+def test_bounded_concurrency(service, tmp_path):
+    layers = [(name, service.add_layer(name, OBJECT_IDS)) for name in ("Mains", "Valves", "Laterals")]
+    paths = extract_layers(layers, str(tmp_path), get_session(), max_workers=4, page_size=100)
+
+    # the pages of every layer share one pool, they overlap but never more than max_workers at once
+    assert 1 < service.max_in_flight <= 4
+    for name, _ in layers:
+        with open(paths[name]) as f:
+            assert [feature["attributes"]["OBJECTID"] for feature in json.load(f)["features"]] == OBJECT_IDS
+
+
+def test_geojson_output(service, tmp_path):
+    url = service.add_layer("Valves", OBJECT_IDS[:4])
+    paths = extract_layers([("Valves", url)], str(tmp_path), get_session(), output_format="geojson")
+    with open(paths["Valves"]) as f:
+        collection = json.load(f)
+    assert collection["type"] == "FeatureCollection"
+    assert collection["features"][0]["geometry"] == {"type": "Point", "coordinates": [1.0, 0.0]}
+
+
+class _FailingSession:
+    # Session failing the requests the test picks, as a service error would
+
+    def __init__(self, fails):
+        self.session = get_session()
+        self.fails = fails
+
+    def post(self, url, data, **kwargs):
+        if self.fails(url, data):
+            raise RuntimeError(f"{url}: service error")
+        return self.session.post(url, data=data, **kwargs)
+
+
+@pytest.mark.parametrize("fails", [
+    lambda url, data: data.get("where", "").startswith("OBJECTID >= 21"),
+    lambda url, data: "/Valves/" in url and not url.endswith("/query"),
+], ids=["page", "plan"])
+def test_failed_extract_writes_no_file(service, tmp_path, fails):
+    # a layer is only written once every page is, the file from before is left as it was and no temporary file is left
+    layers = [(name, service.add_layer(name, OBJECT_IDS)) for name in ("Mains", "Valves")]
+    (tmp_path / "Mains.json").write_text("before")
+    with pytest.raises(RuntimeError):
+        extract_layers(layers, str(tmp_path), _FailingSession(fails), max_workers=3, page_size=100)
+    assert sorted(os.listdir(tmp_path)) == ["Mains.json"]
+    assert (tmp_path / "Mains.json").read_text() == "before"
@@ -0,0 +1,22 @@
+import json
+
+from GeometryIO import read_layer
+
+
+def test_features_without_geometry(tmp_path):
+    # A main without a geometry is left out of the arrays, its attributes are still in all_attributes
+    path = tmp_path / "mains.json"
+    path.write_text(json.dumps({
+        "geometryType": "esriGeometryPolyline",
+        "fields": [{"name": "FACILITYID", "type": "esriFieldTypeString"}],
+        "features": [
+            {"attributes": {"FACILITYID": "A"}, "geometry": {"paths": [[[0, 0], [1, 0]]]}},
+            {"attributes": {"FACILITYID": "B"}},
+            {"attributes": {"FACILITYID": "C"}, "geometry": {"paths": []}},
+            {"attributes": {"FACILITYID": "D"}, "geometry": {"paths": [[[1, 0], [2, 0]]]}},
+        ],
+    }))
+    mains = read_layer(str(path), "FACILITYID")
+    assert mains["ids"].tolist() == ["A", "D"]
+    assert len(mains["offsets"][0]) == 3
+    assert mains["all_attributes"]["FACILITYID"].tolist() == ["A", "B", "C", "D"]
@@ -0,0 +1,32 @@
+import numpy as np
+import shapely
+
+from IsolationZoneEngine import find_isolation_zones, read_lines_shapely
+
+
+def _zones(geometries, valve_xy):
+    lines = read_lines_shapely(["A", "B"], geometries)
+    return find_isolation_zones(lines, np.asarray(valve_xy, dtype=float))["main_zones"]
+
+
+def test_repeated_vertices():
+    # A repeated vertex is a zero-length segment, the zones are the same as without it
+    valve_xy = [[2.5, 0.0]]
+    repeated = _zones(
+        [shapely.LineString([(0, 0), (5, 0), (5, 0), (10, 0)]), shapely.LineString([(10, 0), (10, 10), (10, 10)])],
+        valve_xy,
+    )
+    clean = _zones(
+        [shapely.LineString([(0, 0), (5, 0), (10, 0)]), shapely.LineString([(10, 0), (10, 10)])], valve_xy
+    )
+    assert repeated.equals(clean)
+    # the valve part way along A splits it between two zones, one of them shared with B
+    assert len(repeated.loc[0, "zones"].split(";")) == 2
+    assert repeated.loc[1, "zone"] == repeated.loc[0, "zone"]
+
+
+def test_valve_on_repeated_vertex():
+    zones = _zones(
+        [shapely.LineString([(0, 0), (5, 0), (5, 0), (10, 0)]), shapely.LineString([(10, 0), (10, 10)])], [[5.0, 0.0]]
+    )
+    assert len(zones.loc[0, "zones"].split(";")) == 2
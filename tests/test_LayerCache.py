@@ -0,0 +1,38 @@
+import json
+
+from FeatureExtractor import get_session
+from LayerCache import sync_layers
+
+OBJECT_IDS = list(range(1, 41))
+NAMES = ("Mains", "Valves", "Laterals", "Hydrants")
+
+
+def _object_ids(path: str) -> list:
+    with open(path) as f:
+        return [feature["attributes"]["OBJECTID"] for feature in json.load(f)["features"]]
+
+
+def test_sync_layers_bounded_concurrency(service, tmp_path):
+    layers = [(name, service.add_layer(name, OBJECT_IDS)) for name in NAMES]
+    paths = sync_layers(layers, str(tmp_path), get_session(), max_workers=3)
+    # the layers download at once but their pages share the request budget
+    assert 1 < service.max_in_flight <= 3
+    assert all(_object_ids(path) == OBJECT_IDS for path in paths.values())
+
+    # every layer fetches its added and edited features again on the next run, still within the budget
+    for name in NAMES:
+        service.edit(name, list(range(1, 21)) + [41, 42], 1800000000000)
+    service.max_in_flight = 0
+    paths = sync_layers(layers, str(tmp_path), get_session(), max_workers=3)
+    assert 1 < service.max_in_flight <= 3
+    assert all(len(service.queries(name, "objectIds")) == 5 for name in NAMES)
+    assert all(_object_ids(path) == OBJECT_IDS + [41, 42] for path in paths.values())
+
+
+def test_sync_layers_unchanged(service, tmp_path):
+    layers = [(name, service.add_layer(name, OBJECT_IDS)) for name in NAMES[:2]]
+    sync_layers(layers, str(tmp_path), get_session())
+    pages = len(service.requests)
+    sync_layers(layers, str(tmp_path), get_session())
+    # an unchanged layer only has its edit state checked
+    assert {query for _, query, _ in service.requests[pages:]} == {"info", "statistics"}
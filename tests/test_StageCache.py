@@ -0,0 +1,26 @@
+from StageCache import StageCache
+
+
+def _write_stage(path: str, value: int) -> int:
+    with open(path, "w") as f:
+        f.write(str(value))
+    return value
+
+
+def test_missing_output_reruns_stage(tmp_path):
+    # A cached stage runs again when the file it writes is deleted or overwritten, so its output is always written
+    output = str(tmp_path / "Final.csv")
+
+    def run():
+        stages = StageCache(str(tmp_path / "StageCache"))
+        ran = stages.run("write", _write_stage, params=dict(path=output, value=1), outputs=[output])
+        return ran, stages.get("write")
+
+    assert run() == (True, 1)
+    assert run() == (False, 1)
+    (tmp_path / "Final.csv").unlink()
+    assert run() == (True, 1)
+    assert (tmp_path / "Final.csv").read_text() == "1"
+    (tmp_path / "Final.csv").write_text("2")
+    assert run() == (True, 1)
+    assert run() == (False, 1)
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ResultStore import read_result, write_result
+from WaterMainRisk import merge_sorted, run_risk, run_risk_streaming
+
+# Ids on both sides, COF only (C, F), LOF only (B, E), and a duplicated id on each side (D, G)
+COF = pd.DataFrame({
+    "FACILITYID": ["A", "C", "D", "D", "F", "G", "H", "I"],
+    "COF": [10, 40, 25, 30, 80, 55, 70, 95],
+    "LENGTH": [100.0, 250.0, 75.0, 20.0, 300.0, 125.0, 60.0, 410.0],
+})
+LOF = pd.DataFrame({
+    "FACILITYID": ["A", "B", "D", "E", "G", "G", "H", "I"],
+    "LOF": [1.5, 2.0, 7.0, 3.5, 4.0, 9.0, 5.5, 8.0],
+})
+
+
+def _batches(df: pd.DataFrame, batch_size: int):
+    for start in range(0, len(df), batch_size):
+        yield df.iloc[start:start + batch_size].reset_index(drop=True)
+
+
+def _sorted(df: pd.DataFrame) -> pd.DataFrame:
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("batch_size", [1, 2, 3, 100])
+def test_merge_sorted(batch_size):
+    # batches of 1 to 3 rows split the duplicated keys between batches
+    expected = pd.merge(COF, LOF, on="FACILITYID", suffixes=("_cof", "_lof"))
+    merged = pd.concat(
+        merge_sorted(_batches(COF, batch_size), _batches(LOF, batch_size), "FACILITYID", ("_cof", "_lof")),
+        ignore_index=True,
+    )
+    pd.testing.assert_frame_equal(_sorted(merged), _sorted(expected))
+
+
+@pytest.mark.parametrize("batch_size", [1, 2, 3])
+def test_streaming_risk_matches_run_risk(tmp_path, batch_size):
+    folders = {}
+    for mode in ("memory", "streaming"):
+        folders[mode] = tmp_path / mode
+        folders[mode].mkdir()
+        write_result(COF, str(folders[mode]), "Final_COF", sort_by="FACILITYID")
+        write_result(LOF, str(folders[mode]), "Final_LOF", sort_by="FACILITYID")
+
+    risk_df = run_risk(str(folders["memory"]), use_cache=False)
+    summary = run_risk_streaming(str(folders["streaming"]), use_cache=False, batch_size=batch_size)
+
+    streamed = read_result(str(folders["streaming"]), "Final_Risk")
+    assert summary["rows"] == len(risk_df) == 7
+    pd.testing.assert_frame_equal(
+        _sorted(streamed), _sorted(read_result(str(folders["memory"]), "Final_Risk")), check_dtype=False
+    )
+    assert set(streamed["FACILITYID"]) == {"A", "D", "G", "H", "I"}
+    # the limits are those of the merged mains, not of every COF and LOF
+    assert summary["limits"] == {"COF": [10.0, 95.0], "LOF": [1.5, 9.0]}
+    pd.testing.assert_frame_equal(
+        read_result(str(folders["streaming"]), "RiskMatrix"), read_result(str(folders["memory"]), "RiskMatrix"),
+        check_dtype=False,
+    )
+    assert summary["matrix_counts"].sum() == 7
+    assert np.isclose(summary["matrix_lengths"].sum(), risk_df["LENGTH"].sum())